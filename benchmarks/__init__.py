@@ -0,0 +1,6 @@
+"""cjblog :: benchmarks
+
+Performance benchmarks for the blog. Each module may be run directly, for
+example `python -m benchmarks.storage`.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
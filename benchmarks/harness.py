@@ -0,0 +1,113 @@
+"""cjblog :: benchmark harness
+
+Helpers shared by the benchmarks: timing calls, summarizing latencies and
+saving and comparing results.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import json
+import os.path
+import platform
+import sqlite3
+import time
+
+
+# Location of the schema script used to create benchmark databases
+schema = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                      'cjblog', 'scripts', 'make_database.sql')
+
+
+def read_schema():
+    """Return the text of the real database schema script."""
+    with open(schema, 'r', encoding='utf8') as f:
+        return f.read()
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of the sorted list `values`."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies):
+    """Return a dictionary summarizing a list of latencies in seconds,
+    with every value reported in milliseconds."""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'count': count,
+        'mean_ms': (sum(latencies) / count if count else 0.0) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000
+    }
+
+
+def time_calls(func, iterations, warmup=0):
+    """Call `func` with the iteration number `warmup` times without timing
+    it and then `iterations` times, returning each call's latency."""
+    for i in range(warmup):
+        func(i)
+
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def environment():
+    """Return a description of the environment the benchmarks ran in."""
+    return {
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'processor': platform.processor()
+    }
+
+
+def save_results(path, params, results):
+    """Save benchmark `results` and the `params` they ran with as JSON."""
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(),
+                   'params': params,
+                   'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Return the benchmark results saved in `path`."""
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+
+def print_results(results, previous=None, threshold=10.0):
+    """
+    Print a table of benchmark `results`.
+
+    If the `previous` results of an earlier run are given, the change in
+    median latency is shown as well, and benchmarks which slowed down by
+    more than `threshold` percent are flagged. Returns the names of those
+    benchmarks.
+    """
+    regressions = []
+    print("{:<32} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "benchmark", "count", "p50 ms", "p90 ms", "p99 ms", "max ms",
+        "change"))
+    for name in sorted(results):
+        result = results[name]
+        change = ''
+        before = (previous or {}).get(name)
+        if before is not None and before['p50_ms'] > 0:
+            pct = (result['p50_ms'] - before['p50_ms']) / before['p50_ms']
+            change = "{:+.1f}%".format(pct * 100)
+            if pct * 100 > threshold:
+                change += " !"
+                regressions.append(name)
+        print("{name:<32} {count:>7d} {p50_ms:>9.3f} {p90_ms:>9.3f} "
+              "{p99_ms:>9.3f} {max_ms:>9.3f} {change:>9}".format(
+                  name=name, change=change, **result))
+    return regressions
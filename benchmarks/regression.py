@@ -0,0 +1,324 @@
+"""cjblog :: query regression checks
+
+Runs the public read functions of the database module and every route of
+the blog against a seeded database and checks that each one runs no more
+SQL statements than its declared budget, that the query plans use the
+intended indexes, and that no query reads every row of the articles or
+tag map tables.
+
+Run with `python -m benchmarks.regression --help` for options. The
+command exits with status 1 if any check fails, so it can guard changes
+to the query builders. The blog must be configured (`cjblog/config.py`
+must exist) for the checks to run.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+import benchmarks.suite as suite
+import benchmarks.synthetic as synthetic
+
+# Modules which keep files in the data directory (such as the slow query
+# log) are only imported once `suite.prepare` has moved it
+
+
+# Tables which must never be read in full on a read path
+_no_scan_tables = frozenset(('articles', 'tag_map'))
+
+# Number of times each check is run; the budget applies to every call, so
+# it covers both cold caches and warm ones
+_calls = 3
+
+# Statement budget and intended indexes of each public route; a tuple of
+# index names means any one of them will do
+_route_checks = {
+    'home': (4, ['article_released_date']),
+    'home.page': (4, ['article_released_date']),
+    'home_older': (4, ['article_released_date']),
+    'show_article': (3, ['title_path']),
+    'show_page': (3, ['page_title']),
+    'articles_by_tag': (4, ['tag_map_tag']),
+    'articles_by_tag_older': (4, ['tag_map_tag']),
+    'article_list': (5, ['article_released_date', 'tag_count_released']),
+    'search': (4, []),
+    'feed': (2, []),
+    'feed.tag': (2, []),
+    'sitemap_xml': (5, []),
+    'login': (1, [('page_link', 'page_released', 'page_order')]),
+}
+
+# Statement budget and intended indexes of each administrator page
+_admin_checks = {
+    'admin.home': (7, []),
+    'admin.edit_config': (4, []),
+    'admin.create_article': (4, []),
+    'admin.edit_article': (5, []),
+    'admin.create_page': (4, []),
+    'admin.edit_page': (5, []),
+}
+
+
+def statement_recorder(engine):
+    """Return a function which calls a function with the iteration number
+    and returns the list of (statement, params) tuples `engine` ran during
+    the call."""
+    recorded = []
+    active = [False]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, params, context, executemany):
+        if active[0]:
+            if executemany:
+                params = params[0] if params else ()
+            recorded.append((statement, params))
+
+    def recorder(func, i):
+        del recorded[:]
+        active[0] = True
+        try:
+            func(i)
+        finally:
+            active[0] = False
+        return list(recorded)
+    return recorder
+
+
+def database_checks(database, sample):
+    """Return a dictionary of named database checks, each a tuple of its
+    statement budget, intended indexes and a function taking the
+    iteration number."""
+    def nth(name, i):
+        values = sample[name]
+        return values[i % len(values)]
+
+    def boundaries(i):
+        database._boundary_cache.clear()
+        database.get_page_boundaries(released=True)
+
+    checks = {
+        'db.get_articles': (1, ['article_released_date'], lambda i:
+                            database.get_articles(released=True,
+                                                  with_links=True,
+                                                  tag_list=True)),
+        'db.get_articles.deep': (1, ['article_released_date'], lambda i:
+                                 database.get_articles(
+                                     released=True,
+                                     before=database.cursor_from_str(
+                                         nth('cursors', i)))),
+        'db.get_articles.unreleased': (1, ['article_released_date'],
+                                       lambda i: database.get_articles(
+                                           with_body=False, released=False)),
+        'db.get_articles.tag': (1, ['tag_map_tag'], lambda i:
+                                database.get_articles(released=True,
+                                                      tag=nth('tags', i))),
+        'db.iter_articles': (1, ['article_released_date'], lambda i:
+                             list(database.iter_articles(released=True))),
+        'db.get_article': (1, ['title_path'], lambda i:
+                           database.get_article(
+                               title_path=str(nth('articles', i)),
+                               released=True)),
+        'db.get_article.id': (1, [], lambda i: database.get_article(
+            article_id=nth('article_ids', i), released=True)),
+        'db.get_page_boundaries': (2, ['article_released_date'], boundaries),
+        'db.get_num_articles': (1, [('article_released_date', 'released')],
+                                lambda i: database.get_num_articles(
+                                    released=True)),
+        'db.get_num_articles.tag': (1, ['tag_count_tag'], lambda i:
+                                    database.get_num_articles(
+                                        released=True, tag=nth('tags', i))),
+        'db.get_all_tags': (1, ['tag_count_released'], lambda i:
+                            database.get_all_tags(released=True)),
+        'db.get_all_tags.unreleased': (1, [], lambda i:
+                                       database.get_all_tags(released=False)),
+        'db.get_page': (1, ['page_title'], lambda i: database.get_page(
+            title_path=str(nth('pages', i)), released=True)),
+        'db.get_pages': (1, [('page_link', 'page_released', 'page_order')],
+                         lambda i: database.get_pages(released=True,
+                                                      render=False,
+                                                      with_body=False,
+                                                      only_links=True)),
+        'db.search': (2, [], lambda i: database.search(nth('words', i))),
+        'db.iter_sitemap_entries': (4, [], lambda i:
+                                    list(database.iter_sitemap_entries())),
+    }
+    if not sample['cursors']:
+        del checks['db.get_articles.deep']
+    if not sample['tags']:
+        del checks['db.get_articles.tag']
+        del checks['db.get_num_articles.tag']
+    if not sample['pages']:
+        del checks['db.get_page']
+    return checks
+
+
+def in_context(app, func):
+    """Return a function calling `func` in its own application context, as
+    it would be during a request."""
+    def call(i):
+        with app.app_context():
+            func(i)
+    return call
+
+
+def route_checks(client, urls, budgets):
+    """Return a dictionary of checks requesting each of the `urls` with
+    the test `client`, using the budgets and indexes in `budgets`."""
+    benches = suite.route_benchmarks(client, urls, 'route')
+    return {name: budgets[name.split('.', 1)[1]] + (func,)
+            for name, func in benches.items()}
+
+
+def uses_index(plans, name):
+    """Return True if any step of the query `plans` uses the index
+    `name`."""
+    pattern = re.compile(r'\bINDEX {}\b'.format(re.escape(name)))
+    return any(pattern.search(step)
+               for plan in plans for step in plan or [])
+
+
+def scanned_tables(plan):
+    """Return the tables read in full by the steps of a query plan."""
+    import cjblog.slowlog as slowlog
+
+    tables = []
+    for step in slowlog.full_scans(plan):
+        tables.append(step.replace('SCAN TABLE ', 'SCAN ').split()[1])
+    return tables
+
+
+def run_check(recorder, path, budget, indexes, func):
+    """Run a check and return a tuple of the most statements it ran in one
+    call, the plan of each statement and a list of its failures."""
+    import cjblog.slowlog as slowlog
+
+    most = 0
+    plans = {}
+    for i in range(_calls):
+        statements = recorder(func, i)
+        most = max(most, len(statements))
+        for statement, params in statements:
+            if statement not in plans:
+                plans[statement] = slowlog.query_plan(path, statement,
+                                                      params)
+
+    failures = []
+    if most > budget:
+        failures.append("ran {most} statements (budget {budget})".format(
+            most=most, budget=budget))
+    for index in indexes:
+        names = index if isinstance(index, tuple) else (index,)
+        if not any(uses_index(plans.values(), name) for name in names):
+            failures.append("did not use index {}".format(
+                ' or '.join(names)))
+    for statement, plan in plans.items():
+        for table in scanned_tables(plan):
+            if table in _no_scan_tables:
+                failures.append("scanned every row of '{table}' in: "
+                                "{sql}".format(
+                                    table=table,
+                                    sql=' '.join(statement.split())
+                                ))
+    return most, plans, failures
+
+
+def run(recorder, path, checks, only=None, verbose=False):
+    """Run each of the named checks, printing its result, and return the
+    number of checks which failed."""
+    failed = 0
+    for name in sorted(checks):
+        if only is not None and not any(pattern in name
+                                        for pattern in only):
+            continue
+        budget, indexes, func = checks[name]
+        most, plans, failures = run_check(recorder, path, budget, indexes,
+                                          func)
+        print("{status:4} {name:36} {most:>3}/{budget} statements".format(
+            status='FAIL' if failures else 'ok', name=name, most=most,
+            budget=budget
+        ))
+        for failure in failures:
+            print("     {}".format(failure))
+        if failures or verbose:
+            for statement, plan in plans.items():
+                print("     SQL: {}".format(' '.join(statement.split())))
+                for step in plan or []:
+                    print("       {}".format(step))
+        if failures:
+            failed += 1
+    return failed
+
+
+def main():
+    """
+    Main command-line entry point for the query regression checks.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the number of statements and the query plans of "
+                    "the blog's database functions and routes."
+    )
+    parser.add_argument("-d", "--database",
+                        dest="database",
+                        help="Check a copy of this database instead of a "
+                             "synthetic one",
+                        default=None)
+    parser.add_argument("-k", "--only",
+                        dest="only",
+                        help="Only run checks whose names contain this text "
+                             "(may be repeated)",
+                        action="append",
+                        default=None)
+    parser.add_argument("-v", "--verbose",
+                        dest="verbose",
+                        help="Show the plan of every statement",
+                        default=False,
+                        action="store_true")
+    synthetic.add_arguments(parser)
+
+    args = parser.parse_args()
+    options = synthetic.generate_options(args)
+
+    workdir = tempfile.mkdtemp(prefix='cjblog-regression-')
+    try:
+        database = suite.prepare(workdir, args.database, options)
+        sample = suite.samples(database, random.Random(args.seed))
+        path = database.engine.url.database
+        recorder = statement_recorder(database.engine)
+
+        import cjblog.main
+        app = cjblog.main.app
+
+        # Render every page rather than serving it from the page cache
+        cjblog.main._cached_views = frozenset()
+        client = app.test_client()
+        failed = run(recorder, path,
+                     route_checks(client, suite.route_urls(sample),
+                                  _route_checks),
+                     args.only, args.verbose)
+
+        admin_client = app.test_client()
+        suite.log_in(admin_client, database)
+        failed += run(recorder, path,
+                      route_checks(admin_client, suite.admin_urls(sample),
+                                   _admin_checks),
+                      args.only, args.verbose)
+
+        checks = {name: (budget, indexes, in_context(app, func))
+                  for name, (budget, indexes, func)
+                  in database_checks(database, sample).items()}
+        failed += run(recorder, path, checks, args.only, args.verbose)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failed:
+        print("\n{} checks failed.".format(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
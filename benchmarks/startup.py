@@ -0,0 +1,191 @@
+"""cjblog :: startup benchmark
+
+Measures how quickly a new worker process becomes ready: the time taken
+to `import cjblog.main` and the latency of the first requests it serves,
+each in a fresh Python process against a seeded database. The modules
+which are only meant to be imported on first use are reported as well,
+so a change which imports one of them eagerly again is easy to spot.
+
+Run with `python -m benchmarks.startup --help` for options.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+import json
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import benchmarks.harness as harness
+import benchmarks.suite as suite
+import benchmarks.synthetic as synthetic
+import cjblog.util as util
+
+
+# Modules which a worker should not import until they are first needed
+_lazy_modules = ('bcrypt', 'dateutil', 'markdown', 'pygments',
+                 'cjblog.backup')
+
+# Run in each fresh process: points the blog at the prepared database,
+# times importing it and then each of the requested URLs, and prints the
+# results as JSON. Nothing is imported before the clock starts.
+_child_script = """
+import sys
+import time
+
+start = time.perf_counter()
+import cjblog.util as util
+util._data_dir = sys.argv[1]
+import cjblog.database as database
+database.engine = database.make_engine('sqlite:///' + sys.argv[2])
+import cjblog.main
+imported = time.perf_counter()
+
+lazy = sys.argv[3].split(',')
+loaded = [name for name in lazy if name in sys.modules]
+
+client = cjblog.main.app.test_client()
+requests = []
+for url in sys.argv[4:]:
+    before = time.perf_counter()
+    response = client.get(url)
+    response.get_data()
+    requests.append([url, response.status_code,
+                     time.perf_counter() - before])
+
+import json
+print(json.dumps({
+    'import': imported - start,
+    'requests': requests,
+    'loaded_on_import': loaded,
+    'loaded_after_requests': [name for name in lazy if name in sys.modules]
+}))
+"""
+
+
+def start_worker(data_dir, path, urls):
+    """Start a fresh Python process which imports the blog and requests
+    each of the `urls`, returning the results it reports."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output(
+        [sys.executable, '-c', _child_script, data_dir, path,
+         ','.join(_lazy_modules)] + list(urls),
+        cwd=root
+    )
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def first_request_urls(sample):
+    """Return the names and URLs requested by each new worker, in the order
+    they are requested."""
+    urls = [('home', '/'),
+            ('show_article', '/post/{}'.format(sample['articles'][0]))]
+    if sample['tags']:
+        urls.append(('articles_by_tag', '/tag/{}'.format(sample['tags'][0])))
+    urls.append(('login', '/login'))
+    return urls
+
+
+def run(data_dir, path, urls, runs):
+    """Start `runs` workers one after another, each with an empty page
+    cache, and return the benchmark results along with the lazy modules
+    each worker had imported."""
+    import cjblog.cache as cache
+
+    latencies = {'startup.import': []}
+    latencies.update(('startup.first.{}'.format(name), [])
+                     for name, _ in urls)
+    loaded = {'on_import': set(), 'after_requests': set()}
+
+    for _ in range(runs):
+        cache.invalidate()
+        result = start_worker(data_dir, path, [url for _, url in urls])
+        latencies['startup.import'].append(result['import'])
+        for (name, _), (url, status, elapsed) in zip(urls,
+                                                     result['requests']):
+            if status >= 400:
+                raise RuntimeError("'{url}' returned {status}.".format(
+                    url=url, status=status
+                ))
+            latencies['startup.first.{}'.format(name)].append(elapsed)
+        loaded['on_import'].update(result['loaded_on_import'])
+        loaded['after_requests'].update(result['loaded_after_requests'])
+
+    results = {name: harness.summarize(values)
+               for name, values in latencies.items()}
+    return results, loaded
+
+
+def main():
+    """
+    Main command-line entry point for the startup benchmark.
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure the time to import the blog and serve the "
+                    "first requests in a new worker process."
+    )
+    parser.add_argument("-d", "--database",
+                        dest="database",
+                        help="Benchmark a copy of this database instead of "
+                             "a synthetic one",
+                        default=None)
+    parser.add_argument("-n", "--runs",
+                        dest="runs",
+                        help="Number of worker processes started",
+                        type=int,
+                        default=10)
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="Write the results to this JSON file",
+                        default=None)
+    parser.add_argument("-b", "--baseline",
+                        dest="baseline",
+                        help="Compare against the results in this JSON file",
+                        default=None)
+    parser.add_argument("--threshold",
+                        dest="threshold",
+                        help="Percent slowdown in median latency reported "
+                             "as a regression",
+                        type=float,
+                        default=10.0)
+    synthetic.add_arguments(parser)
+
+    args = parser.parse_args()
+    options = synthetic.generate_options(args)
+    params = dict(options, database=args.database, runs=args.runs)
+
+    workdir = tempfile.mkdtemp(prefix='cjblog-startup-')
+    try:
+        database = suite.prepare(workdir, args.database, options)
+        sample = suite.samples(database, random.Random(args.seed))
+        database.engine.dispose()
+
+        results, loaded = run(util._data_dir, database.engine.url.database,
+                              first_request_urls(sample), args.runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if args.baseline is not None:
+        previous = harness.load_results(args.baseline)
+    regressions = harness.print_results(results, previous, args.threshold)
+
+    print()
+    print("Imported with cjblog.main: {}".format(
+        ', '.join(sorted(loaded['on_import'])) or 'none'))
+    print("Imported by the first requests: {}".format(
+        ', '.join(sorted(loaded['after_requests'] - loaded['on_import'])) or
+        'none'))
+
+    if args.output is not None:
+        harness.save_results(args.output, params, results)
+    if regressions:
+        print("\n{} benchmarks regressed by more than {}%.".format(
+            len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
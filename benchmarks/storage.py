@@ -0,0 +1,214 @@
+"""cjblog :: storage benchmark
+
+Measures read throughput and latency for each SQLite storage profile while
+a writer repeatedly saves articles, the way `database.save_article` does.
+
+Run with `python -m benchmarks.storage --help` for options.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import benchmarks.harness as harness
+import cjblog.util as util
+
+# Queries matching those run by the home page and article views
+_home_query = str(
+    "SELECT id, released, title_path, title, date, body, body_html, "
+    "title_link, title_alt FROM articles WHERE released = 1 "
+    "ORDER BY date DESC LIMIT 5"
+)
+_article_query = "SELECT * FROM articles WHERE title_path = ?"
+
+
+def create_database(path, num_articles):
+    """Create a database at `path` containing `num_articles` articles."""
+    conn = sqlite3.connect(path)
+    conn.executescript(harness.read_schema())
+    body = "Lorem ipsum dolor sit amet. " * 80
+    conn.executemany(
+        "INSERT INTO articles (released, title_path, title, date, body, "
+        "body_html) VALUES (1, ?, ?, ?, ?, ?)",
+        (("article-{}".format(i), "Article {}".format(i),
+          1400000000 + i * 3600, body, "<p>{}</p>".format(body))
+         for i in range(num_articles))
+    )
+    conn.commit()
+    conn.close()
+
+
+def connect(path, settings):
+    """Open a connection to `path` with the storage `settings` applied."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    for pragma in util.storage_pragmas(settings):
+        conn.execute(pragma)
+    return conn
+
+
+def reader(path, settings, num_articles, duration, results):
+    """Run the public read queries for `duration` seconds, reporting each
+    query's latency."""
+    conn = connect(path, settings)
+    latencies = []
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.execute(_home_query).fetchall()
+            title_path = "article-{}".format(random.randrange(num_articles))
+            conn.execute(_article_query, (title_path,)).fetchall()
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+    results.put(('reader', latencies, errors))
+
+
+def writer(path, settings, num_articles, duration, results):
+    """Save articles in a loop for `duration` seconds."""
+    conn = connect(path, settings)
+    writes = 0
+    errors = 0
+    body = "Edited text for the benchmark. " * 80
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        article_id = random.randrange(num_articles) + 1
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE articles SET body = ?, body_html = ? "
+                         "WHERE id = ?",
+                         (body, "<p>{}</p>".format(body), article_id))
+            conn.execute("DELETE FROM tag_map WHERE article_id = ?",
+                         (article_id,))
+            conn.execute("INSERT OR IGNORE INTO tags (tag) VALUES ('bench')")
+            conn.execute("INSERT INTO tag_map (tag_id, article_id) "
+                         "SELECT id, ? FROM tags WHERE tag = 'bench'",
+                         (article_id,))
+            conn.execute("COMMIT")
+            writes += 1
+        except sqlite3.OperationalError:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            errors += 1
+    conn.close()
+    results.put(('writer', writes, errors))
+
+
+def run_profile(template, workdir, profile, readers, num_articles, duration):
+    """Benchmark `profile` against a fresh copy of the `template` database
+    and return a dictionary of results."""
+    settings = util.storage_settings(profile=profile)
+    path = os.path.join(workdir, '{}.db'.format(profile))
+    shutil.copy(template, path)
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=reader,
+                                     args=(path, settings, num_articles,
+                                           duration, results))
+             for _ in range(readers)]
+    procs.append(multiprocessing.Process(target=writer,
+                                         args=(path, settings, num_articles,
+                                               duration, results)))
+    for proc in procs:
+        proc.start()
+
+    latencies = []
+    read_errors = writes = write_errors = 0
+    for _ in procs:
+        kind, value, errors = results.get()
+        if kind == 'reader':
+            latencies.extend(value)
+            read_errors += errors
+        else:
+            writes = value
+            write_errors = errors
+    for proc in procs:
+        proc.join()
+
+    latencies.sort()
+    return {
+        'profile': profile,
+        'settings': settings,
+        'reads_per_sec': len(latencies) / duration,
+        'read_p50_ms': harness.percentile(latencies, 50) * 1000,
+        'read_p99_ms': harness.percentile(latencies, 99) * 1000,
+        'read_max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'read_errors': read_errors,
+        'writes': writes,
+        'write_errors': write_errors
+    }
+
+
+def main():
+    """
+    Main command-line entry point for the storage benchmark.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark concurrent reads during writes for each "
+                    "SQLite storage profile."
+    )
+    parser.add_argument("-a", "--articles",
+                        dest="articles",
+                        help="Number of articles in the benchmark database",
+                        type=int,
+                        default=5000)
+    parser.add_argument("-r", "--readers",
+                        dest="readers",
+                        help="Number of concurrent reader processes",
+                        type=int,
+                        default=4)
+    parser.add_argument("-d", "--duration",
+                        dest="duration",
+                        help="Seconds to run each profile",
+                        type=float,
+                        default=10.0)
+    parser.add_argument("-p", "--profile",
+                        dest="profiles",
+                        help="Profile to benchmark (default: all)",
+                        action="append",
+                        choices=sorted(util.storage_profiles),
+                        default=None)
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="Write the results to this JSON file",
+                        default=None)
+
+    args = parser.parse_args()
+    profiles = args.profiles or sorted(util.storage_profiles)
+
+    workdir = tempfile.mkdtemp(prefix='cjblog-bench-')
+    try:
+        template = os.path.join(workdir, 'template.db')
+        create_database(template, args.articles)
+
+        results = []
+        print("{:<10} {:>10} {:>9} {:>9} {:>9} {:>7} {:>7}".format(
+            "profile", "reads/s", "p50 ms", "p99 ms", "max ms",
+            "busy", "writes"))
+        for profile in profiles:
+            result = run_profile(template, workdir, profile, args.readers,
+                                 args.articles, args.duration)
+            results.append(result)
+            print("{profile:<10} {reads_per_sec:>10.0f} {read_p50_ms:>9.2f} "
+                  "{read_p99_ms:>9.2f} {read_max_ms:>9.2f} "
+                  "{read_errors:>7d} {writes:>7d}".format(**result))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
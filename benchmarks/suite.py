@@ -0,0 +1,330 @@
+"""cjblog :: benchmark suite
+
+Measures the database functions, Markdown rendering and every route of
+the blog against a synthetic database (or a copy of a real one), and
+compares the results against those of an earlier run.
+
+Run with `python -m benchmarks.suite --help` for options. The blog must
+be configured (`cjblog/config.py` must exist) for the suite to run.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+
+import benchmarks.harness as harness
+import benchmarks.synthetic as synthetic
+import cjblog.util as util
+
+
+def prepare(workdir, database_file=None, options=None):
+    """
+    Prepare a database for the benchmarks in `workdir` and point the blog
+    at it, returning the database module.
+
+    The database is a copy of `database_file` if given, and otherwise a new
+    synthetic database generated with the `synthetic.generate` keyword
+    `options`. Files the blog shares between workers are kept in `workdir`
+    as well.
+    """
+    # The data directory must be set before any module which keeps files
+    # there is imported
+    util._data_dir = os.path.join(workdir, 'data')
+    os.makedirs(util._data_dir)
+
+    path = os.path.join(workdir, 'bench.db')
+    if database_file is not None:
+        shutil.copy(database_file, path)
+    else:
+        synthetic.generate(path, **(options or {}))
+
+    import cjblog.database as database
+    database.engine.dispose()
+    database.engine = database.make_engine('sqlite:///' + path)
+    database.upgrade_schema()
+    database.rebuild_tag_index()
+    database.rebuild_search_index()
+    return database
+
+
+def samples(database, rand, count=50):
+    """Return lists of existing article paths, page paths, tags, search
+    words and pagination cursors to use in benchmarks."""
+    articles = database.get_articles(page_size=None, with_body=False,
+                                     released=True)
+    pages = database.get_pages(released=True, render=False,
+                               with_body=False, only_links=False)
+    _, boundaries = database.get_page_boundaries(released=True)
+
+    def pick(values):
+        values = list(values)
+        return [rand.choice(values) for _ in range(count)] if values else []
+
+    return {
+        'articles': pick(a['title_path'] or a['id'] for a in articles),
+        'article_ids': pick(a['id'] for a in articles),
+        'pages': pick(p['title_path'] or p['id'] for p in pages),
+        'page_ids': pick(p['id'] for p in pages),
+        'tags': pick(database.get_all_tags(released=True)),
+        'words': pick(synthetic._words),
+        'cursors': pick(database.cursor_to_str(key)
+                        for key in boundaries[1:]),
+        'bodies': [database.get_article(article_id=article_id,
+                                        render=False)['body']
+                   for article_id in pick(a['id'] for a in articles)[:10]]
+    }
+
+
+def database_benchmarks(app, database, sample):
+    """Return a dictionary of named functions benchmarking the database
+    functions, each taking the iteration number. Each call runs in its own
+    application context, as it would during a request."""
+    def nth(name, i):
+        values = sample[name]
+        return values[i % len(values)]
+
+    def cursor(i):
+        return database.cursor_from_str(nth('cursors', i))
+
+    def uncached_mkdown(body):
+        import cjblog.highlight as highlight
+        highlight.clear()
+        util.mkdown(body)
+
+    benches = {
+        'db.get_articles': lambda i: database.get_articles(
+            released=True, with_links=True, tag_list=True),
+        'db.get_articles.deep': lambda i: database.get_articles(
+            released=True, with_links=True, tag_list=True,
+            before=cursor(i)),
+        'db.get_article': lambda i: database.get_article(
+            title_path=str(nth('articles', i)), released=True),
+        'db.get_num_articles': lambda i: database.get_num_articles(
+            released=True),
+        'db.get_num_articles.tag': lambda i: database.get_num_articles(
+            released=True, tag=nth('tags', i)),
+        'db.get_all_tags': lambda i: database.get_all_tags(released=True),
+        'db.search': lambda i: database.search(nth('words', i)),
+        'db.save_tags': lambda i: database.save_tags(
+            nth('article_ids', i), [nth('tags', i), nth('tags', i + 1)]),
+        'util.mkdown': lambda i: util.mkdown(nth('bodies', i)),
+        'util.mkdown.uncached': lambda i: uncached_mkdown(nth('bodies', i)),
+    }
+    if not sample['cursors']:
+        del benches['db.get_articles.deep']
+    if not sample['tags']:
+        del benches['db.get_num_articles.tag']
+        del benches['db.save_tags']
+
+    def in_context(func):
+        def call(i):
+            with app.app_context():
+                func(i)
+        return call
+
+    return {name: in_context(func) for name, func in benches.items()}
+
+
+def route_urls(sample):
+    """Return a dictionary mapping each public endpoint to a function which
+    returns a URL for the iteration number."""
+    def nth(name, i):
+        values = sample[name]
+        return values[i % len(values)]
+
+    urls = {
+        'home': lambda i: '/',
+        'home.page': lambda i: '/2',
+        'home_older': lambda i: '/older/{}'.format(nth('cursors', i)),
+        'show_article': lambda i: '/post/{}'.format(nth('articles', i)),
+        'show_page': lambda i: '/page/{}'.format(nth('pages', i)),
+        'articles_by_tag': lambda i: '/tag/{}'.format(nth('tags', i)),
+        'articles_by_tag_older': lambda i: '/tag/{}/older/{}'.format(
+            sample['tags'][0], nth('cursors', i)),
+        'article_list': lambda i: '/articles',
+        'search': lambda i: '/search?q={}'.format(nth('words', i)),
+        'feed': lambda i: '/feed.atom',
+        'feed.tag': lambda i: '/tag/{}/feed.atom'.format(nth('tags', i)),
+        'sitemap_xml': lambda i: '/sitemap.xml',
+        'login': lambda i: '/login',
+    }
+    if not sample['cursors']:
+        del urls['home_older']
+        del urls['articles_by_tag_older']
+    if not sample['pages']:
+        del urls['show_page']
+    return urls
+
+
+def admin_urls(sample):
+    """Return a dictionary mapping each administrator page to a function
+    which returns a URL for the iteration number."""
+    def nth(name, i):
+        values = sample[name]
+        return values[i % len(values)]
+
+    urls = {
+        'admin.home': lambda i: '/admin/',
+        'admin.edit_config': lambda i: '/admin/config',
+        'admin.create_article': lambda i: '/admin/article/create',
+        'admin.edit_article': lambda i: '/admin/article/edit/{}'.format(
+            nth('article_ids', i)),
+        'admin.create_page': lambda i: '/admin/page/create',
+    }
+    if sample['page_ids']:
+        urls['admin.edit_page'] = lambda i: '/admin/page/edit/{}'.format(
+            nth('page_ids', i))
+    return urls
+
+
+def route_benchmarks(client, urls, prefix):
+    """Return a dictionary of named functions requesting each of the
+    `urls` with the test `client`, failing on any error response."""
+    def bench(url_for):
+        def get(i):
+            url = url_for(i)
+            response = client.get(url)
+            response.get_data()
+            if response.status_code >= 400:
+                raise RuntimeError("'{url}' returned {status}.".format(
+                    url=url, status=response.status_code
+                ))
+        return get
+
+    return {'{}.{}'.format(prefix, name): bench(url_for)
+            for name, url_for in urls.items()}
+
+
+def log_in(client, database):
+    """Give the test `client` an administrator session."""
+    stmt = database.select([database.users.c.id]).where(
+        database.users.c.username == 'bench'
+    )
+    with database.transaction() as conn:
+        if conn.execute(stmt).fetchone() is None:
+            conn.execute(database.users.insert().values(username='bench',
+                                                        password=''))
+
+    key = os.urandom(32)
+    database.create_session('bench', key)
+    with client.session_transaction() as session:
+        session['username'] = 'bench'
+        session['key'] = key
+
+
+def run(benches, iterations, warmup, only=None):
+    """Run each of the named benchmarks and return their summaries."""
+    results = {}
+    for name in sorted(benches):
+        if only is not None and not any(pattern in name
+                                        for pattern in only):
+            continue
+        print("Running {}...".format(name), file=sys.stderr)
+        latencies = harness.time_calls(benches[name], iterations, warmup)
+        results[name] = harness.summarize(latencies)
+    return results
+
+
+def main():
+    """
+    Main command-line entry point for the benchmark suite.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the blog's database functions, Markdown "
+                    "rendering and routes."
+    )
+    parser.add_argument("-d", "--database",
+                        dest="database",
+                        help="Benchmark a copy of this database instead of "
+                             "a synthetic one",
+                        default=None)
+    parser.add_argument("-n", "--iterations",
+                        dest="iterations",
+                        help="Number of timed calls of each benchmark",
+                        type=int,
+                        default=200)
+    parser.add_argument("-w", "--warmup",
+                        dest="warmup",
+                        help="Number of untimed calls before timing",
+                        type=int,
+                        default=10)
+    parser.add_argument("-k", "--only",
+                        dest="only",
+                        help="Only run benchmarks whose names contain this "
+                             "text (may be repeated)",
+                        action="append",
+                        default=None)
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="Write the results to this JSON file",
+                        default=None)
+    parser.add_argument("-b", "--baseline",
+                        dest="baseline",
+                        help="Compare against the results in this JSON file",
+                        default=None)
+    parser.add_argument("--threshold",
+                        dest="threshold",
+                        help="Percent slowdown in median latency reported "
+                             "as a regression",
+                        type=float,
+                        default=10.0)
+    synthetic.add_arguments(parser)
+
+    args = parser.parse_args()
+    options = synthetic.generate_options(args)
+    params = dict(options, database=args.database,
+                  iterations=args.iterations, warmup=args.warmup)
+
+    workdir = tempfile.mkdtemp(prefix='cjblog-bench-')
+    try:
+        database = prepare(workdir, args.database, options)
+        sample = samples(database, random.Random(args.seed))
+
+        import cjblog.main
+        app = cjblog.main.app
+        cached_views = cjblog.main._cached_views
+        client = app.test_client()
+
+        benches = {}
+        benches.update(route_benchmarks(client, route_urls(sample),
+                                        'route.cached'))
+        results = run(benches, args.iterations, args.warmup, args.only)
+
+        # Without the page cache, every request renders the page
+        cjblog.main._cached_views = frozenset()
+        benches = route_benchmarks(client, route_urls(sample), 'route')
+        results.update(run(benches, args.iterations, args.warmup,
+                           args.only))
+        cjblog.main._cached_views = cached_views
+
+        admin_client = app.test_client()
+        log_in(admin_client, database)
+        benches = route_benchmarks(admin_client, admin_urls(sample), 'route')
+        results.update(run(benches, args.iterations, args.warmup,
+                           args.only))
+
+        # Run the database benchmarks last, since some of them write
+        benches = database_benchmarks(app, database, sample)
+        results.update(run(benches, args.iterations, args.warmup, args.only))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if args.baseline is not None:
+        previous = harness.load_results(args.baseline)
+    regressions = harness.print_results(results, previous, args.threshold)
+
+    if args.output is not None:
+        harness.save_results(args.output, params, results)
+    if regressions:
+        print("\n{} benchmarks regressed by more than {}%.".format(
+            len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
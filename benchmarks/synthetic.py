@@ -0,0 +1,248 @@
+"""cjblog :: synthetic data generator
+
+Creates a blog database of any size filled with synthetic articles, tags,
+pages and sessions, using the real schema script.
+
+Run with `python -m benchmarks.synthetic --help` for options.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import time
+
+import benchmarks.harness as harness
+import cjblog.util as util
+
+
+# Words used for titles, bodies and tags
+_words = str(
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua enim ad minim "
+    "veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat duis aute irure in reprehenderit voluptate velit "
+    "esse cillum fugiat nulla pariatur excepteur sint occaecat cupidatat "
+    "non proident sunt culpa qui officia deserunt mollit anim id est "
+    "python sqlite flask markdown pygments database query index cache "
+    "server request response template session article page tag archive"
+).split()
+
+# Code placed in the code blocks of article bodies
+_code = (
+    ":::python",
+    "def {name}(values):",
+    "    \"\"\"Return the total of the given values.\"\"\"",
+    "    total = 0",
+    "    for value in values:",
+    "        total += value * {num}",
+    "    return total",
+)
+
+# Articles are dated an hour apart, ending at this time
+_newest = 1450000000
+
+
+def sentence(rand, length):
+    """Return a sentence of `length` random words."""
+    words = [rand.choice(_words) for _ in range(length)]
+    return " ".join(words).capitalize() + "."
+
+
+def body_text(rand, length, code_density):
+    """Return a Markdown body of about `length` words, in which each
+    paragraph is a code block with probability `code_density`."""
+    paragraphs = []
+    remaining = length
+    while remaining > 0:
+        if rand.random() < code_density:
+            code = "\n".join("    " + line for line in _code)
+            paragraphs.append(code.format(name=rand.choice(_words),
+                                          num=rand.randrange(100)))
+            remaining -= 20
+        else:
+            size = min(remaining, rand.randrange(40, 120))
+            paragraphs.append(" ".join(sentence(rand, 10)
+                                       for _ in range(max(size // 10, 1))))
+            remaining -= size
+    return "\n\n".join(paragraphs)
+
+
+def generate(path, articles=1000, tags=200, tags_per_article=3,
+             body_length=500, code_density=0.1, pages=10, sessions=100,
+             seed=0, processes=None):
+    """
+    Create a blog database at `path` filled with synthetic data.
+
+    The database holds `articles` articles of about `body_length` words
+    each (a `code_density` fraction of paragraphs are code blocks), each
+    with up to `tags_per_article` of `tags` distinct tags, plus `pages`
+    pages and `sessions` sessions for a single user. Every body is rendered
+    in advance the same way the blog renders them when they are saved.
+
+    The tag and search indexes are left empty; build them with the
+    `database` rebuild functions once the blog is pointed at `path`.
+    """
+    rand = random.Random(seed)
+    if os.path.exists(path):
+        raise ValueError("File '{}' already exists.".format(path))
+
+    conn = sqlite3.connect(path)
+    conn.executescript(harness.read_schema())
+    version = util.render_version()
+
+    # Rendering Markdown dominates the time taken, so spread it over
+    # every CPU
+    pool = multiprocessing.Pool(processes)
+    try:
+        fill_database(conn, rand, pool, version, articles, tags,
+                      tags_per_article, body_length, code_density, pages,
+                      sessions)
+        conn.commit()
+    finally:
+        pool.close()
+        pool.join()
+        conn.close()
+
+
+def fill_database(conn, rand, pool, version, articles, tags,
+                  tags_per_article, body_length, code_density, pages,
+                  sessions):
+    """Insert the synthetic data described by `generate`, rendering
+    bodies in `pool`."""
+
+    # Tags are picked unevenly, so a few are far more popular than others
+    tag_names = ["{}-{}".format(rand.choice(_words), i) for i in range(tags)]
+    conn.executemany("INSERT INTO tags (id, tag) VALUES (?, ?)",
+                     enumerate(tag_names, start=1))
+
+    batch_size = 1000
+    for start in range(0, articles, batch_size):
+        ids = range(start + 1, min(start + batch_size, articles) + 1)
+        bodies = [body_text(rand, body_length, code_density) for _ in ids]
+        rendered = pool.map(util.mkdown, bodies, chunksize=32)
+
+        rows = []
+        tag_rows = set()
+        for article_id, body, body_html in zip(ids, bodies, rendered):
+            words = [rand.choice(_words) for _ in range(5)] + \
+                [str(article_id)]
+            rows.append((article_id,
+                         1 if rand.random() < 0.95 else 0,
+                         "-".join(words),
+                         " ".join(words).capitalize(),
+                         _newest - (articles - article_id) * 3600,
+                         body,
+                         body_html,
+                         version))
+            for _ in range(rand.randint(0, tags_per_article)):
+                tag_id = min(int(rand.paretovariate(0.5)), tags)
+                tag_rows.add((tag_id, article_id))
+
+        conn.executemany(
+            "INSERT INTO articles (id, released, title_path, title, date, "
+            "body, body_html, render_version) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.executemany(
+            "INSERT INTO tag_map (tag_id, article_id) VALUES (?, ?)",
+            sorted(tag_rows)
+        )
+
+    bodies = [body_text(rand, body_length, code_density)
+              for _ in range(pages)]
+    rendered = pool.map(util.mkdown, bodies)
+    conn.executemany(
+        "INSERT INTO pages (id, released, pg_order, title_path, title, "
+        "create_date, incl_link, body, body_html, render_version) "
+        "VALUES (?, 1, ?, ?, ?, ?, 1, ?, ?, ?)",
+        ((page_id, page_id, "page-{}".format(page_id),
+          "Page {}".format(page_id), _newest, body, body_html, version)
+         for page_id, body, body_html in zip(range(1, pages + 1),
+                                             bodies, rendered))
+    )
+
+    conn.execute("INSERT INTO users (id, username, password) "
+                 "VALUES (1, 'bench', '')")
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO sessions (key, user, change) VALUES (?, 1, ?)",
+        ((os.urandom(32), now - rand.randrange(3600))
+         for _ in range(sessions))
+    )
+
+
+def main():
+    """
+    Main command-line entry point for the synthetic data generator.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create a blog database filled with synthetic data."
+    )
+    parser.add_argument("output",
+                        help="Location of the new database")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.time()
+    generate(args.output, **generate_options(args))
+    print("Generated '{loc}' in {secs:.1f}s.".format(
+        loc=args.output, secs=time.time() - start
+    ))
+
+
+def add_arguments(parser):
+    """Add the options for the shape of the synthetic data to `parser`."""
+    parser.add_argument("-a", "--articles",
+                        dest="articles",
+                        help="Number of articles",
+                        type=int,
+                        default=1000)
+    parser.add_argument("-t", "--tags",
+                        dest="tags",
+                        help="Number of distinct tags",
+                        type=int,
+                        default=200)
+    parser.add_argument("--tags-per-article",
+                        dest="tags_per_article",
+                        help="Maximum number of tags on each article",
+                        type=int,
+                        default=3)
+    parser.add_argument("-l", "--body-length",
+                        dest="body_length",
+                        help="Approximate number of words in each body",
+                        type=int,
+                        default=500)
+    parser.add_argument("-c", "--code-density",
+                        dest="code_density",
+                        help="Fraction of paragraphs which are code blocks",
+                        type=float,
+                        default=0.1)
+    parser.add_argument("-p", "--pages",
+                        dest="pages",
+                        help="Number of pages",
+                        type=int,
+                        default=10)
+    parser.add_argument("-s", "--sessions",
+                        dest="sessions",
+                        help="Number of sessions",
+                        type=int,
+                        default=100)
+    parser.add_argument("--seed",
+                        dest="seed",
+                        help="Random seed, so runs can be repeated",
+                        type=int,
+                        default=0)
+
+
+def generate_options(args):
+    """Return the `generate` keyword arguments from parsed arguments."""
+    return {name: getattr(args, name)
+            for name in ('articles', 'tags', 'tags_per_article',
+                         'body_length', 'code_density', 'pages',
+                         'sessions', 'seed')}
+
+
+if __name__ == "__main__":
+    main()
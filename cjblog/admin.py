@@ -5,9 +5,10 @@ Renders most of the pages of the admin site.
 Author: Christopher Rink (chrisrink10 at gmail dot com)"""
 import datetime
 import functools
-import importlib
+import json
 
 from flask import (Blueprint,
+                   Response,
                    current_app,
                    render_template,
                    session,
@@ -15,8 +16,10 @@ from flask import (Blueprint,
                    redirect,
                    url_for,
                    request)
-import cjblog.config as config
 import cjblog.database as database
+import cjblog.jobs as jobs
+import cjblog.preview as preview
+import cjblog.settings as settings
 import cjblog.util as util
 
 
@@ -62,7 +65,8 @@ def home():
                                                             released=False),
                            adm_page_list=database.get_pages(with_body=False,
                                                             released=None,
-                                                            only_links=False))
+                                                            only_links=False),
+                           job_status=database.get_job_status())
 
 
 @admin.route('/config', methods=['GET'])
@@ -70,9 +74,9 @@ def home():
 def edit_config():
     return render_template("config.html",
                            admin=True,
-                           page_size=config.PAGE_SIZE,
-                           session_expire=config.SESSION_EXPIRE,
-                           session_prune_age=config.SESSION_PRUNE_AGE,
+                           page_size=settings.get('page_size'),
+                           session_expire=settings.get('session_expire'),
+                           session_prune_age=settings.get('session_prune_age'),
                            page_list=database.get_pages(with_body=False,
                                                         released=None))
 
@@ -97,26 +101,21 @@ def save_config():
                 data['page_size'] < 1):
             raise ValueError
 
-        database.save_config(data)
+        with jobs.regenerating():
+            database.save_config(data)
     except TypeError:
         error = str("Page size, session expire and session prune age must be "
                     "integer values.")
     except ValueError:
         error = str("Page size, session expire, and session prune age must be "
                     "integer values greater than or equal to 1.")
-    except util.CompileError:
-        error = str("There was an error compiling the configuration options you"
-                    " selected. Please try again.")
-    else:
-        # If no exception occurred, reload the configuration file
-        importlib.reload(config)
 
     return render_template("config.html",
                            admin=True,
                            error=error,
-                           page_size=config.PAGE_SIZE,
-                           session_expire=config.SESSION_EXPIRE,
-                           session_prune_age=config.SESSION_PRUNE_AGE,
+                           page_size=settings.get('page_size'),
+                           session_expire=settings.get('session_expire'),
+                           session_prune_age=settings.get('session_prune_age'),
                            page_list=database.get_pages(with_body=False,
                                                         released=None))
 
@@ -138,21 +137,26 @@ def create_article():
 def save_new_article():
     """Save a new article and then redirect to the edit page for that
     new article."""
-    new_id = database.create_article(request.form['title'],
-                                     request.form['title_link'],
-                                     request.form['title_alt'],
-                                     request.form['date'],
-                                     request.form['body'],
-                                     1 if 'released' in request.form else 0,
-                                     request.form['tags'])
-    return redirect(url_for("admin.edit_article", article_id=new_id))
+    with jobs.regenerating() as changed:
+        changed['article_id'] = database.create_article(
+            request.form['title'],
+            request.form['title_link'],
+            request.form['title_alt'],
+            request.form['date'],
+            request.form['body'],
+            1 if 'released' in request.form else 0,
+            request.form['tags']
+        )
+    return redirect(url_for("admin.edit_article",
+                            article_id=changed['article_id']))
 
 
 @admin.route('/article/delete/<int:article_id>')
 @login_required
 def delete_article(article_id):
     """Delete an article and then redirect home."""
-    database.delete_article(article_id)
+    with jobs.regenerating(article_id=article_id):
+        database.delete_article(article_id)
     return redirect(url_for('admin.home'))
 
 
@@ -173,14 +177,15 @@ def edit_article(article_id):
 @login_required
 def save_article(article_id):
     """Save changes to an article."""
-    database.save_article(article_id,
-                          request.form['title'],
-                          request.form['title_link'],
-                          request.form['title_alt'],
-                          request.form['date'],
-                          request.form['body'],
-                          1 if 'released' in request.form else 0,
-                          request.form['tags'])
+    with jobs.regenerating(article_id=article_id):
+        database.save_article(article_id,
+                              request.form['title'],
+                              request.form['title_link'],
+                              request.form['title_alt'],
+                              request.form['date'],
+                              request.form['body'],
+                              1 if 'released' in request.form else 0,
+                              request.form['tags'])
     return redirect(url_for("admin.edit_article", article_id=article_id))
 
 
@@ -200,19 +205,23 @@ def create_page():
 @login_required
 def save_new_page():
     """Save a new page and then redirect to the edit page for that new page."""
-    new_id = database.create_page(1 if 'released' in request.form else 0,
-                                  request.form['pg_order'],
-                                  request.form['title'],
-                                  1 if 'incl_link' in request.form else 0,
-                                  request.form['body'])
-    return redirect(url_for("admin.edit_page", page_id=new_id))
+    with jobs.regenerating() as changed:
+        changed['page_id'] = database.create_page(
+            1 if 'released' in request.form else 0,
+            request.form['pg_order'],
+            request.form['title'],
+            1 if 'incl_link' in request.form else 0,
+            request.form['body']
+        )
+    return redirect(url_for("admin.edit_page", page_id=changed['page_id']))
 
 
 @admin.route('/page/delete/<int:page_id>')
 @login_required
 def delete_page(page_id):
     """Delete a page and then redirect home."""
-    database.delete_page(page_id)
+    with jobs.regenerating(page_id=page_id):
+        database.delete_page(page_id)
     return redirect(url_for('admin.home'))
 
 
@@ -233,15 +242,37 @@ def edit_page(page_id):
 @login_required
 def save_page(page_id):
     """Save changes to a page."""
-    database.save_page(page_id,
-                       1 if 'released' in request.form else 0,
-                       request.form['pg_order'],
-                       request.form['title'],
-                       1 if 'incl_link' in request.form else 0,
-                       request.form['body'])
+    with jobs.regenerating(page_id=page_id):
+        database.save_page(page_id,
+                           1 if 'released' in request.form else 0,
+                           request.form['pg_order'],
+                           request.form['title'],
+                           1 if 'incl_link' in request.form else 0,
+                           request.form['body'])
     return redirect(url_for("admin.edit_page", page_id=page_id))
 
 
+@admin.route('/export/<fmt>')
+@login_required
+def export(fmt):
+    """Download a backup of the whole blog, streamed from a snapshot of
+    the database."""
+    # Rarely used, so only imported when needed
+    import cjblog.backup as backup
+
+    if fmt not in backup.formats:
+        abort(404)
+    headers = {
+        'Content-Disposition': 'attachment; filename="{}"'.format(
+            backup.export_name(fmt)
+        ),
+        'Cache-Control': 'no-store'
+    }
+    return Response(backup.iter_export(fmt),
+                    mimetype=backup.formats[fmt],
+                    headers=headers)
+
+
 @admin.route('/tomarkdown', methods=['POST'])
 @login_required
 def to_markdown():
@@ -250,6 +281,27 @@ def to_markdown():
     return util.mkdown(body)
 
 
+@admin.route('/preview', methods=['POST'])
+@login_required
+def preview_blocks():
+    """Given a Markdown body and the hashes of the blocks the editor
+    already has, return the hash of every block in order and the HTML of
+    the blocks the editor does not have."""
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('body'), str):
+        abort(400)
+    known = data.get('known')
+    if not isinstance(known, list):
+        known = []
+
+    order, rendered = preview.render_blocks(
+        data['body'], (key for key in known if isinstance(key, str))
+    )
+    return Response(json.dumps({'blocks': order, 'html': rendered}),
+                    mimetype='application/json',
+                    headers={'Cache-Control': 'no-store'})
+
+
 @admin.route('/now')
 def current_date():
     """Returns a properly formatted date for now."""
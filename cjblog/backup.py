@@ -0,0 +1,297 @@
+"""cjblog :: backup module
+
+Takes consistent snapshots of the live database and exports the whole
+blog (articles with their tags, pages and configuration) as JSON Lines or
+as a tarball of Markdown files with front matter. The import module reads
+either export back.
+
+Snapshots are taken with SQLite's backup API a few pages at a time, so
+writers are never blocked for long. Exports are read from a snapshot, so
+they are consistent even while the blog is being edited, and written out
+as rows are read, so memory use does not depend on the size of the blog.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import io
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import time
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, select
+
+import cjblog.database as database
+import cjblog.util as util
+
+
+# Snapshots taken for exports are kept here until the export finishes
+_snapshot_dir = util.data_path('backups')
+
+# Number of database pages copied in each step of a snapshot, and the
+# time given to writers between steps
+_backup_pages = 256
+_backup_sleep = 0.005
+
+# Version of the export format
+_format_version = 1
+
+# Export formats and their content types
+formats = {
+    'jsonl': 'application/x-ndjson',
+    'tar': 'application/gzip'
+}
+
+
+def snapshot(dest, source=None):
+    """
+    Copy the database at `source` (by default, the blog's database) to a
+    new file `dest`, as a consistent snapshot taken while the blog runs.
+
+    The SQLite backup API is used where Python provides it; otherwise the
+    snapshot is written with `VACUUM INTO`, which needs SQLite 3.27.
+    """
+    source = source or database.engine.url.database
+    if os.path.exists(dest):
+        raise ValueError("File '{}' already exists.".format(dest))
+
+    src = sqlite3.connect('file:{}?mode=ro'.format(quote(source)), uri=True)
+    try:
+        if hasattr(src, 'backup'):
+            dst = sqlite3.connect(dest)
+            try:
+                src.backup(dst, pages=_backup_pages, sleep=_backup_sleep)
+            finally:
+                dst.close()
+        else:
+            src.execute("VACUUM INTO ?", (dest,))
+    finally:
+        src.close()
+
+
+@contextmanager
+def snapshot_connection():
+    """Yield a connection to a temporary snapshot of the database, which
+    is removed when the block exits."""
+    os.makedirs(_snapshot_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=_snapshot_dir, suffix='.db')
+    os.close(fd)
+    os.remove(path)
+
+    engine = None
+    try:
+        snapshot(path)
+        engine = create_engine('sqlite:///' + path)
+        with engine.connect() as conn:
+            yield conn.execution_options(stream_results=True)
+    finally:
+        if engine is not None:
+            engine.dispose()
+        for name in (path, path + '-wal', path + '-shm', path + '-journal'):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def iso_date(timestamp):
+    """Return the ISO 8601 form of a UNIX timestamp, or None."""
+    if timestamp is None or timestamp == '':
+        return None
+    return datetime.fromtimestamp(float(timestamp), timezone.utc).isoformat()
+
+
+def iter_records(conn):
+    """
+    Yield every record of an export read with the connection `conn`: a
+    header, the configuration and then each article and page, oldest
+    first. Records use the same fields as the front matter understood by
+    the import module, plus the `body`.
+    """
+    version = conn.execute(select([database.content_version.c.version]))
+    yield {
+        'type': 'export',
+        'format': _format_version,
+        'created': iso_date(time.time()),
+        'content_version': version.scalar()
+    }
+
+    values = {}
+    for row in conn.execute(select([database.configuration.c.key_name,
+                                    database.configuration.c.value,
+                                    database.configuration.c.default])):
+        value = row['value']
+        values[row['key_name']] = value if value is not None \
+            else row['default']
+    yield {'type': 'config', 'values': values}
+
+    articles = database.articles
+    for row in conn.execute(select([articles]).order_by(articles.c.id)):
+        yield {
+            'type': 'article',
+            'id': row['id'],
+            'title': row['title'],
+            'slug': row['title_path'],
+            'date': iso_date(row['date']),
+            'released': bool(row['released']),
+            'tags': list(database.tags_as_list(row['tag_list'] or '')),
+            'link': row['title_link'],
+            'link_text': row['title_alt'],
+            'body': row['body'] or ''
+        }
+
+    pages = database.pages
+    for row in conn.execute(select([pages]).order_by(pages.c.id)):
+        yield {
+            'type': 'page',
+            'id': row['id'],
+            'title': row['title'],
+            'slug': row['title_path'],
+            'date': iso_date(row['create_date']),
+            'edited': iso_date(row['edit_date']),
+            'released': bool(row['released']),
+            'order': row['pg_order'],
+            'in_menu': bool(row['incl_link']),
+            'body': row['body'] or ''
+        }
+
+
+def iter_jsonl(conn):
+    """Yield the JSON Lines export read with `conn`, a line at a time."""
+    for record in iter_records(conn):
+        yield (json.dumps(record, sort_keys=True) + '\n').encode('utf8')
+
+
+def markdown_file(record):
+    """Return the Markdown file, with front matter, for an article or
+    page record. Every value is written in JSON form, which YAML reads
+    as well as the import module's own front matter parser."""
+    lines = ['---']
+    for key in sorted(record):
+        if key != 'body' and record[key] is not None:
+            lines.append('{}: {}'.format(key, json.dumps(record[key])))
+    lines.extend(['---', '', record['body']])
+    return '\n'.join(lines).encode('utf8')
+
+
+def record_file(record):
+    """Return the name of the file for an export record in a tarball, or
+    None if it is not written to one."""
+    if record['type'] == 'config':
+        return 'config.json'
+    if record['type'] not in ('article', 'page'):
+        return None
+    slug = database.url_safe_string(record['slug'] or '')
+    return '{kind}s/{id}{sep}{slug}.md'.format(
+        kind=record['type'], id=record['id'], sep='-' if slug else '',
+        slug=slug
+    )
+
+
+def iter_tarball(conn):
+    """Yield the gzipped tarball export read with `conn`, a file at a
+    time."""
+    buf = io.BytesIO()
+
+    def drain():
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return data
+
+    now = time.time()
+    tar = tarfile.open(fileobj=buf, mode='w|gz')
+    try:
+        for record in iter_records(conn):
+            name = record_file(record)
+            if name is None:
+                continue
+            if record['type'] == 'config':
+                data = json.dumps(record['values'], indent=2,
+                                  sort_keys=True).encode('utf8')
+            else:
+                data = markdown_file(record)
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = now
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+            chunk = drain()
+            if chunk:
+                yield chunk
+    finally:
+        tar.close()
+    yield drain()
+
+
+def iter_export(fmt):
+    """Yield the export of the blog in the format `fmt` ('jsonl' or
+    'tar'), read from a snapshot taken when iteration starts."""
+    if fmt not in formats:
+        raise ValueError("Unknown export format '{}'.".format(fmt))
+    with snapshot_connection() as conn:
+        chunks = iter_jsonl(conn) if fmt == 'jsonl' else iter_tarball(conn)
+        for chunk in chunks:
+            yield chunk
+
+
+def export_name(fmt):
+    """Return the file name offered for an export in the format `fmt`."""
+    return 'blog-{}.{}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                               'jsonl' if fmt == 'jsonl' else 'tar.gz')
+
+
+def main():
+    """
+    Main command-line entry point for backing up the blog.
+    """
+    parser = argparse.ArgumentParser(
+        description="Snapshot the database or export the blog."
+    )
+    parser.add_argument("-s", "--snapshot",
+                        dest="snapshot",
+                        help="Write a snapshot of the database to this file",
+                        required=False,
+                        default=None)
+    parser.add_argument("-f", "--format",
+                        dest="format",
+                        help="Export format (default: jsonl)",
+                        required=False,
+                        choices=sorted(formats),
+                        default='jsonl')
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="Write the export to this file (default: "
+                             "standard output)",
+                        required=False,
+                        default=None)
+
+    args = parser.parse_args()
+
+    try:
+        if args.snapshot is not None:
+            snapshot(args.snapshot)
+            return
+
+        if args.output is None:
+            out = sys.stdout.buffer
+            for chunk in iter_export(args.format):
+                out.write(chunk)
+            out.flush()
+            return
+
+        with open(args.output, 'xb') as out:
+            for chunk in iter_export(args.format):
+                out.write(chunk)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("\nError: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""cjblog :: cache module
+
+Stores fully rendered public pages on disk so every worker process can
+serve them without touching the database.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import cjblog.util as util
+
+
+# Cached pages are stored in one directory per generation; invalidating
+# the cache simply advances the generation
+_cache_dir = util.data_path('cache')
+_stamp_name = 'cache'
+
+# Upper bound for the size of the current generation; the least recently
+# used pages are evicted once a worker has stored `_evict_interval` more
+# pages and finds it exceeded
+_max_bytes = 64 * 1024 * 1024
+_evict_interval = 100
+_stored = [0]
+
+
+def generation():
+    """Return the current cache generation."""
+    return util.read_stamp(_stamp_name)
+
+
+def get(key, gen):
+    """Return a (body, headers) tuple for the page cached under `key`
+    in generation `gen` or None if it is not cached."""
+    path = _entry_path(key, gen)
+    try:
+        with open(path, 'rb') as f:
+            headers = json.loads(f.readline().decode('utf8'))
+            body = f.read()
+        # Mark the entry as recently used for eviction purposes
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return body, headers
+
+
+def put(key, body, headers, gen):
+    """Cache the page `body` and its `headers` under `key` in generation
+    `gen`. Nothing is stored if the cache was invalidated since `gen`."""
+    if gen != generation():
+        return
+
+    gendir = os.path.join(_cache_dir, str(gen))
+    try:
+        os.makedirs(gendir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=gendir, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(headers).encode('utf8'))
+            f.write(b'\n')
+            f.write(body)
+        os.replace(tmp, _entry_path(key, gen))
+    except OSError:
+        return
+    _count_store(gendir)
+
+
+def put_stream(key, chunks, headers, gen, charset='utf-8'):
+    """
+    Yield each chunk of a streamed page from `chunks` while caching it
+    under `key` in generation `gen`.
+
+    Chunks are written to disk as they pass through rather than collected
+    in memory, and the page is only cached if the stream is consumed to
+    the end.
+    """
+    gendir = os.path.join(_cache_dir, str(gen))
+    try:
+        os.makedirs(gendir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=gendir, prefix='.')
+        out = os.fdopen(fd, 'wb')
+        out.write(json.dumps(headers).encode('utf8'))
+        out.write(b'\n')
+    except OSError:
+        yield from chunks
+        return
+
+    complete = False
+    stored = False
+    try:
+        for chunk in chunks:
+            if out is not None:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+                try:
+                    out.write(chunk)
+                except OSError:
+                    out.close()
+                    out = None
+            yield chunk
+        complete = True
+    finally:
+        if out is not None:
+            out.close()
+            if complete and gen == generation():
+                try:
+                    os.replace(tmp, _entry_path(key, gen))
+                    stored = True
+                except OSError:
+                    pass
+        if not stored:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    if stored:
+        _count_store(gendir)
+
+
+def invalidate():
+    """Discard every cached page in all worker processes."""
+    gen = util.bump_stamp(_stamp_name)
+
+    # Remove the old generations; any worker still reading from them
+    # will simply treat the page as a cache miss
+    try:
+        gendirs = os.listdir(_cache_dir)
+    except OSError:
+        return
+    for gendir in gendirs:
+        if gendir != str(gen):
+            shutil.rmtree(os.path.join(_cache_dir, gendir),
+                          ignore_errors=True)
+
+
+def _entry_path(key, gen):
+    """Return the location of the file caching `key` in generation `gen`."""
+    name = hashlib.sha1(key.encode('utf8')).hexdigest()
+    return os.path.join(_cache_dir, str(gen), name)
+
+
+def _count_store(gendir):
+    """Count a page stored in `gendir`, evicting old pages from it every
+    `_evict_interval` pages so storing a page rarely scans the cache."""
+    _stored[0] += 1
+    if _stored[0] % _evict_interval == 0:
+        _evict(gendir)
+
+
+def _evict(gendir):
+    """Remove the least recently used pages in `gendir` until it is back
+    under the size limit."""
+    entries = []
+    total = 0
+    try:
+        scanned = list(os.scandir(gendir))
+    except OSError:
+        return
+    for entry in scanned:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    if total <= _max_bytes:
+        return
+
+    # Evict down to 90% of the limit so we don't evict on every store
+    for _, size, path in sorted(entries):
+        if total <= _max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
@@ -3,14 +3,19 @@
 Performs all of the database manipulation for the site.
 
 Author: Christopher Rink (chrisrink10 at gmail dot com)"""
-from datetime import date
-from math import ceil
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import date, datetime
+from math import ceil, isfinite
 import re
+import sys
+import threading
+import time
 
-import bcrypt
-from flask import current_app
-from dateutil import parser
+from flask import current_app, g, has_app_context
 from sqlalchemy import (create_engine,
+                        event,
                         Table,
                         Column,
                         Integer,
@@ -19,16 +24,85 @@ from sqlalchemy import (create_engine,
                         MetaData,
                         ForeignKey,
                         select,
+                        exists,
                         func,
                         bindparam,
-                        null)
+                        null,
+                        text)
+from sqlalchemy.pool import QueuePool
 
 import cjblog.config as config
+import cjblog.settings as settings
 import cjblog.util as util
 
 
+# Location of the blog database
+_db_uri = 'sqlite:////data/database.db'
+
+# Connections kept open by each worker process and the number of extra
+# connections which may be opened under load
+_pool_size = 5
+_pool_overflow = 10
+
+# Connection shared by a unit of work outside of a Flask app context
+_local = threading.local()
+
+# Sessions checked recently by this worker, along with their activity
+# times which have not yet been written to the database; sessions are
+# checked against the database again after `_session_ttl` seconds and
+# each session's activity is written at most once per write interval
+_session_cache = {}
+_session_pending = {}
+_session_lock = threading.Lock()
+_session_ttl = 10
+_session_write_interval = 60
+
+# Stamp bumped whenever a session is destroyed, so every worker drops its
+# cached sessions at once
+_session_stamp_name = 'sessions'
+_session_stamp = None
+
+# Page boundaries for each paginated list of articles, cached along with
+# the content version they were computed for
+_boundary_cache = {}
+_boundary_cache_size = 256
+
+# Default `page_size` of the article functions, standing for the page size
+# in the current settings, which may change while the blog is running
+_configured_page_size = object()
+
+# Finished jobs are kept for this many seconds, so the administration
+# panel can report recent failures
+_job_prune_age = 7 * 24 * 60 * 60
+
+
+def make_engine(uri, storage=None):
+    """Create an engine with an explicitly sized connection pool for the
+    SQLite database at `uri`. The `storage` settings (by default, those
+    in the configuration) are applied to every new connection."""
+    if storage is None:
+        storage = util.storage_settings(config)
+    pragmas = util.storage_pragmas(storage)
+
+    new_engine = create_engine(uri,
+                               echo=config.DEBUG,
+                               poolclass=QueuePool,
+                               pool_size=_pool_size,
+                               max_overflow=_pool_overflow,
+                               connect_args={'check_same_thread': False})
+
+    @event.listens_for(new_engine, 'connect')
+    def apply_storage_settings(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return new_engine
+
+
 # Configure SQLAlchemy
-engine = create_engine('sqlite:////data/database.db', echo=config.DEBUG)
+engine = make_engine(_db_uri)
 metadata = MetaData()
 
 # Table configuration
@@ -46,11 +120,15 @@ articles = Table('articles', metadata,
                  Column('title_link', String),
                  Column('title_alt', String),
                  Column('date', Integer),
-                 Column('body', String)
+                 Column('body', String),
+                 Column('body_html', String),
+                 Column('render_version', String),
+                 Column('tag_list', String)
 )
 Index('released', articles.c.released)
 Index('title_path', articles.c.title_path)
 Index('article_date', articles.c.date)
+Index('article_released_date', articles.c.released, articles.c.date)
 
 pages = Table('pages', metadata,
               Column('id', Integer, primary_key=True),
@@ -61,7 +139,9 @@ pages = Table('pages', metadata,
               Column('create_date', Integer),
               Column('edit_date', Integer),
               Column('incl_link', Integer),
-              Column('body', String)
+              Column('body', String),
+              Column('body_html', String),
+              Column('render_version', String)
 )
 Index('page_released', pages.c.released)
 Index('page_link', pages.c.incl_link)
@@ -77,6 +157,16 @@ tag_map = Table('tag_map', metadata,
                 Column('tag_id', Integer, ForeignKey('tags.id')),
                 Column('article_id', Integer, ForeignKey('articles.id'))
 )
+Index('tag_map_tag', tag_map.c.tag_id, tag_map.c.article_id)
+Index('tag_map_article', tag_map.c.article_id)
+
+tag_counts = Table('tag_counts', metadata,
+                   Column('tag_id', Integer, primary_key=True),
+                   Column('tag', String),
+                   Column('released', Integer)
+)
+Index('tag_count_tag', tag_counts.c.tag)
+Index('tag_count_released', tag_counts.c.released)
 
 sessions = Table('sessions', metadata,
                  Column('key', String, primary_key=True),
@@ -99,6 +189,196 @@ configuration = Table('configuration', metadata,
                       Column('default', String))
 Index('config_key', configuration.c.key_name)
 
+content_version = Table('content_version', metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('version', Integer),
+                        Column('changed', Integer))
+
+# Full-text index of released articles and pages; articles are stored
+# under their own ID and pages under their negated ID
+search_index = Table('search_index', metadata,
+                     Column('rowid', Integer, primary_key=True),
+                     Column('title', String),
+                     Column('body', String))
+
+# Background jobs regenerating whatever a save affected; at most one job
+# with each kind and target is queued at a time, which the schema enforces
+# with a partial unique index on queued jobs (`job_queued`)
+jobs = Table('jobs', metadata,
+             Column('id', Integer, primary_key=True),
+             Column('kind', String),
+             Column('target', String),
+             Column('state', String),
+             Column('created', Integer),
+             Column('started', Integer),
+             Column('finished', Integer),
+             Column('error', String))
+Index('job_state', jobs.c.state, jobs.c.id)
+
+# Columns added to existing tables since the original schema was released;
+# `upgrade_schema` will add any of these which are missing
+_added_columns = (
+    ('articles', 'body_html', 'TEXT'),
+    ('articles', 'render_version', 'TEXT'),
+    ('pages', 'body_html', 'TEXT'),
+    ('pages', 'render_version', 'TEXT'),
+    ('articles', 'tag_list', 'TEXT'),
+)
+
+# Tables added since the original schema was released; `upgrade_schema`
+# runs each of these statements, so they must be safe to repeat
+_added_tables = (
+    """CREATE TABLE IF NOT EXISTS content_version (
+        id       INTEGER PRIMARY KEY,
+        version  INTEGER,
+        changed  INTEGER
+    )""",
+    """INSERT OR IGNORE INTO content_version (id, version, changed)
+        VALUES (1, 0, strftime('%s', 'now'))""",
+    """CREATE TABLE IF NOT EXISTS tag_counts (
+        tag_id    INTEGER PRIMARY KEY,
+        tag       TEXT,
+        released  INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS tag_count_tag ON tag_counts (tag)",
+    "CREATE INDEX IF NOT EXISTS tag_count_released ON tag_counts (released)",
+    "CREATE INDEX IF NOT EXISTS tag_map_tag ON tag_map (tag_id, article_id)",
+    "CREATE INDEX IF NOT EXISTS tag_map_article ON tag_map (article_id)",
+    """CREATE INDEX IF NOT EXISTS article_released_date
+        ON articles (released, date)""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        title,
+        body,
+        tokenize = 'porter unicode61',
+        prefix = '2 3'
+    )""",
+    """INSERT INTO search_index (search_index, rank)
+        VALUES ('rank', 'bm25(10.0, 1.0)')""",
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id        INTEGER PRIMARY KEY,
+        kind      TEXT,
+        target    TEXT,
+        state     TEXT,
+        created   INTEGER,
+        started   INTEGER,
+        finished  INTEGER,
+        error     TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS job_state ON jobs (state, id)",
+    """CREATE UNIQUE INDEX IF NOT EXISTS job_queued ON jobs (kind, target)
+        WHERE state = 'queued'""",
+)
+
+# Markers placed around matching terms in search results; they cannot
+# appear in indexed text, so they are safe to replace after escaping
+search_mark_start = '\x02'
+search_mark_end = '\x03'
+
+# Matching search results; the best matches are found in the index first
+# and only that page of results is highlighted and joined with the
+# articles and pages
+_search_sql = """
+    SELECT
+        search_index.rowid AS rowid,
+        highlight(search_index, 0, :mark_start, :mark_end) AS title,
+        snippet(search_index, 1, :mark_start, :mark_end,
+                :ellipsis, :snippet_size) AS snippet,
+        articles.title_path AS article_path,
+        articles.date AS article_date,
+        pages.title_path AS page_path
+    FROM search_index
+    LEFT JOIN articles ON articles.id = search_index.rowid
+    LEFT JOIN pages ON pages.id = -search_index.rowid
+    WHERE search_index MATCH :query AND search_index.rowid IN (
+        SELECT rowid FROM search_index
+        WHERE search_index MATCH :query
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+    )
+    ORDER BY {order}
+"""
+
+# Ranking has to score every match, so queries matching more than
+# `_search_rank_limit` entries list the newest matches first instead
+_search_rank_limit = 2000
+_search_ranked_stmt = text(_search_sql.format(order='rank'))
+_search_recent_stmt = text(_search_sql.format(order='search_index.rowid DESC'))
+
+_search_count_stmt = text("""
+    SELECT count(*) FROM search_index WHERE search_index MATCH :query
+""")
+
+
+############################
+# CONNECTION FUNCTIONS
+############################
+
+
+@contextmanager
+def connection():
+    """
+    Yield the connection for the current unit of work.
+
+    Within a Flask app context, every call shares one connection which is
+    returned to the pool by `close_connection` when the context tears
+    down. Elsewhere, the outermost call opens a connection which nested
+    calls share and closes it when it exits.
+    """
+    if has_app_context():
+        if getattr(g, 'db_conn', None) is None:
+            g.db_conn = engine.connect()
+        yield g.db_conn
+        return
+
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = _local.conn = engine.connect()
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        conn.close()
+
+
+@contextmanager
+def transaction():
+    """Yield a connection with an open transaction which is committed when
+    the block exits (or rolled back on an exception). Nested calls join
+    the outermost transaction."""
+    with connection() as conn:
+        if conn.in_transaction():
+            yield conn
+            return
+        with conn.begin():
+            yield conn
+
+
+def close_connection(exc=None):
+    """Return the current app context's connection to the pool."""
+    conn = getattr(g, 'db_conn', None)
+    if conn is not None:
+        g.db_conn = None
+        conn.close()
+
+
+############################
+# UTILITY FUNCTIONS
+############################
+
+
+def query_source():
+    """Return the name of the innermost function of this module on the
+    stack, which is the function running the current query."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename == __file__:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'other'
+
 
 def date_to_str(timestamp):
     """Return a date string in a consistent format from a UNIX timestamp."""
@@ -109,12 +389,32 @@ def date_to_str(timestamp):
     return dt_str.format(d=dt) or ""
 
 
+def time_to_str(timestamp):
+    """Return a date and time string in a consistent format from a UNIX
+    timestamp."""
+    if timestamp is None:
+        return ""
+    dt = datetime.fromtimestamp(int(timestamp))
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
 def safe_date(article_date):
     """Return a UNIX timestamp for the given date string."""
+    # Only imported when saving, so workers start faster
+    from dateutil import parser
+
     timestamp = parser.parse(article_date).timestamp()
     return timestamp
 
 
+def page_size_or_setting(page_size):
+    """Return `page_size`, or the page size in the current settings if
+    it was not given."""
+    if page_size is _configured_page_size:
+        return settings.get('page_size')
+    return page_size
+
+
 def url_safe_string(string):
     """Returns a URL safe string."""
     whitespace = re.compile('[\s]+', flags=re.ASCII)
@@ -124,6 +424,28 @@ def url_safe_string(string):
     return safe_str
 
 
+def cursor_to_str(key):
+    """Return the URL form of the (date, id) pagination cursor `key`."""
+    article_date, article_id = key
+    if article_date == int(article_date):
+        article_date = int(article_date)
+    return "{}_{}".format(article_date, article_id)
+
+
+def cursor_from_str(string):
+    """Return the (date, id) pagination cursor from its URL form, raising
+    a ValueError if the string is not a valid cursor."""
+    article_date, sep, article_id = string.rpartition("_")
+    if not sep:
+        raise ValueError("Invalid cursor '{}'.".format(string))
+    article_date = float(article_date)
+    if not isfinite(article_date):
+        raise ValueError("Invalid cursor '{}'.".format(string))
+    if article_date == int(article_date):
+        article_date = int(article_date)
+    return article_date, int(article_id)
+
+
 def tags_as_list(tag_names):
     """Accept a string of tags delimited by a comma and return a list."""
     if not isinstance(tag_names, str):
@@ -140,19 +462,38 @@ def get_render_func(render=True):
         return lambda val: val
 
 
+def get_body_func(row, render=True):
+    """Return a function which produces the body for the given row,
+    preferring the pre-rendered HTML stored alongside it if available."""
+    if render and 'body_html' in row.keys() and row['body_html'] is not None:
+        return lambda val: row['body_html']
+    return get_render_func(render)
+
+
+def rendered_body(body):
+    """Return the columns storing the rendered HTML for the given body."""
+    return {
+        'body_html': util.mkdown(body or ''),
+        'render_version': util.render_version()
+    }
+
+
 def check_login(username, password):
     """Check a username and password combination."""
+    # Only imported when logging in, so workers start faster
+    import bcrypt
+
     stmt = select([users.c.password]).where(users.c.username == username)
-    conn = engine.connect()
-    result = conn.execute(stmt)
-    row = result.fetchone()
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
 
-    if row is not None:
-        if bcrypt.hashpw(bytes(password, encoding='utf8'),
-                         bytes(row[0], encoding='utf8')) == row[0]:
-            result = True
+    if row is None:
+        return False
 
-    return result
+    hashed = row[0]
+    if not isinstance(hashed, bytes):
+        hashed = bytes(hashed, encoding='utf8')
+    return bcrypt.hashpw(bytes(password, encoding='utf8'), hashed) == hashed
 
 
 ############################
@@ -161,32 +502,78 @@ def check_login(username, password):
 
 
 def check_session(username, key):
-    """Check a username and key session data combination."""
+    """
+    Check a username and key session data combination, returning a
+    tuple of whether the session is valid and whether it is current.
+
+    Sessions are cached in each worker for a few seconds and the time of
+    their last use is written back to the database at most once every
+    `_session_write_interval` seconds, so browsing with a session does not
+    cost a database write per request. Destroyed sessions are revoked in
+    every worker immediately.
+    """
+    now = int(time.time())
+    entry = _cached_session(key, now)
+    if entry is None or username != entry['username']:
+        return False, False
+
+    # The stored time may trail another worker's view of the session by
+    # up to one write interval, so allow for that before expiring it
+    last_change = entry['change']
+    if not entry['seen']:
+        last_change += _session_write_interval
+    if now - last_change > settings.get('session_expire'):
+        destroy_session(username, key)
+        return True, False
+
+    update_session(username, key, now)
+    return True, True
+
+
+def _cached_session(key, now):
+    """Return the cached entry for the session `key`, reading it from the
+    database if it is missing, stale, or sessions have been revoked since
+    it was cached. Returns None if there is no such session."""
+    global _session_stamp
+    stamp = util.read_stamp(_session_stamp_name)
+    with _session_lock:
+        if stamp != _session_stamp:
+            _session_cache.clear()
+            _session_stamp = stamp
+        entry = _session_cache.get(key)
+        if entry is not None and now - entry['cached'] < _session_ttl:
+            return entry
+
     stmt = select([
         users.c.username,
-        func.sum(
-            func.strftime('%s', 'now') - sessions.c.change
-        ).label("last_check")
+        sessions.c.change
     ]).select_from(
         sessions.join(users, users.c.id == sessions.c.user)
     ).where(
         sessions.c.key == key
     )
 
-    conn = engine.connect()
-    result = conn.execute(stmt)
-    row = result.fetchone()
-    conn.close()
-
-    if row is None or username != row['username']:
-        return False, False
-
-    if row['last_check'] > config.SESSION_EXPIRE:
-        destroy_session(username, key)
-        return True, False
-
-    update_session(username, key)
-    return True, True
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
+
+    with _session_lock:
+        if row is None:
+            _session_cache.pop(key, None)
+            _session_pending.pop(key, None)
+            return None
+
+        # Keep any activity this worker has not written back yet
+        seen = _session_pending.get(key)
+        change = row['change'] or 0
+        entry = {
+            'username': row['username'],
+            'change': max(change, seen or 0),
+            'written': change,
+            'seen': seen is not None and seen >= change,
+            'cached': now
+        }
+        _session_cache[key] = entry
+        return entry
 
 
 def create_session(username, key):
@@ -196,13 +583,12 @@ def create_session(username, key):
         user=select([users.c.id]).where(users.c.username == username),
         change=func.strftime('%s', 'now')
     )
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    with connection() as conn:
+        conn.execute(stmt)
 
 
 def destroy_session(username, key):
-    """Destroy the given session."""
+    """Destroy the given session and revoke it in every worker."""
     seluser = select([users.c.id]).where(
         users.c.username == username
     )
@@ -211,23 +597,101 @@ def destroy_session(username, key):
     ).where(
         sessions.c.user == seluser
     )
-    conn = engine.connect()
+    with connection() as conn:
+        conn.execute(stmt)
+
+    with _session_lock:
+        _session_cache.pop(key, None)
+        _session_pending.pop(key, None)
+    util.bump_stamp(_session_stamp_name)
+
+
+def update_session(username, key, now=None):
+    """Record that the session was used at `now` (by default, the current
+    time). The change is written to the database along with any other
+    pending session activity once the stored time is more than
+    `_session_write_interval` seconds old."""
+    if now is None:
+        now = int(time.time())
+
+    with _session_lock:
+        _session_pending[key] = now
+        entry = _session_cache.get(key)
+        if entry is not None:
+            entry['change'] = now
+            entry['seen'] = True
+            if now - entry['written'] < _session_write_interval:
+                return
+
+    flush_sessions()
+
+
+def flush_sessions():
+    """Write every pending session activity time to the database in a
+    single transaction."""
+    with _session_lock:
+        pending = [{'session_key': key, 'change': change}
+                   for key, change in _session_pending.items()]
+        _session_pending.clear()
+        for row in pending:
+            entry = _session_cache.get(row['session_key'])
+            if entry is not None:
+                entry['written'] = row['change']
+
+    if len(pending) == 0:
+        return
+
+    stmt = sessions.update().where(
+        sessions.c.key == bindparam('session_key')
+    ).values(
+        change=bindparam('change')
+    )
+    with transaction() as conn:
+        conn.execute(stmt, pending)
+
+
+# Don't lose session activity which was never written back
+atexit.register(flush_sessions)
+
+
+############################
+# CONTENT VERSION FUNCTIONS
+############################
+
+
+def bump_content_version(conn):
+    """Record that public content has changed using the connection `conn`
+    of the write which changed it."""
+    stmt = content_version.update().where(
+        content_version.c.id == 1
+    ).values(
+        version=content_version.c.version + 1,
+        changed=func.strftime('%s', 'now')
+    )
     conn.execute(stmt)
-    conn.close()
 
+    if has_app_context():
+        g.content_version = None
 
-def update_session(username, key):
-    """Update a user's last session check time in the database."""
-    seluser = select([users.c.id]).where(
-        users.c.username == username
+
+def get_content_version():
+    """Return the current content version and the UNIX timestamp at which
+    it last changed. The version is read at most once per request."""
+    if has_app_context() and getattr(g, 'content_version', None) is not None:
+        return g.content_version
+
+    stmt = select([content_version.c.version,
+                   content_version.c.changed]).where(
+        content_version.c.id == 1
     )
-    stmt = sessions.update().values(
-        change=func.strftime('%s', 'now')
-    ).where(sessions.c.key == key).where(sessions.c.user == seluser)
 
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
+
+    version = (0, None) if row is None else (row['version'], row['changed'])
+    if has_app_context():
+        g.content_version = version
+    return version
 
 
 ############################
@@ -246,7 +710,7 @@ def article_from_row(row, render=True):
         'title_alt': '',
         'date': date_to_str,
         'tag_list': tags_as_list,
-        'body': get_render_func(render)
+        'body': get_body_func(row, render)
     }
 
     for key, val in article.copy().items():
@@ -256,6 +720,10 @@ def article_from_row(row, render=True):
         else:
             article[key] = ''
 
+    # Keep the raw timestamp for anything which needs the date in another
+    # format, such as feeds
+    article['timestamp'] = row['date'] if 'date' in row.keys() else None
+
     return article
 
 
@@ -266,26 +734,36 @@ def create_article(title, title_link, title_alt, article_date,
         'released': released,
         'title_path': url_safe_string(title),
         'title': title,
-        'link': title_link,
-        'alt': title_alt,
+        'title_link': title_link,
+        'title_alt': title_alt,
         'date': safe_date(article_date),
         'body': body
     }
+    args.update(rendered_body(body))
 
-    conn = engine.connect()
     stmt = articles.insert()
-    result = conn.execute(stmt, args)
-    save_tags(result, tag_list)
+    with transaction() as conn:
+        result = conn.execute(stmt, args)
+        article_id = result.inserted_primary_key[0]
+        index_content(conn, article_id, args)
+        bump_content_version(conn)
+        save_tags(article_id, tag_list)
 
-    return result.inserted_primary_key[0]
+    return article_id
 
 
 def delete_article(article_id):
     """Delete an article by it's ID."""
     stmt = articles.delete().where(articles.c.id == article_id)
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    with transaction() as conn:
+        tag_ids = article_tag_ids(conn, article_id)
+        conn.execute(
+            tag_map.delete().where(tag_map.c.article_id == article_id)
+        )
+        conn.execute(stmt)
+        refresh_tag_counts(conn, tag_ids)
+        unindex_content(conn, article_id)
+        bump_content_version(conn)
 
 
 def get_article(article_id=None, title_path=None, render=True, released=None):
@@ -299,41 +777,102 @@ def get_article(article_id=None, title_path=None, render=True, released=None):
     else:
         where_cond = (articles.c.title_path == title_path)
 
-    # Generate the SQL syntax with SQLAlchemy
-    stmt = select(
-        [articles,
-         func.ifnull(func.group_concat(tags.c.tag, ", "), "").label('tag_list')]
-    ).select_from(
-        articles.outerjoin(
-            tag_map,
-            articles.c.id == tag_map.c.article_id
-        ).outerjoin(
-            tags,
-            tag_map.c.tag_id == tags.c.id
-        )
-    ).where(
+    # Generate the SQL syntax with SQLAlchemy; tags are read from the
+    # article's own denormalized tag list
+    stmt = select([articles]).where(
         where_cond
     ).where(
         articles.c.released == released if released is not None else ""
-    ).group_by(
-        tag_map.c.article_id
     )
 
     # Get our results
-    conn = engine.connect()
-    result = conn.execute(stmt)
-    row = result.fetchone()
-    article = article_from_row(row, render=render) if row is not None else None
-    conn.close()
-    return article
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
+    return article_from_row(row, render=render) if row is not None else None
+
+
+def get_articles(start=None, page_size=_configured_page_size,
+                 with_body=True, with_links=False, released=False,
+                 render=True, tag=None, tag_list=False, before=None,
+                 after=None):
+    """Return a list of articles.
+
+    Articles are returned newest first, a page at a time; by default the
+    page size is taken from the settings, and a `page_size` of None
+    returns every article. Give a (date, id) cursor as `before` to return
+    the articles following it, or as `after` to return the articles
+    preceding it; either is far cheaper than `start` on deep pages."""
+    page_size = page_size_or_setting(page_size)
+    by_tag = True if isinstance(tag, str) else False
+    cols = article_columns(with_body, with_links, render, tag_list)
+
+    # Build the statement
+    stmt = select(cols, offset=start, limit=page_size).where(
+        articles.c.released == released if released is not None else ""
+    )
 
+    # Seek directly to the cursor using the date index; articles preceding
+    # a cursor are selected in reverse and then flipped back below
+    if before is not None:
+        stmt = stmt.where(
+            articles.c.date <= before[0]
+        ).where(
+            (articles.c.date < before[0]) | (articles.c.id < before[1])
+        )
+    if after is not None:
+        stmt = stmt.where(
+            articles.c.date >= after[0]
+        ).where(
+            (articles.c.date > after[0]) | (articles.c.id > after[1])
+        ).order_by(
+            articles.c.date.asc(),
+            articles.c.id.asc()
+        )
+    else:
+        stmt = stmt.order_by(
+            articles.c.date.desc(),
+            articles.c.id.desc()
+        )
 
-def get_articles(start=None, page_size=config.PAGE_SIZE, with_body=True,
-                 with_links=False, released=False, render=True,
-                 tag=None, tag_list=False):
-    """Return a list of articles."""
-    by_tag = True if isinstance(tag, str) else False
-    # Generate the correct list of columns
+    # Limit articles by tag
+    if by_tag:
+        stmt = stmt.where(articles.c.id.in_(tagged_article_ids(tag)))
+
+    # Execute the statement
+    article_list = []
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            article = article_from_row(row, render=render)
+            article_list.append(article)
+
+    if after is not None:
+        article_list.reverse()
+    return article_list
+
+
+def iter_articles(with_body=False, with_links=False, released=False,
+                  render=True, tag_list=False):
+    """Yield every article, newest first.
+
+    Unlike `get_articles`, rows are streamed from the database as they
+    are yielded, so memory use does not grow with the number of
+    articles."""
+    cols = article_columns(with_body, with_links, render, tag_list)
+    stmt = select(cols).where(
+        articles.c.released == released if released is not None else ""
+    ).order_by(
+        articles.c.date.desc(),
+        articles.c.id.desc()
+    )
+
+    with connection() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for row in conn.execute(stmt):
+            yield article_from_row(row, render=render)
+
+
+def article_columns(with_body, with_links, render, tag_list):
+    """Return the list of article columns to select."""
     cols = [articles.c.id,
             articles.c.released,
             articles.c.title_path,
@@ -342,90 +881,130 @@ def get_articles(start=None, page_size=config.PAGE_SIZE, with_body=True,
 
     if with_body:
         cols.append(articles.c.body)
+        if render:
+            cols.append(articles.c.body_html)
     if with_links:
         cols.append(articles.c.title_link)
         cols.append(articles.c.title_alt)
     if tag_list:
-        cols.append(
-            func.ifnull(
-                func.group_concat(tags.c.tag, ", "),
-                ""
-            ).label('tag_list')
-        )
+        cols.append(articles.c.tag_list)
+    return cols
 
-    # Build the statement
-    stmt = select(cols, offset=start, limit=page_size).where(
-        articles.c.released == released if released is not None else ""
-    ).order_by(
-        articles.c.date.desc()
-    )
-
-    # Join the tag map and tag table if either:
-    # - we want to return tags
-    # - we are returning all articles with a certain tag
-    if by_tag or tag_list:
-        stmt = stmt.select_from(
-            articles.outerjoin(
-                tag_map,
-                articles.c.id == tag_map.c.article_id
-            ).outerjoin(
-                tags,
-                tag_map.c.tag_id == tags.c.id
-            )
-        ).group_by(articles.c.id)
 
-    # Limit articles by tag
-    if by_tag:
-        stmt = stmt.where(
-            articles.c.id.in_(
-                select([tag_map.c.article_id]).select_from(
-                    tag_map.outerjoin(
-                        tags,
-                        tag_map.c.tag_id == tags.c.id
-                    )
-                ).where(
-                    tags.c.tag == tag
-                )
-            )
+def tagged_article_ids(tag):
+    """Return a statement selecting the IDs of articles with `tag`."""
+    return select([tag_map.c.article_id]).select_from(
+        tag_map.join(
+            tags,
+            tag_map.c.tag_id == tags.c.id
         )
+    ).where(
+        tags.c.tag == tag
+    )
 
-    # Execute the statement
-    article_list = []
-    conn = engine.connect()
-    for row in conn.execute(stmt):
-        article = article_from_row(row, render=render)
-        article_list.append(article)
 
-    conn.close()
-    return article_list
+def get_page_boundaries(page_size=_configured_page_size, released=True,
+                        tag=None):
+    """
+    Return the number of articles and a list of the (date, id) cursor
+    preceding each page of articles, so that page `n` holds the articles
+    `before` the `n - 1`th cursor. The first page has no cursor (None).
+
+    Boundaries are computed by walking the date index once and cached
+    until the content version changes, so any page can be found without
+    counting or skipping over the articles before it.
+    """
+    cached = _cached_boundaries(page_size_or_setting(page_size), released,
+                                tag)
+    return cached['num_articles'], cached['boundaries']
+
+
+def locate_cursor(cursor, page_size=_configured_page_size, released=True,
+                  tag=None):
+    """
+    Return the number of page boundaries newer than the (date, id)
+    `cursor` and whether the cursor is itself a page boundary.
+
+    If it is, the articles `before` the cursor are exactly page
+    `count + 2`; otherwise they overlap pages `count + 1` and `count + 2`.
+    """
+    cached = _cached_boundaries(page_size_or_setting(page_size), released,
+                                tag)
+    count = bisect_left(cached['keys'], (-cursor[0], -cursor[1]))
+    boundaries = cached['boundaries']
+    exact = count + 1 < len(boundaries) and \
+        tuple(boundaries[count + 1]) == tuple(cursor)
+    return count, exact
+
+
+def _cached_boundaries(page_size, released, tag):
+    """Return the cached page boundaries for the given list of articles,
+    computing them if the content has changed since they were cached."""
+    version, _ = get_content_version()
+    cache_key = (page_size, released, tag)
+    cached = _boundary_cache.get(cache_key)
+    if cached is not None and cached['version'] == version:
+        return cached
+
+    stmt = select([articles.c.date, articles.c.id]).where(
+        articles.c.released == released if released is not None else ""
+    ).order_by(
+        articles.c.date.desc(),
+        articles.c.id.desc()
+    )
+    if isinstance(tag, str):
+        stmt = stmt.where(articles.c.id.in_(tagged_article_ids(tag)))
+
+    num_articles = 0
+    boundaries = [None]
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            num_articles += 1
+            if num_articles % page_size == 0:
+                boundaries.append((row['date'], row['id']))
+
+    # Drop the trailing boundary if the final page is exactly full
+    if num_articles > 0 and num_articles % page_size == 0:
+        boundaries.pop()
+
+    # Keep the boundaries in ascending order as well so cursors can be
+    # located by bisection
+    cached = {
+        'version': version,
+        'num_articles': num_articles,
+        'boundaries': boundaries,
+        'keys': [(-key[0], -key[1]) for key in boundaries[1:]]
+    }
+    if len(_boundary_cache) >= _boundary_cache_size:
+        _boundary_cache.clear()
+    _boundary_cache[cache_key] = cached
+    return cached
 
 
-def get_num_articles(page_size=config.PAGE_SIZE, released=True, tag=None):
+def get_num_articles(page_size=_configured_page_size, released=True,
+                     tag=None):
     """Return the number of articles and the number of pages using the
     given page size (rounding up)."""
+    page_size = page_size_or_setting(page_size)
     stmt = select([func.count(articles.c.id).label("num_articles")]).where(
         articles.c.released == released if released is not None else ""
     )
 
-    # Check against a given tag
-    if tag is not None:
-        stmt = stmt.select_from(
-            articles.outerjoin(
-                tag_map,
-                articles.c.id == tag_map.c.article_id
-            ).outerjoin(
-                tags,
-                tag_map.c.tag_id == tags.c.id
+    # Released articles with a given tag are counted in the tag index
+    if tag is not None and released is True:
+        stmt = select([
+            func.ifnull(func.max(tag_counts.c.released), 0).label(
+                "num_articles"
             )
-        ).where(
-            tags.c.tag == tag
+        ]).where(
+            tag_counts.c.tag == tag
         )
+    elif tag is not None:
+        stmt = stmt.where(articles.c.id.in_(tagged_article_ids(tag)))
 
     # Get the connection
-    conn = engine.connect()
-    result = conn.execute(stmt)
-    row = result.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
 
     pagination = (row['num_articles'],
                   ceil(int(row['num_articles']) / page_size))
@@ -446,11 +1025,14 @@ def save_article(article_id, title, title_link, title_alt,
         'body': body,
         'released': released
     }
+    args.update(rendered_body(body))
 
     stmt = articles.update().where(articles.c.id == article_id)
-    conn = engine.connect()
-    conn.execute(stmt, args)
-    save_tags(article_id, tag_list)
+    with transaction() as conn:
+        conn.execute(stmt, args)
+        index_content(conn, article_id, args)
+        bump_content_version(conn)
+        save_tags(article_id, tag_list)
 
 
 ############################
@@ -469,7 +1051,7 @@ def page_from_row(row, render=True):
         'create_date': date_to_str,
         'edit_date': date_to_str,
         'incl_link': '',
-        'body': get_render_func(render)
+        'body': get_body_func(row, render)
     }
 
     for key, val in page.copy().items():
@@ -484,27 +1066,36 @@ def page_from_row(row, render=True):
 
 def create_page(released, pg_order, title, incl_link, body):
     """Save a new page to the database."""
+    args = {
+        'released': released,
+        'pg_order': pg_order,
+        'title_path': url_safe_string(title),
+        'title': title,
+        'incl_link': incl_link,
+        'body': body
+    }
+    args.update(rendered_body(body))
+
     stmt = pages.insert().values(
-        released=released,
-        pg_order=pg_order,
-        title_path=url_safe_string(title),
-        title=title,
         create_date=func.strftime("%s", "now"),
-        incl_link=incl_link,
-        body=body
+        **args
     )
-    conn = engine.connect()
-    result = conn.execute(stmt)
+    with transaction() as conn:
+        result = conn.execute(stmt)
+        page_id = result.inserted_primary_key[0]
+        index_content(conn, -page_id, args)
+        bump_content_version(conn)
 
-    return result.inserted_primary_key[0]
+    return page_id
 
 
 def delete_page(page_id):
     """Delete a page by its ID."""
     stmt = pages.delete().where(pages.c.id == page_id)
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    with transaction() as conn:
+        conn.execute(stmt)
+        unindex_content(conn, -page_id)
+        bump_content_version(conn)
 
 
 def get_page(page_id=None, title_path=None, render=True, released=None):
@@ -526,12 +1117,9 @@ def get_page(page_id=None, title_path=None, render=True, released=None):
     )
 
     # Get our results
-    conn = engine.connect()
-    result = conn.execute(stmt)
-    row = result.fetchone()
-    page = page_from_row(row, render=render) if row is not None else None
-    conn.close()
-    return page
+    with connection() as conn:
+        row = conn.execute(stmt).fetchone()
+    return page_from_row(row, render=render) if row is not None else None
 
 
 def get_pages(released=None, render=True, with_body=True, only_links=True):
@@ -551,6 +1139,8 @@ def get_pages(released=None, render=True, with_body=True, only_links=True):
     # Include the body
     if with_body:
         cols.append(pages.c.body)
+        if render:
+            cols.append(pages.c.body_html)
 
     # Generate the SQL syntax with SQLAlchemy
     stmt = select(cols).order_by(
@@ -570,27 +1160,33 @@ def get_pages(released=None, render=True, with_body=True, only_links=True):
         )
 
     # Get our results
-    conn = engine.connect()
-    for row in conn.execute(stmt):
-        page = page_from_row(row, render=render)
-        page_list.append(page)
-    conn.close()
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            page = page_from_row(row, render=render)
+            page_list.append(page)
     return page_list
 
 
 def save_page(page_id, released, pg_order, title, incl_link, body):
     """Updates an existing page."""
+    args = {
+        'released': released,
+        'pg_order': pg_order,
+        'title_path': url_safe_string(title),
+        'title': title,
+        'incl_link': incl_link,
+        'body': body
+    }
+    args.update(rendered_body(body))
+
     stmt = pages.update().values(
-        released=released,
-        pg_order=pg_order,
-        title_path=url_safe_string(title),
-        title=title,
         edit_date=func.strftime('%s', 'now'),
-        incl_link=incl_link,
-        body=body
+        **args
     ).where(pages.c.id == page_id)
-    conn = engine.connect()
-    conn.execute(stmt)
+    with transaction() as conn:
+        conn.execute(stmt)
+        index_content(conn, -page_id, args)
+        bump_content_version(conn)
 
 
 ############################
@@ -612,31 +1208,100 @@ def save_tags(article_id, tag_names=None):
             return
     current_app.logger.debug("Tags given: {}".format(tag_names))
 
-    conn = engine.connect()
+    with transaction() as conn:
+        # Remove all current tags for the given article
+        old_ids = article_tag_ids(conn, article_id)
+        delstmt = tag_map.delete().where(tag_map.c.article_id == article_id)
+        conn.execute(delstmt)
+        bump_content_version(conn)
+
+        # Insert any new tags which didn't exist before and attach them to
+        # the article using the map table (unless we just wanted to delete
+        # the current tag associations)
+        if tag_names is not None and len(tag_names) > 0:
+            insstmt = tags.insert().prefix_with("OR IGNORE")
+            conn.execute(insstmt, [{'tag': tag} for tag in tag_names])
+
+            selstmt = select([tags.c.id]).where(
+                tags.c.tag == bindparam("tag_name")
+            )
+            mapstmt = tag_map.insert({'tag_id': selstmt})
+            conn.execute(mapstmt,
+                         [{'tag_name': tag,
+                           'article_id': article_id} for tag in tag_names])
+
+        # Keep the tag index in sync for both the old and new tags
+        new_ids = article_tag_ids(conn, article_id)
+        refresh_tag_counts(conn, set(old_ids) | set(new_ids))
+        refresh_article_tags(conn, article_id)
+
+
+def article_tag_ids(conn, article_id):
+    """Return the IDs of the tags attached to the given article."""
+    stmt = select([tag_map.c.tag_id]).where(
+        tag_map.c.article_id == article_id
+    )
+    return [row['tag_id'] for row in conn.execute(stmt)]
+
+
+def refresh_tag_counts(conn, tag_ids=None):
+    """Recompute the number of released articles for each of the given
+    tags (or every tag) in the tag index."""
+    if tag_ids is not None:
+        tag_ids = list(tag_ids)
+        if len(tag_ids) == 0:
+            return
+
+    selstmt = select([tags.c.id, tags.c.tag, released_tag_count()])
+
+    delstmt = tag_counts.delete()
+    if tag_ids is not None:
+        selstmt = selstmt.where(tags.c.id.in_(tag_ids))
+        delstmt = delstmt.where(tag_counts.c.tag_id.in_(tag_ids))
 
-    # Remove all current tags for the given article
-    delstmt = tag_map.delete().where(tag_map.c.article_id == article_id)
     conn.execute(delstmt)
+    conn.execute(tag_counts.insert().from_select(
+        ['tag_id', 'tag', 'released'], selstmt
+    ))
 
-    # If tags is None, we just wanted to delete current tag associations
-    if tag_names is None or len(tag_names) == 0:
-        conn.close()
-        return
 
-    # Insert any new tags which didn't exist before
-    insstmt = tags.insert().prefix_with("OR IGNORE")
-    conn.execute(insstmt, [{'tag': tag} for tag in tag_names])
+def released_tag_count():
+    """Return a scalar subquery counting the released articles with the
+    tag in the enclosing query."""
+    return select([func.count(tag_map.c.article_id)]).select_from(
+        tag_map.join(articles, articles.c.id == tag_map.c.article_id)
+    ).where(
+        tag_map.c.tag_id == tags.c.id
+    ).where(
+        articles.c.released == 1
+    ).as_scalar()
+
+
+def article_tag_names():
+    """Return a scalar expression listing the tags of the article in the
+    enclosing query."""
+    tag_names = select([func.group_concat(tags.c.tag, ", ")]).select_from(
+        tag_map.join(tags, tag_map.c.tag_id == tags.c.id)
+    ).where(
+        tag_map.c.article_id == articles.c.id
+    ).as_scalar()
+    return func.ifnull(tag_names, "")
 
-    # Now attach the tags to the articles using the map table
-    selstmt = select([tags.c.id]).where(tags.c.tag == bindparam("tag_name"))
-    mapstmt = tag_map.insert({'tag_id': selstmt})
-    conn.execute(mapstmt,
-                 [{'tag_name': tag,
-                   'article_id': article_id} for tag in tag_names])
+
+def refresh_article_tags(conn, article_id=None):
+    """Recompute the denormalized tag list of the given article (or every
+    article)."""
+    stmt = articles.update().values(tag_list=article_tag_names())
+    if article_id is not None:
+        stmt = stmt.where(articles.c.id == article_id)
+    conn.execute(stmt)
 
 
 def get_all_tags(released=True):
     """Return a list of all tags ordered by popularity."""
+    if released is True:
+        return get_indexed_tags()
+
     stmt = select([tags.c.tag]).select_from(
         tags.outerjoin(
             tag_map, tags.c.id == tag_map.c.tag_id
@@ -651,19 +1316,350 @@ def get_all_tags(released=True):
         func.count(tags.c.id).desc()
     )
 
-    conn = engine.connect()
     tag_list = []
-    for row in conn.execute(stmt):
-        tag_list.append(row['tag'])
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            tag_list.append(row['tag'])
 
-    conn.close()
     return tag_list
 
 
+############################
+# SITEMAP FUNCTIONS
+############################
+
+def iter_sitemap_entries():
+    """
+    Yield a (path, timestamp) tuple for every public URL on the site, with
+    the time its content last changed (or None if it is unknown).
+
+    Rows are streamed from the database as they are yielded rather than
+    collected into lists, so memory use does not grow with the archive.
+    """
+    latest = select([func.max(articles.c.date)]).where(
+        articles.c.released == 1
+    )
+    article_stmt = select([
+        articles.c.id, articles.c.title_path, articles.c.date
+    ]).where(
+        articles.c.released == 1
+    )
+    page_stmt = select([
+        pages.c.id,
+        pages.c.title_path,
+        func.ifnull(pages.c.edit_date, pages.c.create_date).label('changed')
+    ]).where(
+        pages.c.released == 1
+    )
+    tag_stmt = select([
+        tag_counts.c.tag, func.max(articles.c.date).label('changed')
+    ]).select_from(
+        tag_counts.join(
+            tag_map, tag_map.c.tag_id == tag_counts.c.tag_id
+        ).join(
+            articles, articles.c.id == tag_map.c.article_id
+        )
+    ).where(
+        tag_counts.c.released > 0
+    ).where(
+        articles.c.released == 1
+    ).group_by(
+        tag_counts.c.tag_id
+    )
+
+    with connection() as conn:
+        conn = conn.execution_options(stream_results=True)
+        newest = conn.execute(latest).scalar()
+        yield '/', newest
+        yield '/articles', newest
+        for row in conn.execute(article_stmt):
+            yield '/post/{}'.format(row['title_path'] or row['id']), \
+                row['date']
+        for row in conn.execute(page_stmt):
+            yield '/page/{}'.format(row['title_path'] or row['id']), \
+                row['changed']
+        for row in conn.execute(tag_stmt):
+            yield '/tag/{}'.format(row['tag']), row['changed']
+
+
+############################
+# SEARCH FUNCTIONS
+############################
+
+def search_query(terms):
+    """Convert the words a reader typed into an FTS5 query matching every
+    word, with the last word treated as a prefix. Returns None if there
+    are no words to search for."""
+    words = re.findall(r'\w+', terms or '')
+    if len(words) == 0:
+        return None
+    quoted = ['"{}"'.format(word) for word in words]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def index_content(conn, rowid, content):
+    """Update the search index entry for an article (or a page, given its
+    negated ID) from its saved `content`. Unreleased content is removed
+    from the index."""
+    unindex_content(conn, rowid)
+    if not content['released']:
+        return
+    conn.execute(search_index.insert().values(
+        rowid=rowid,
+        title=content['title'] or '',
+        body=util.html_to_text(content['body_html'])
+    ))
+
+
+def unindex_content(conn, rowid):
+    """Remove an article (or a page, given its negated ID) from the search
+    index."""
+    conn.execute(search_index.delete().where(search_index.c.rowid == rowid))
+
+
+def search(terms, page_num=1, page_size=20, snippet_size=32):
+    """
+    Search released articles and pages for `terms`.
+
+    Returns a tuple of the total number of matches and a list with the
+    matches on the given page, best match first (or newest first, if there
+    are too many matches to rank). The title and snippet of each match
+    surround matching words with `search_mark_start` and
+    `search_mark_end`.
+    """
+    query = search_query(terms)
+    if query is None:
+        return 0, []
+
+    params = {
+        'query': query,
+        'mark_start': search_mark_start,
+        'mark_end': search_mark_end,
+        'ellipsis': '\u2026',
+        'snippet_size': snippet_size,
+        'limit': page_size,
+        'offset': page_size * (page_num - 1)
+    }
+
+    results = []
+    with connection() as conn:
+        total = conn.execute(_search_count_stmt, query=query).scalar()
+        stmt = _search_ranked_stmt if total <= _search_rank_limit \
+            else _search_recent_stmt
+        for row in conn.execute(stmt, **params):
+            if row['rowid'] > 0:
+                result = {
+                    'kind': 'article',
+                    'path': '/post/{}'.format(row['article_path'] or
+                                              row['rowid']),
+                    'date': date_to_str(row['article_date'])
+                }
+            else:
+                result = {
+                    'kind': 'page',
+                    'path': '/page/{}'.format(row['page_path'] or
+                                              -row['rowid']),
+                    'date': ''
+                }
+            result['title'] = row['title']
+            result['snippet'] = row['snippet']
+            results.append(result)
+
+    return total, results
+
+
+def rebuild_search_index(batch_size=500):
+    """Rebuild the search index from every released article and page.
+    Returns the number of entries indexed."""
+    count = 0
+    with transaction() as conn:
+        conn.execute(search_index.delete())
+        for table, sign in ((articles, 1), (pages, -1)):
+            stmt = select([table.c.id]).where(table.c.released == 1)
+            ids = [row['id'] for row in conn.execute(stmt)]
+
+            # Index in batches so we never hold every body in memory at once
+            for i in range(0, len(ids), batch_size):
+                selstmt = select([table.c.id,
+                                  table.c.title,
+                                  table.c.body,
+                                  table.c.body_html]).where(
+                    table.c.id.in_(ids[i:i + batch_size])
+                )
+                rows = [{'rowid': sign * row['id'],
+                         'title': row['title'] or '',
+                         'body': util.html_to_text(
+                             row['body_html'] or util.mkdown(row['body'] or '')
+                         )}
+                        for row in conn.execute(selstmt)]
+                conn.execute(search_index.insert(), rows)
+                count += len(rows)
+
+    return count
+
+
+############################
+# JOB FUNCTIONS
+############################
+
+def queue_jobs(conn, new_jobs):
+    """Queue a job for each (kind, target) pair in `new_jobs` using the
+    connection `conn`, skipping any job which is already queued."""
+    rows = [{'kind': kind, 'target': target} for kind, target in new_jobs]
+    if len(rows) == 0:
+        return
+
+    stmt = jobs.insert().prefix_with('OR IGNORE').values(
+        kind=bindparam('kind'),
+        target=bindparam('target'),
+        state='queued',
+        created=func.strftime('%s', 'now')
+    )
+    conn.execute(stmt, rows)
+
+
+def claim_job():
+    """Mark the oldest queued job as running and return it, or None if no
+    job is queued. Every job is claimed by exactly one worker."""
+    selstmt = select([jobs.c.id, jobs.c.kind, jobs.c.target]).where(
+        jobs.c.state == 'queued'
+    ).order_by(
+        jobs.c.id
+    ).limit(1)
+
+    with connection() as conn:
+        while True:
+            row = conn.execute(selstmt).fetchone()
+            if row is None:
+                return None
+
+            # Another worker may claim the job between these statements
+            updstmt = jobs.update().where(
+                jobs.c.id == row['id']
+            ).where(
+                jobs.c.state == 'queued'
+            ).values(
+                state='running',
+                started=func.strftime('%s', 'now')
+            )
+            if conn.execute(updstmt).rowcount == 1:
+                return {'id': row['id'],
+                        'kind': row['kind'],
+                        'target': row['target']}
+
+
+def finish_job(job_id, error=None):
+    """Record that a job finished, or failed with the message `error`."""
+    stmt = jobs.update().where(jobs.c.id == job_id).values(
+        state='failed' if error is not None else 'done',
+        finished=func.strftime('%s', 'now'),
+        error=error
+    )
+    with connection() as conn:
+        conn.execute(stmt)
+
+
+def requeue_jobs(timeout):
+    """Queue again every job which has been running for longer than
+    `timeout` seconds, since the worker running it must have stopped."""
+    cutoff = func.strftime('%s', 'now') - timeout
+    queued = jobs.alias('queued')
+    duplicate = exists().where(
+        queued.c.state == 'queued'
+    ).where(
+        queued.c.kind == jobs.c.kind
+    ).where(
+        queued.c.target == jobs.c.target
+    )
+
+    with transaction() as conn:
+        # Jobs which were queued again in the meantime are dropped
+        conn.execute(jobs.delete().where(
+            jobs.c.state == 'running'
+        ).where(
+            jobs.c.started < cutoff
+        ).where(
+            duplicate
+        ))
+        conn.execute(jobs.update().where(
+            jobs.c.state == 'running'
+        ).where(
+            jobs.c.started < cutoff
+        ).values(
+            state='queued',
+            started=None
+        ))
+
+
+def get_job_status(num_failures=5):
+    """Return the number of jobs in each state, when a job last finished
+    and the most recent `num_failures` failed jobs."""
+    stmt = select([
+        jobs.c.state,
+        func.count(jobs.c.id).label('num_jobs'),
+        func.max(jobs.c.finished).label('finished')
+    ]).group_by(jobs.c.state)
+
+    status = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0,
+              'last_finished': '', 'failures': []}
+    last_finished = None
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            status[row['state']] = row['num_jobs']
+            if row['finished'] is not None:
+                last_finished = max(last_finished or 0, row['finished'])
+
+        if status['failed'] > 0:
+            failstmt = select([
+                jobs.c.kind,
+                jobs.c.target,
+                jobs.c.error,
+                jobs.c.finished
+            ]).where(
+                jobs.c.state == 'failed'
+            ).order_by(
+                jobs.c.id.desc()
+            ).limit(num_failures)
+            status['failures'] = [{
+                'kind': row['kind'],
+                'target': row['target'],
+                'error': row['error'] or '',
+                'finished': time_to_str(row['finished'])
+            } for row in conn.execute(failstmt)]
+
+    status['last_finished'] = time_to_str(last_finished)
+    return status
+
+
+def prune_jobs(age=_job_prune_age):
+    """Remove jobs which finished more than `age` seconds ago."""
+    stmt = jobs.delete().where(
+        jobs.c.state.in_(('done', 'failed'))
+    ).where(
+        jobs.c.finished < func.strftime('%s', 'now') - age
+    )
+    with connection() as conn:
+        conn.execute(stmt)
+
+
 ############################
 # MAINTENANCE FUNCTIONS
 ############################
 
+def get_indexed_tags():
+    """Return a list of all tags with released articles ordered by
+    popularity, as recorded in the tag index."""
+    stmt = select([tag_counts.c.tag]).where(
+        tag_counts.c.released > 0
+    ).order_by(
+        tag_counts.c.released.desc()
+    )
+
+    with connection() as conn:
+        return [row['tag'] for row in conn.execute(stmt)]
+
+
 def prune_tags():
     """Remove any unused tags."""
     stmt = tags.delete().where(
@@ -675,21 +1671,128 @@ def prune_tags():
             )
         )
     )
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    cntstmt = tag_counts.delete().where(
+        tag_counts.c.tag_id.notin_(select([tags.c.id]))
+    )
+    with transaction() as conn:
+        conn.execute(stmt)
+        conn.execute(cntstmt)
+
+
+def check_tag_index():
+    """Return a list of descriptions of every way in which the tag index
+    differs from the tags actually attached to articles."""
+    problems = []
+    with connection() as conn:
+        stored = {row['tag_id']: (row['tag'], row['released'])
+                  for row in conn.execute(select([tag_counts]))}
+
+        stmt = select([tags.c.id, tags.c.tag,
+                       released_tag_count().label('released')])
+        for row in conn.execute(stmt):
+            expected = (row['tag'], row['released'])
+            if stored.pop(row['id'], None) != expected:
+                problems.append("Tag '{}' should have {} released "
+                                "articles.".format(*expected))
+        for tag, _ in stored.values():
+            problems.append("Tag '{}' no longer exists.".format(tag))
+
+        stmt = select([articles.c.id, articles.c.tag_list,
+                       article_tag_names().label('expected')])
+        for row in conn.execute(stmt):
+            if set(tags_as_list(row['tag_list'])) != \
+                    set(tags_as_list(row['expected'])):
+                problems.append("Article {} should have tags '{}'.".format(
+                    row['id'], row['expected']
+                ))
+
+    return problems
+
+
+def rebuild_tag_index():
+    """Rebuild the tag index and every article's tag list from scratch."""
+    with transaction() as conn:
+        refresh_tag_counts(conn)
+        refresh_article_tags(conn)
+        bump_content_version(conn)
+
+
+def render_bodies(force=False, batch_size=100):
+    """Store freshly rendered HTML for every article and page whose HTML
+    is missing or was produced by a different renderer version (or all of
+    them if `force` is given). Returns the number of rows re-rendered."""
+    version = util.render_version()
+    count = 0
+
+    with connection() as conn:
+        for table in (articles, pages):
+            stmt = select([table.c.id])
+            if not force:
+                stmt = stmt.where(
+                    (table.c.body_html == null()) |
+                    (table.c.render_version == null()) |
+                    (table.c.render_version != version)
+                )
+            ids = [row['id'] for row in conn.execute(stmt)]
+
+            updstmt = table.update().where(
+                table.c.id == bindparam('row_id')
+            ).values(
+                body_html=bindparam('body_html'),
+                render_version=bindparam('render_version')
+            )
+
+            # Render in batches so we never hold every body in memory at once
+            for i in range(0, len(ids), batch_size):
+                selstmt = select([table.c.id, table.c.body]).where(
+                    table.c.id.in_(ids[i:i + batch_size])
+                )
+                rows = [{'row_id': row['id'],
+                         'body_html': util.mkdown(row['body'] or ''),
+                         'render_version': version}
+                        for row in conn.execute(selstmt)]
+                conn.execute(updstmt, rows)
+                count += len(rows)
+
+        # Pages showing the new HTML must not be answered with a 304
+        if count > 0:
+            bump_content_version(conn)
+
+    return count
+
+
+def upgrade_schema():
+    """Add any tables and columns missing from a database created with
+    an older version of the schema script."""
+    with transaction() as conn:
+        for stmt in _added_tables:
+            conn.execute(stmt)
+        for table, column, coltype in _added_columns:
+            info = conn.execute("PRAGMA table_info({})".format(table))
+            if column in [row['name'] for row in info]:
+                continue
+            conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table, column, coltype
+            ))
+    analyze()
+
+
+def analyze():
+    """Refresh the table statistics SQLite uses to choose between
+    indexes. Without them, lookups by title path may be planned against
+    the released article index instead of the title path index."""
+    with connection() as conn:
+        conn.execute("ANALYZE")
 
 
 def prune_sessions():
     """Remove any old sessions from the database."""
     stmt = sessions.delete().where(
-        func.sum(
-            func.strftime('%s', 'now') - sessions.change
-        ) == config.SESSION_PRUNE_AGE
+        sessions.c.change < func.strftime('%s', 'now') -
+        settings.get('session_prune_age')
     )
-    conn = engine.connect()
-    conn.execute(stmt)
-    conn.close()
+    with connection() as conn:
+        conn.execute(stmt)
 
 
 ############################
@@ -697,10 +1800,9 @@ def prune_sessions():
 ############################
 
 def save_config(data):
-    """Save configuration options to the database and compile the
-    Python config file."""
+    """Save configuration options to the database and publish them to
+    every worker."""
     zipped = [{'key': k, 'val': v} for k, v in data.items()]
-    util.compile_configuration(data)
 
     stmt = configuration.update().where(
         configuration.c.key_name == bindparam('key')
@@ -708,9 +1810,14 @@ def save_config(data):
         value=bindparam('val')
     )
 
-    conn = engine.connect()
-    conn.execute(stmt, zipped)
-    conn.close()
+    # Publish before committing: pages rendered with the new settings
+    # under the old content version are discarded once it is bumped, but
+    # pages rendered with the old settings under the new version would be
+    # served until the next change
+    with transaction() as conn:
+        conn.execute(stmt, zipped)
+        bump_content_version(conn)
+        settings.publish(dict(settings.current(), **data))
 
 
 def load_config():
@@ -721,12 +1828,10 @@ def load_config():
          configuration.c.default]
     )
 
-    conn = engine.connect()
-    result = conn.execute(stmt)
     data = {}
-    for row in result:
-        val = row['value']
-        data[row['key_name']] = val if val is not None else row['default']
+    with connection() as conn:
+        for row in conn.execute(stmt):
+            val = row['value']
+            data[row['key_name']] = val if val is not None else row['default']
 
-    conn.close()
     return data
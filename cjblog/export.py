@@ -0,0 +1,309 @@
+"""cjblog :: export module
+
+Renders the public blog to static files which nginx can serve without
+involving Python at all.
+
+Each export is written to a new release directory, reusing unchanged
+files from the previous release, and then published by atomically
+switching the `current` symlink, so a half finished export is never
+served.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path
+import shutil
+import tempfile
+import time
+from urllib.parse import quote
+
+import cjblog.database as database
+import cjblog.settings as settings
+
+
+# Default export location; nginx serves `current` below this directory
+_export_dir = '/app/export'
+
+# Name of the manifest file written into each release
+_manifest_name = '.manifest.json'
+
+# Number of previous releases to keep around after a new one is published
+_keep_releases = 2
+
+# Test client used to render pages in each worker process
+_client = None
+
+
+def fingerprint(*args):
+    """Return a stable hash of the given JSON serializable values."""
+    data = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def site_fingerprint():
+    """Return a fingerprint of everything which appears on every page:
+    settings, the page links in the header, and the templates."""
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    templates = []
+    for name in sorted(os.listdir(template_dir)):
+        with open(os.path.join(template_dir, name), 'rb') as f:
+            templates.append(hashlib.sha1(f.read()).hexdigest())
+
+    page_links = [(page['title_path'], page['title'])
+                  for page in database.get_pages(released=True,
+                                                 render=False,
+                                                 with_body=False,
+                                                 only_links=True)]
+
+    return fingerprint(settings.current(),
+                       page_links,
+                       templates)
+
+
+def collect_outputs():
+    """Return a dictionary mapping every public URL on the site to a
+    fingerprint of the content that URL depends on."""
+    site = site_fingerprint()
+    outputs = {}
+
+    articles = database.get_articles(page_size=None,
+                                     with_body=True,
+                                     with_links=True,
+                                     released=True,
+                                     tag_list=True)
+    article_fps = [fingerprint(article) for article in articles]
+
+    # Individual articles
+    for article, article_fp in zip(articles, article_fps):
+        path = article['title_path'] or str(article['id'])
+        outputs['/post/{}'.format(path)] = fingerprint(site, article_fp)
+
+    # Paginated home pages
+    outputs.update(paginated_outputs('', site, article_fps))
+
+    # Paginated tag pages, in the same order the articles are shown
+    by_tag = {}
+    for article_fp, article in zip(article_fps, articles):
+        for tag in article['tag_list']:
+            by_tag.setdefault(tag, []).append(article_fp)
+    for tag, tag_fps in by_tag.items():
+        if '/' in tag or tag in ('.', '..'):
+            continue
+        outputs.update(paginated_outputs('/tag/{}'.format(tag),
+                                         site, tag_fps, tag=tag))
+
+    # Pages
+    for page in database.get_pages(released=True,
+                                   with_body=True,
+                                   only_links=False):
+        path = page['title_path'] or str(page['id'])
+        outputs['/page/{}'.format(path)] = fingerprint(site, page)
+
+    # The full article list
+    listing = [(article['id'], article['title_path'],
+                article['title'], article['date']) for article in articles]
+    outputs['/articles'] = fingerprint(site, listing,
+                                       database.get_all_tags(released=True))
+
+    return outputs
+
+
+def paginated_outputs(prefix, site, article_fps, tag=None):
+    """Return the fingerprints for each page of a paginated list of
+    articles whose URLs begin with `prefix`, under both its page number
+    and its cursor URL."""
+    page_size = settings.get('page_size')
+    _, boundaries = database.get_page_boundaries(page_size=page_size,
+                                                 released=True,
+                                                 tag=tag)
+    pages = len(boundaries)
+    outputs = {}
+
+    for page_num in range(1, pages + 1):
+        # Pages link to their neighbours by cursor, so they depend on them
+        start = page_size * (page_num - 1)
+        page_fp = fingerprint(site, pages,
+                              article_fps[start:start + page_size],
+                              boundaries[max(page_num - 2, 0):page_num + 1])
+        # The app redirects the first page's number to the list itself
+        if page_num == 1:
+            outputs[prefix or '/'] = page_fp
+        else:
+            outputs['{}/{}'.format(prefix, page_num)] = page_fp
+            cursor = database.cursor_to_str(boundaries[page_num - 1])
+            outputs['{}/older/{}'.format(prefix, cursor)] = page_fp
+
+    return outputs
+
+
+def output_file(url):
+    """Return the location of the file for `url` relative to a release."""
+    return os.path.join(url.lstrip('/'), 'index.html')
+
+
+def load_manifest(release_dir):
+    """Return the manifest of the release in `release_dir`, if any."""
+    try:
+        with open(os.path.join(release_dir, _manifest_name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_file(release_dir, url, data):
+    """Write the rendered `data` for `url` into `release_dir`."""
+    path = os.path.join(release_dir, output_file(url))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def reuse_file(previous_dir, release_dir, url):
+    """Link the unchanged file for `url` from the previous release."""
+    src = os.path.join(previous_dir, output_file(url))
+    dst = os.path.join(release_dir, output_file(url))
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def publish(outdir, release_dir):
+    """Atomically point the `current` symlink at `release_dir` and remove
+    any old releases."""
+    current = os.path.join(outdir, 'current')
+    tmplink = os.path.join(outdir, '.current.tmp')
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(os.path.relpath(release_dir, outdir), tmplink)
+    os.replace(tmplink, current)
+
+    releases_dir = os.path.join(outdir, 'releases')
+    releases = sorted(os.listdir(releases_dir))
+    for name in releases[:-_keep_releases]:
+        if name != os.path.basename(release_dir):
+            shutil.rmtree(os.path.join(releases_dir, name),
+                          ignore_errors=True)
+
+
+def _init_worker():
+    """Prepare a worker process for rendering pages."""
+    global _client
+    database.engine.dispose()
+
+    import cjblog.main
+    _client = cjblog.main.app.test_client()
+
+
+def _render(url):
+    """Render `url` exactly as the application would serve it."""
+    response = _client.get(quote(url))
+    return url, response.status_code, response.get_data()
+
+
+def export(outdir, processes=None, full=False):
+    """
+    Export the blog to a new release in `outdir` and publish it.
+
+    Only pages whose content changed since the last export are rendered
+    unless `full` is given. Pages are rendered in a pool of `processes`
+    worker processes (by default, one per CPU).
+    """
+    outdir = os.path.abspath(outdir)
+    current = os.path.join(outdir, 'current')
+    previous_dir = os.path.realpath(current) if os.path.exists(current) \
+        else None
+    previous = load_manifest(previous_dir) if previous_dir and not full \
+        else {}
+
+    print("Collecting site contents... ", end='', flush=True)
+    outputs = collect_outputs()
+    changed = [url for url, fp in outputs.items() if previous.get(url) != fp]
+    print("{total} pages, {changed} changed.".format(total=len(outputs),
+                                                     changed=len(changed)))
+
+    # Releases are named for the time they were started, so they sort in
+    # order; the random suffix keeps simultaneous exports apart
+    releases_dir = os.path.join(outdir, 'releases')
+    os.makedirs(releases_dir, exist_ok=True)
+    release_dir = tempfile.mkdtemp(
+        dir=releases_dir,
+        prefix='{}-'.format(datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    )
+    os.chmod(release_dir, 0o755)
+
+    # Carry over everything we don't need to render again
+    for url in outputs:
+        if url in previous and previous[url] == outputs[url]:
+            reuse_file(previous_dir, release_dir, url)
+
+    # Never share database connections with the worker processes
+    database.engine.dispose()
+
+    start = time.time()
+    manifest = {url: fp for url, fp in outputs.items() if url not in changed}
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    try:
+        for url, status, data in pool.imap_unordered(_render, changed,
+                                                     chunksize=8):
+            if status != 200:
+                print("Skipping '{url}' (status {status})".format(
+                    url=url, status=status))
+                continue
+            write_file(release_dir, url, data)
+            manifest[url] = outputs[url]
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    with open(os.path.join(release_dir, _manifest_name), 'w') as f:
+        json.dump(manifest, f)
+
+    publish(outdir, release_dir)
+    print("Rendered {count} pages in {secs:.2f}s; published '{loc}'.".format(
+        count=len(changed), secs=elapsed, loc=release_dir
+    ))
+
+
+def main():
+    """
+    Main command-line entry point for exporting the blog.
+    """
+    parser = argparse.ArgumentParser(
+        description="Export the blog to static files."
+    )
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="Export directory",
+                        required=False,
+                        default=_export_dir)
+    parser.add_argument("-p", "--processes",
+                        dest="processes",
+                        help="Number of rendering processes "
+                             "(default: one per CPU)",
+                        required=False,
+                        type=int,
+                        default=None)
+    parser.add_argument("-f", "--full",
+                        dest="full",
+                        help="Render every page, even if it is unchanged",
+                        required=False,
+                        default=False,
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    try:
+        export(args.output, processes=args.processes, full=args.full)
+    except (OSError, ValueError) as e:
+        print("\nError: {}".format(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""cjblog :: feeds module
+
+Builds Atom feeds of the newest released articles. Each feed is stored on
+disk so every worker process can serve it, and it is only rebuilt when the
+articles in it actually change.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import tempfile
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import cjblog.settings as settings
+import cjblog.database as database
+import cjblog.util as util
+
+
+# Feeds are stored as files holding a JSON header line and the feed itself
+_feed_dir = util.data_path('feeds')
+
+# Number of articles in each feed
+_feed_size = 20
+
+# Changed whenever the markup of a feed changes, so stored feeds are built
+# again rather than reused
+_feed_format = 2
+
+# Each worker keeps the formatted entries it has built recently, so a
+# rebuilt feed only formats the entries which are new or have changed
+_entry_cache = {}
+_entry_cache_size = 512
+
+
+def fingerprint(*args):
+    """Return a stable hash of the given JSON serializable values."""
+    data = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def iso_date(timestamp):
+    """Return the RFC 3339 form of a UNIX timestamp."""
+    dt = datetime.utcfromtimestamp(int(timestamp or 0))
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_feed(base_url, tag=None):
+    """
+    Return a tuple of the Atom feed of the newest articles (optionally only
+    those with `tag`), its ETag and the time it last changed.
+
+    The stored feed is reused as long as the content has not changed, and
+    even then it is only rebuilt if the articles in it changed. Returns
+    None if there are no articles with the given tag.
+    """
+    version, changed = database.get_content_version()
+    key = 'tag-{}'.format(tag) if tag is not None else 'articles'
+    stored = load(key)
+    if stored is not None:
+        header, body = stored
+        if header['version'] == version and header['base_url'] == base_url:
+            return body, header['etag'], header['updated']
+
+    articles = database.get_articles(page_size=_feed_size,
+                                     with_body=True,
+                                     with_links=True,
+                                     released=True,
+                                     tag=tag,
+                                     tag_list=True)
+    if tag is not None and len(articles) == 0:
+        return None
+
+    signature = fingerprint(_feed_format, base_url, tag,
+                            settings.get('main_title'),
+                            settings.get('subtitle'), articles)
+    if stored is not None and stored[0]['signature'] == signature:
+        header, body = stored
+    else:
+        updated = changed if changed is not None else int(time.time())
+        header = {
+            'signature': signature,
+            'etag': '"{}"'.format(signature[:20]),
+            'updated': updated
+        }
+        body = build_feed(base_url, tag, articles, updated)
+
+    header['version'] = version
+    header['base_url'] = base_url
+    store(key, header, body)
+    return body, header['etag'], header['updated']
+
+
+def build_feed(base_url, tag, articles, updated):
+    """Return the Atom feed of `articles` as bytes."""
+    if tag is not None:
+        title = "{} - {}".format(settings.get('main_title'), tag)
+        page_url = "{}/tag/{}".format(base_url, tag)
+    else:
+        title = settings.get('main_title')
+        page_url = base_url + "/"
+
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<feed xmlns="http://www.w3.org/2005/Atom">\n',
+        '<title>{}</title>\n'.format(escape(title)),
+        '<subtitle>{}</subtitle>\n'.format(escape(settings.get('subtitle'))),
+        '<id>{}</id>\n'.format(escape(page_url)),
+        '<link href={} rel="alternate"/>\n'.format(quoteattr(page_url)),
+        '<link href={} rel="self"/>\n'.format(quoteattr(page_url.rstrip('/') +
+                                                        '/feed.atom')),
+        '<updated>{}</updated>\n'.format(iso_date(updated)),
+        # Entries have no author of their own, so the blog is named as the
+        # author of every entry, as Atom requires
+        '<author><name>{}</name></author>\n'.format(
+            escape(settings.get('main_title') or base_url)
+        )
+    ]
+    parts.extend(feed_entry(base_url, article) for article in articles)
+    parts.append('</feed>\n')
+    return ''.join(parts).encode('utf8')
+
+
+def feed_entry(base_url, article):
+    """Return the Atom entry for `article`, reusing the formatted entry
+    if it has not changed since it was last built."""
+    entry_key = fingerprint(base_url, article)
+    entry = _entry_cache.get(entry_key)
+    if entry is not None:
+        return entry
+
+    url = "{}/post/{}".format(base_url, article['title_path'] or
+                              article['id'])
+    parts = [
+        '<entry>\n',
+        '<title>{}</title>\n'.format(escape(article['title'] or 'Untitled')),
+        '<id>{}/post/{}</id>\n'.format(escape(base_url), article['id']),
+        '<link href={} rel="alternate"/>\n'.format(quoteattr(url)),
+        '<published>{}</published>\n'.format(iso_date(article['timestamp'])),
+        '<updated>{}</updated>\n'.format(iso_date(article['timestamp']))
+    ]
+    for tag in article['tag_list'] or []:
+        parts.append('<category term={}/>\n'.format(quoteattr(tag)))
+    parts.append('<content type="html">{}</content>\n'.format(
+        escape(article['body'])
+    ))
+    parts.append('</entry>\n')
+    entry = ''.join(parts)
+
+    if len(_entry_cache) >= _entry_cache_size:
+        _entry_cache.clear()
+    _entry_cache[entry_key] = entry
+    return entry
+
+
+def load(key):
+    """Return a (header, body) tuple for the feed stored under `key` or
+    None if it has not been stored."""
+    try:
+        with open(_feed_path(key), 'rb') as f:
+            header = json.loads(f.readline().decode('utf8'))
+            body = f.read()
+    except (OSError, ValueError):
+        return None
+    return header, body
+
+
+def store(key, header, body):
+    """Store the feed `body` and its `header` under `key`."""
+    try:
+        os.makedirs(_feed_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=_feed_dir, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(header).encode('utf8'))
+            f.write(b'\n')
+            f.write(body)
+        os.replace(tmp, _feed_path(key))
+    except OSError:
+        pass
+
+
+def _feed_path(key):
+    """Return the location of the file storing the feed `key`."""
+    name = hashlib.sha1(key.encode('utf8')).hexdigest()
+    return os.path.join(_feed_dir, name)
@@ -0,0 +1,195 @@
+"""cjblog :: highlight module
+
+Caches the HTML which the Markdown codehilite extension produces for
+each code block, so re-rendering an article, or previewing it again while
+it is edited, only runs Pygments for code which has not been highlighted
+before.
+
+Blocks are cached under a hash of their code, language and highlighting
+options along with the versions of Markdown and Pygments, so HTML is
+never reused for a block which would highlight differently. Each worker
+keeps the most recently used blocks in memory; with `HIGHLIGHT_CACHE`
+enabled in the configuration they are also kept in the data directory,
+where every worker and the maintenance and import scripts share them.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+import markdown.extensions.codehilite as codehilite
+
+import cjblog.config as config
+import cjblog.metrics as metrics
+import cjblog.util as util
+
+
+# Highlighted blocks most recently used by this worker
+_memory_size = 2048
+_blocks = OrderedDict()
+_blocks_lock = threading.Lock()
+
+# Highlighted blocks shared by every worker, and the most space they may
+# take up; the least recently used blocks are evicted once a worker has
+# stored `_evict_interval` more of them
+_cache_dir = util.data_path('highlight')
+_max_bytes = 32 * 1024 * 1024
+_evict_interval = 100
+_stored = [0]
+
+
+def disk_enabled():
+    """Return True if highlighted blocks are kept on disk."""
+    return bool(getattr(config, 'HIGHLIGHT_CACHE', True))
+
+
+def block_key(block, args, kwargs):
+    """Return the cache key of a code block about to be highlighted with
+    the given arguments. The key covers the block's code, language and
+    every option it was created with."""
+    state = json.dumps([util.render_version(), vars(block), args,
+                        sorted(kwargs.items())],
+                       sort_keys=True, default=repr)
+    return hashlib.sha1(state.encode('utf8')).hexdigest()
+
+
+def lookup(key):
+    """Return the highlighted HTML cached under `key`, or None."""
+    with _blocks_lock:
+        html = _blocks.get(key)
+        if html is not None:
+            _blocks.move_to_end(key)
+            _count('memory')
+            return html
+
+    html = _read(key) if disk_enabled() else None
+    if html is None:
+        _count('miss')
+        return None
+
+    _remember(key, html)
+    _count('disk')
+    return html
+
+
+def store(key, html):
+    """Cache the highlighted `html` of a block under `key`."""
+    _remember(key, html)
+    if disk_enabled():
+        _write(key, html)
+
+
+def clear():
+    """Discard every highlighted block, in memory and on disk."""
+    with _blocks_lock:
+        _blocks.clear()
+    shutil.rmtree(_cache_dir, ignore_errors=True)
+
+
+def _count(result):
+    """Count a lookup in the metrics, if enabled."""
+    if metrics.enabled():
+        metrics.inc('cjblog_highlight_cache_requests_total',
+                    (('result', result),))
+
+
+def _remember(key, html):
+    """Keep a highlighted block in this worker's memory."""
+    with _blocks_lock:
+        _blocks[key] = html
+        _blocks.move_to_end(key)
+        while len(_blocks) > _memory_size:
+            _blocks.popitem(last=False)
+
+
+def _entry_path(key):
+    """Return the location of the file caching the block `key`."""
+    return os.path.join(_cache_dir, key)
+
+
+def _read(key):
+    """Return the highlighted HTML stored on disk under `key`, or None."""
+    path = _entry_path(key)
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            html = f.read()
+        # Mark the entry as recently used for eviction purposes
+        os.utime(path)
+    except OSError:
+        return None
+    return html
+
+
+def _write(key, html):
+    """Store highlighted HTML on disk under `key`."""
+    try:
+        os.makedirs(_cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=_cache_dir, prefix='.')
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(html)
+        os.replace(tmp, _entry_path(key))
+    except OSError:
+        return
+
+    _stored[0] += 1
+    if _stored[0] % _evict_interval == 0:
+        _evict()
+
+
+def _evict():
+    """Remove the least recently used blocks on disk until they are back
+    under the size limit."""
+    entries = []
+    total = 0
+    try:
+        scanned = list(os.scandir(_cache_dir))
+    except OSError:
+        return
+    for entry in scanned:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    if total <= _max_bytes:
+        return
+
+    # Evict down to 90% of the limit so we don't evict on every check
+    for _, size, path in sorted(entries):
+        if total <= _max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    """Highlights a code block like the codehilite extension, reusing the
+    HTML of any earlier block with the same code and options."""
+
+    def hilite(self, *args, **kwargs):
+        # Highlighting changes the block's attributes, so the key must be
+        # computed first
+        key = block_key(self, args, kwargs)
+        html = lookup(key)
+        if html is None:
+            html = super().hilite(*args, **kwargs)
+            store(key, html)
+        return html
+
+
+def install():
+    """Highlight the code blocks of everything Markdown renders through
+    the cache. The codehilite extension creates each block from its
+    module's `CodeHilite` class when it runs."""
+    if codehilite.CodeHilite is not CachedCodeHilite:
+        codehilite.CodeHilite = CachedCodeHilite
@@ -0,0 +1,535 @@
+"""cjblog :: import module
+
+Imports a directory (or tarball) of Markdown files with YAML or TOML
+front matter as articles and pages, in a single transaction. Exports
+written by the backup module, in either format, are imported the same
+way.
+
+An article looks like this; every front matter field is optional:
+
+    ---
+    title: My First Post
+    date: 2015-06-01 12:00
+    tags: [python, sqlite]
+    released: true
+    link: https://example.com/
+    link_text: Example
+    slug: my-first-post
+    ---
+    The body, in Markdown.
+
+TOML front matter is delimited by `+++` lines instead. The title defaults
+to the file name, the date to the file's modification time and the slug
+to the title; `draft: true` is the same as `released: false`. Pages are
+marked with `type: page` and may also give their menu `order`, whether
+they appear `in_menu` and when they were `edited`. Articles and pages
+whose slug already exists are skipped, so an import can be repeated.
+
+Each line of a JSON Lines file is an object with the same fields plus the
+`body`.
+
+Bodies are parsed and rendered in a pool of worker processes while the
+articles, tags and search index entries are inserted in batches.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+from datetime import date, datetime
+import gzip
+from itertools import islice
+import json
+import multiprocessing
+import os
+import os.path
+import re
+import tarfile
+import time
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import toml as tomllib
+    except ImportError:
+        tomllib = None
+
+from sqlalchemy import func, select
+
+import cjblog.cache as cache
+import cjblog.database as database
+import cjblog.util as util
+
+
+# Files with these extensions are imported
+_extensions = ('.md', '.markdown', '.mdown')
+
+# Configuration file of a tarball export
+_config_name = 'config.json'
+
+# Names given to the lines of JSON Lines files
+_jsonl_line = re.compile(r'\.jsonl(\.gz)?:\d+$')
+
+# Number of files parsed and rendered between each batch of inserts
+_batch_size = 500
+
+# Number of rows given to each statement with an IN clause, which stays
+# below SQLite's limit on the number of bound parameters
+_chunk_size = 500
+
+# Front matter delimiters and the format they introduce
+_delimiters = {'---': 'yaml', '+++': 'toml'}
+
+# Value forms understood by the fallback front matter parser
+_quoted = re.compile(r'^(["\']).*\1$')
+_list_item = re.compile(r'\s*("(?:[^"\\]|\\.)*"|\'[^\']*\'|[^,]+)')
+_number = re.compile(r'^-?\d+(\.\d+)?$')
+_true = frozenset(('true', 'yes', 'on'))
+_false = frozenset(('false', 'no', 'off'))
+
+
+def is_source(name):
+    """Return True if the file `name` should be imported."""
+    return name.lower().endswith(_extensions) or \
+        os.path.basename(name) == _config_name
+
+
+def read_sources(path):
+    """
+    Yield a (name, data, mtime) tuple for each source in the directory,
+    tarball or JSON Lines file (optionally gzipped) at `path`, in order.
+    Each line of a JSON Lines file is a source of its own.
+
+    The data is left undecoded, so a source which is not UTF-8 only fails
+    its own import.
+    """
+    if os.path.isdir(path):
+        names = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            names.extend(os.path.join(root, name) for name in sorted(files)
+                         if is_source(name))
+        for name in names:
+            with open(name, 'rb') as f:
+                data = f.read()
+            yield os.path.relpath(name, path), data, os.path.getmtime(name)
+        return
+
+    if path.endswith(('.jsonl', '.jsonl.gz')):
+        mtime = os.path.getmtime(path)
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            for num, line in enumerate(f, 1):
+                if line.strip():
+                    yield ('{}:{}'.format(os.path.basename(path), num),
+                           line, mtime)
+        return
+
+    with tarfile.open(path, 'r:*') as tar:
+        for member in tar:
+            if member.isfile() and is_source(member.name):
+                yield (member.name, tar.extractfile(member).read(),
+                       member.mtime)
+
+
+def split_front_matter(text):
+    """Return a tuple of the format of the front matter of `text` ('yaml',
+    'toml' or None), the front matter itself and the body."""
+    text = text.lstrip('\ufeff')
+    lines = text.split('\n')
+    fmt = _delimiters.get(lines[0].strip())
+    if fmt is None:
+        return None, '', text
+
+    closing = ('---', '...') if fmt == 'yaml' else ('+++',)
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() in closing:
+            return (fmt, '\n'.join(lines[1:i]),
+                    '\n'.join(lines[i + 1:]).lstrip('\n'))
+    raise ValueError("Front matter is never closed.")
+
+
+def parse_front_matter(fmt, front_matter):
+    """Return the fields of `front_matter` in the format `fmt`, using
+    PyYAML or a TOML library if one is installed, and otherwise a parser
+    which understands simple `key: value` (or `key = value`) fields and
+    lists."""
+    if fmt is None or not front_matter.strip():
+        return {}
+    if fmt == 'yaml' and yaml is not None:
+        fields = yaml.safe_load(front_matter)
+    elif fmt == 'toml' and tomllib is not None:
+        fields = tomllib.loads(front_matter)
+    else:
+        fields = parse_simple(front_matter, ':' if fmt == 'yaml' else '=')
+
+    if not isinstance(fields, dict):
+        raise ValueError("Front matter is not a set of fields.")
+    return {str(key).lower(): value for key, value in fields.items()}
+
+
+def parse_simple(front_matter, separator):
+    """Parse simple front matter of `key<separator>value` lines. YAML style
+    lists of `- value` lines below a key with no value are supported."""
+    fields = {}
+    key = None
+    for line in front_matter.split('\n'):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if stripped.startswith('- ') and key is not None and \
+                isinstance(fields[key], list):
+            fields[key].append(parse_value(stripped[2:]))
+            continue
+
+        key, sep, value = stripped.partition(separator)
+        if not sep:
+            raise ValueError("Cannot parse front matter line '{}'.".format(
+                stripped))
+        key = key.strip().strip('"\'')
+        value = value.strip()
+        fields[key] = parse_value(value) if value else []
+    return fields
+
+
+def parse_value(value):
+    """Parse a single value of simple front matter."""
+    value = value.strip()
+    if value.startswith('[') and value.endswith(']'):
+        return [parse_value(item)
+                for item in _list_item.findall(value[1:-1]) if item.strip()]
+    if _quoted.match(value):
+        if value[0] == '"':
+            try:
+                return json.loads(value)
+            except ValueError:
+                pass
+        return value[1:-1]
+    if value.lower() in _true:
+        return True
+    if value.lower() in _false:
+        return False
+    if _number.match(value):
+        return float(value) if '.' in value else int(value)
+    return value
+
+
+def to_timestamp(value, default):
+    """Return a UNIX timestamp for a front matter date, which may be a
+    date, a datetime, a number or a string."""
+    if value is None or value == '':
+        return default
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day).timestamp()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return database.safe_date(str(value))
+    except (ValueError, OverflowError):
+        raise ValueError("Invalid date '{}'.".format(value))
+
+
+def to_tags(value):
+    """Return the list of tag names in a front matter list or comma
+    separated string, without duplicates."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    tag_names = []
+    for tag in value:
+        tag = str(tag).strip()
+        if tag and tag not in tag_names:
+            tag_names.append(tag)
+    return tag_names
+
+
+def parse_source(name, text):
+    """Return the fields and body of the source file `name`: a Markdown
+    file with front matter, a line of a JSON Lines export or the
+    configuration file of a tarball export."""
+    if os.path.basename(name) == _config_name:
+        return {'type': 'config', 'values': json.loads(text)}, ''
+    if _jsonl_line.search(name):
+        fields = json.loads(text)
+        if not isinstance(fields, dict):
+            raise ValueError("Record is not a JSON object.")
+        return fields, fields.pop('body', '') or ''
+
+    fmt, front_matter, body = split_front_matter(text)
+    return parse_front_matter(fmt, front_matter), body
+
+
+def parse_entry(name, fields, body, mtime):
+    """
+    Return a tuple of the kind of entry described by `fields` and `body`
+    (the name of the table it belongs in, 'config' or None if it should
+    be ignored), its columns, its tags and the text to index for
+    searching. Raises a ValueError if the fields are invalid.
+    """
+    kind = fields.get('type', 'article')
+    if kind == 'config':
+        values = fields.get('values')
+        if not isinstance(values, dict):
+            raise ValueError("Configuration is not a set of fields.")
+        return 'config', values, [], ''
+    if kind == 'export':
+        return None, None, [], ''
+    if kind not in ('article', 'page'):
+        raise ValueError("Unknown entry type '{}'.".format(kind))
+
+    title = str(fields.get('title') or
+                os.path.splitext(os.path.basename(name))[0])
+    released = fields.get('released', not fields.get('draft', False))
+    slug = fields.get('slug') or fields.get('title_path')
+    body_html = util.mkdown(body)
+    columns = {
+        'released': 1 if released else 0,
+        'title_path': str(slug) if slug else database.url_safe_string(title),
+        'title': title,
+        'body': body,
+        'body_html': body_html
+    }
+
+    if kind == 'page':
+        columns.update(
+            pg_order=int(fields.get('order') or 0),
+            incl_link=1 if fields.get('in_menu', True) else 0,
+            create_date=to_timestamp(fields.get('date'), mtime),
+            edit_date=to_timestamp(fields.get('edited'), None)
+        )
+        return 'page', columns, [], util.html_to_text(body_html)
+
+    link = fields.get('link')
+    link_text = fields.get('link_text')
+    columns.update(
+        title_link=str(link) if link else None,
+        title_alt=str(link_text) if link_text else None,
+        date=to_timestamp(fields.get('date'), mtime)
+    )
+    return ('article', columns, to_tags(fields.get('tags')),
+            util.html_to_text(body_html))
+
+
+def _prepare(source):
+    """Parse and render one source in a worker process, returning a tuple
+    of its name and either the parsed entry or an error."""
+    name, data, mtime = source
+    try:
+        fields, body = parse_source(name, data.decode('utf8'))
+        return name, parse_entry(name, fields, body, mtime), None
+    except Exception as e:
+        # The optional front matter parsers each raise their own errors
+        return name, None, "{}: {}".format(type(e).__name__, e)
+
+
+def batches(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_blog(path, processes=None, batch_size=_batch_size,
+                restore_config=False):
+    """
+    Import the articles and pages in the directory, tarball or JSON Lines
+    file at `path`. Configuration found in an export is only restored if
+    `restore_config` is given.
+
+    Returns a dictionary counting the articles and pages imported, the new
+    tags and the sources skipped, and the time taken in seconds.
+    """
+    start = time.time()
+    stats = {'articles': 0, 'pages': 0, 'tags': 0, 'skipped': 0}
+    config_values = {}
+
+    # Never share database connections with the worker processes
+    database.engine.dispose()
+    pool = multiprocessing.Pool(processes)
+    try:
+        with database.transaction() as conn:
+            # Take the write lock before reading the next free IDs
+            database.bump_content_version(conn)
+            state = import_state(conn)
+
+            for batch in batches(read_sources(path), batch_size):
+                entries = []
+                for name, entry, error in pool.map(_prepare, batch,
+                                                   chunksize=16):
+                    if error is not None:
+                        print("Skipping '{name}': {error}".format(
+                            name=name, error=error))
+                        stats['skipped'] += 1
+                    elif entry[0] == 'config':
+                        config_values.update(entry[1])
+                    elif entry[0] is not None:
+                        entries.append((name, entry))
+                insert_entries(conn, state, entries, stats)
+
+                elapsed = time.time() - start
+                count = stats['articles'] + stats['pages']
+                print("Imported {count} entries ({rate:.0f}/s)...".format(
+                    count=count, rate=count / elapsed if elapsed else 0
+                ), flush=True)
+
+            touched = sorted(state['touched'])
+            for i in range(0, len(touched), _chunk_size):
+                database.refresh_tag_counts(conn, touched[i:i + _chunk_size])
+    finally:
+        pool.close()
+        pool.join()
+
+    if config_values and restore_config:
+        data = database.load_config()
+        data.update((key, value) for key, value in config_values.items()
+                    if key in util.defaults)
+        database.save_config(data)
+    elif config_values:
+        print("Ignoring the configuration in the export; pass --config to "
+              "restore it.")
+
+    # Workers would otherwise keep serving the pages they cached before
+    cache.invalidate()
+    database.analyze()
+    stats['elapsed'] = time.time() - start
+    return stats
+
+
+def import_state(conn):
+    """Return the next free article, page and tag IDs, the ID of every
+    tag and the paths already in use, read with the connection `conn`."""
+    def next_id(table):
+        return (conn.execute(select([func.max(table.c.id)])).scalar() or
+                0) + 1
+
+    def paths(table):
+        return {row['title_path'] for row in conn.execute(
+            select([table.c.title_path])
+        )}
+
+    return {
+        'ids': {'articles': next_id(database.articles),
+                'pages': next_id(database.pages),
+                'tags': next_id(database.tags)},
+        'tag_ids': {row['tag']: row['id'] for row in conn.execute(
+            select([database.tags.c.id, database.tags.c.tag])
+        )},
+        'paths': {'articles': paths(database.articles),
+                  'pages': paths(database.pages)},
+        'touched': set()
+    }
+
+
+def insert_entries(conn, state, entries, stats):
+    """Insert a batch of parsed `entries` with the connection `conn`,
+    skipping any whose path is already in use."""
+    ids = state['ids']
+    tag_ids = state['tag_ids']
+    version = util.render_version()
+    rows = {'articles': [], 'pages': [], 'tags': [], 'tag_map': [],
+            'search_index': []}
+
+    for name, (kind, columns, tag_names, text) in entries:
+        kind = kind + 's'
+        paths = state['paths'][kind]
+        if columns['title_path'] and columns['title_path'] in paths:
+            print("Skipping '{name}': the path '{path}' is already in "
+                  "use.".format(name=name, path=columns['title_path']))
+            stats['skipped'] += 1
+            continue
+        paths.add(columns['title_path'])
+
+        entry_id = ids[kind]
+        ids[kind] += 1
+        for tag in tag_names:
+            if tag not in tag_ids:
+                tag_ids[tag] = ids['tags']
+                rows['tags'].append({'id': ids['tags'], 'tag': tag})
+                ids['tags'] += 1
+            rows['tag_map'].append({'tag_id': tag_ids[tag],
+                                    'article_id': entry_id})
+            state['touched'].add(tag_ids[tag])
+
+        columns.update(id=entry_id, render_version=version)
+        if kind == 'articles':
+            columns['tag_list'] = ', '.join(tag_names)
+        rows[kind].append(columns)
+        if columns['released']:
+            # Pages are indexed under their negated ID
+            rows['search_index'].append({
+                'rowid': entry_id if kind == 'articles' else -entry_id,
+                'title': columns['title'],
+                'body': text
+            })
+
+    # Tags must exist before they are mapped to articles
+    for table in ('tags', 'articles', 'pages', 'tag_map', 'search_index'):
+        if rows[table]:
+            conn.execute(getattr(database, table).insert(), rows[table])
+
+    stats['articles'] += len(rows['articles'])
+    stats['pages'] += len(rows['pages'])
+    stats['tags'] += len(rows['tags'])
+
+
+def main():
+    """
+    Main command-line entry point for importing articles and pages.
+    """
+    parser = argparse.ArgumentParser(
+        description="Import a directory or tarball of Markdown files with "
+                    "front matter, or a JSON Lines export of a blog."
+    )
+    parser.add_argument("source",
+                        help="Directory, tarball or JSON Lines file")
+    parser.add_argument("-p", "--processes",
+                        dest="processes",
+                        help="Number of rendering processes "
+                             "(default: one per CPU)",
+                        required=False,
+                        type=int,
+                        default=None)
+    parser.add_argument("-b", "--batch-size",
+                        dest="batch_size",
+                        help="Number of files inserted in each batch",
+                        required=False,
+                        type=int,
+                        default=_batch_size)
+    parser.add_argument("-c", "--config",
+                        dest="config",
+                        help="Restore the configuration in an export",
+                        required=False,
+                        default=False,
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    try:
+        stats = import_blog(args.source, processes=args.processes,
+                            batch_size=args.batch_size,
+                            restore_config=args.config)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        print("\nError: {}".format(e))
+        return
+
+    count = stats['articles'] + stats['pages']
+    print("Imported {articles} articles, {pages} pages and {tags} new tags "
+          "in {secs:.2f}s ({rate:.0f} entries/s); skipped {skipped}.".format(
+              articles=stats['articles'], pages=stats['pages'],
+              tags=stats['tags'], secs=stats['elapsed'],
+              skipped=stats['skipped'],
+              rate=count / stats['elapsed'] if stats['elapsed'] else 0
+          ))
+
+
+if __name__ == "__main__":
+    main()
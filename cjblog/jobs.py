@@ -0,0 +1,195 @@
+"""cjblog :: jobs module
+
+Regenerates the public pages affected by each change to the blog in the
+background, so the first reader after a save is not the one who pays to
+render them again.
+
+Saving an article, a page or the settings queues a job for each page,
+feed and sitemap whose output the change affected, using the state of the
+blog both before and after the save. The jobs are kept in the database,
+where a job which is already queued is never queued twice, and every app
+worker runs a thread which claims queued jobs one at a time and requests
+their pages, filling the page cache and the feed and sitemap files. A
+worker is woken as soon as a job is queued in its own process and notices
+jobs queued by other processes through a stamp; jobs left running by a
+worker which stopped are queued again after a while.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+from contextlib import contextmanager
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+import cjblog.cache as cache
+import cjblog.database as database
+import cjblog.util as util
+
+
+# Stamp bumped whenever jobs are queued, so every worker looks for them
+_stamp_name = 'jobs'
+
+# Seconds between checks of the stamp, and between looking for jobs
+# regardless of the stamp
+_check_interval = 1
+_poll_interval = 60
+
+# Jobs running for longer than this many seconds are assumed to belong to
+# a worker which stopped, and are queued again
+_job_timeout = 300
+
+# Number of pages of the article list regenerated after each change
+_warm_pages = 3
+
+# Wakes this worker's thread as soon as it queues jobs itself
+_wake = threading.Event()
+_started = []
+
+
+def affected_outputs(article_id=None, page_id=None):
+    """
+    Return the set of paths whose output depends on the given article or
+    page, along with the paths which list every article.
+
+    Only released articles and pages appear on the public site, so the
+    paths of an unreleased article or page are left out.
+    """
+    num_pages = database.get_num_articles()[1]
+    paths = {'/', '/articles', '/feed.atom', '/sitemap.xml'}
+    paths.update('/{}'.format(num) for num in
+                 range(2, min(num_pages, _warm_pages) + 1))
+
+    if article_id is not None:
+        article = database.get_article(article_id, render=False)
+        if article is not None and article['released']:
+            paths.add('/post/{}'.format(quote(article['title_path'] or
+                                              str(article['id']))))
+            for tag in article['tag_list']:
+                paths.add('/tag/{}'.format(quote(tag)))
+                paths.add('/tag/{}/feed.atom'.format(quote(tag)))
+
+    if page_id is not None:
+        page = database.get_page(page_id, render=False)
+        if page is not None and page['released']:
+            paths.add('/page/{}'.format(quote(page['title_path'] or
+                                              str(page['id']))))
+
+    return paths
+
+
+@contextmanager
+def regenerating(article_id=None, page_id=None):
+    """
+    Run the block, which changes the blog, in a transaction along with
+    queueing jobs to regenerate every output it affected.
+
+    The block receives a dictionary of the article and page it changes,
+    where it should record the ID of anything it creates. Once the
+    transaction is committed the page cache is invalidated and the
+    workers are told about the new jobs.
+    """
+    changed = {'article_id': article_id, 'page_id': page_id}
+
+    with database.transaction() as conn:
+        paths = affected_outputs(article_id, page_id)
+        yield changed
+        paths.update(affected_outputs(changed['article_id'],
+                                      changed['page_id']))
+        database.queue_jobs(conn, [
+            ('warm', util.site_url() + path) for path in sorted(paths)
+        ])
+
+    cache.invalidate()
+    util.bump_stamp(_stamp_name)
+    _wake.set()
+
+
+def warm(client, target):
+    """Request the page at the URL `target` so it is rendered and cached
+    for readers."""
+    url = urlsplit(target)
+    response = client.get(url.path,
+                          base_url='{}://{}'.format(url.scheme, url.netloc))
+    try:
+        # Streamed pages are only cached once they are read to the end
+        response.get_data()
+    finally:
+        response.close()
+
+    # Pages which no longer exist are expected after deleting something
+    if response.status_code >= 500:
+        raise RuntimeError("'{url}' returned {status}.".format(
+            url=target, status=response.status_code
+        ))
+
+
+# Functions which run each kind of job
+_handlers = {'warm': warm}
+
+
+def run_queued(app):
+    """Run queued jobs until none are left and return the number run."""
+    database.requeue_jobs(_job_timeout)
+    client = app.test_client()
+    count = 0
+    while True:
+        job = database.claim_job()
+        if job is None:
+            return count
+
+        error = None
+        try:
+            _handlers[job['kind']](client, job['target'])
+        except Exception as e:
+            app.logger.exception("Job {} failed.".format(job['id']))
+            error = "{}: {}".format(type(e).__name__, e)
+        database.finish_job(job['id'], error=error)
+        count += 1
+
+
+def run_worker(app):
+    """Run queued jobs whenever any are queued, forever."""
+    seen = None
+    polled = 0
+    while True:
+        stamp = util.read_stamp(_stamp_name)
+        if stamp != seen or time.monotonic() - polled >= _poll_interval:
+            seen = stamp
+            polled = time.monotonic()
+            try:
+                run_queued(app)
+            except Exception:
+                app.logger.exception("Could not run queued jobs.")
+
+        _wake.wait(_check_interval)
+        _wake.clear()
+
+
+def start(app):
+    """Start this worker's background thread, unless it has one already."""
+    if _started:
+        return
+    thread = threading.Thread(target=run_worker, args=(app,),
+                              name='cjblog-jobs', daemon=True)
+    thread.start()
+    _started.append(thread)
+
+
+def main():
+    """
+    Main command-line entry point for running queued jobs.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run every job queued by changes to the blog."
+    )
+    parser.parse_args()
+
+    # Only imported here, since the app imports this module
+    from cjblog.main import app
+
+    count = run_queued(app)
+    print("Ran {count} jobs.".format(count=count))
+
+
+if __name__ == "__main__":
+    main()
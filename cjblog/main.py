@@ -3,21 +3,45 @@
 Renders most of the pages of the site.
 
 Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+from datetime import date, datetime
+from itertools import groupby
 import logging
+from math import ceil
 import os
+import sys
 
 from flask import (Flask,
+                   Response,
                    render_template,
+                   send_file,
+                   stream_with_context,
                    request,
                    session,
                    redirect,
                    url_for,
                    abort,
+                   g,
                    Markup)
+from werkzeug.http import is_resource_modified, parse_date
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
 
 from cjblog.admin import admin
+import cjblog.admin
+import cjblog.cache as cache
 import cjblog.config as config
 import cjblog.database as database
+import cjblog.feeds as feeds
+import cjblog.jobs as jobs
+import cjblog.metrics as metrics
+import cjblog.settings as settings
+import cjblog.sitemap as sitemap
+import cjblog.slowlog as slowlog
+import cjblog.timing as timing
+import cjblog.util as util
 
 
 # Set up Flask
@@ -35,23 +59,120 @@ if config.DEBUG:
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
+# Public views which render identically for every anonymous reader; none
+# of them read the query string, so requests with one are rendered as
+# usual but never cached. Search results are never cached, since every
+# query would take up its own entry.
+_cached_views = frozenset(('home',
+                           'home_older',
+                           'show_article',
+                           'show_page',
+                           'articles_by_tag',
+                           'articles_by_tag_older',
+                           'article_list'))
 
-def paginate(page_num, by_tag=None):
-    """Return start and page_size values"""
-    if not isinstance(page_num, int):
-        abort(404)
-    page_num = page_num if page_num > 0 else 1
 
-    # Return the number of articles and expected number of pages
-    num_articles, pages = database.get_num_articles(released=True,
-                                                    tag=by_tag)
+# Number of page links shown on either side of the current page
+_nav_width = 2
+
+# Number of template output items gathered into each chunk of a streamed
+# response
+_stream_buffer = 50
+
+# Addresses allowed to read the metrics without logging in
+_local_addresses = frozenset(('127.0.0.1', '::1'))
+
+# Number of search results shown on each page
+_search_page_size = 20
 
-    # Figure out which article starts the page
-    start = config.PAGE_SIZE * (page_num - 1)
-    if start > num_articles:
-        start = num_articles % pages
 
-    return start, pages
+def paginate(page_num=None, cursor=None, by_tag=None):
+    """Return the articles on a page, given either its number or the
+    cursor preceding it, and the navigation for that page."""
+    num_articles, boundaries = database.get_page_boundaries(
+        released=True,
+        tag=by_tag
+    )
+    pages = len(boundaries)
+
+    if cursor is not None:
+        try:
+            before = database.cursor_from_str(cursor)
+        except ValueError:
+            abort(404)
+        newer, exact = database.locate_cursor(before,
+                                              released=True,
+                                              tag=by_tag)
+        page_num = newer + 2 if exact else None
+
+        # Only cache the cursors the navigation links to
+        if not exact or database.cursor_to_str(before) != cursor:
+            skip_cache()
+    else:
+        # Numbers past the last page would only repeat another page
+        if not isinstance(page_num, int) or not 1 <= page_num <= pages:
+            abort(404)
+        before = boundaries[page_num - 1]
+        newer = page_num - 2
+
+    # Tags without released articles are not linked from anywhere
+    if by_tag is not None and num_articles == 0:
+        skip_cache()
+
+    articles = database.get_articles(before=before,
+                                     with_body=True,
+                                     with_links=True,
+                                     released=True,
+                                     tag=by_tag,
+                                     tag_list=True)
+    nav = navigation(boundaries, page_num, newer,
+                     "/tag/{}".format(by_tag) if by_tag is not None else "")
+    return articles, nav
+
+
+def navigation(boundaries, page_num, newer, prefix):
+    """
+    Return the page navigation for a list of articles.
+
+    `page_num` is the number of the current page, or None if the current
+    page starts at a cursor which is no longer a page boundary; `newer`
+    is the number of page boundaries newer than the current page. Older
+    and newer links use stable cursor URLs beginning with `prefix`; only
+    a window of page numbers around the current page is linked.
+    """
+    pages = len(boundaries)
+
+    def page_url(num):
+        if num <= 1:
+            return prefix or "/"
+        return "{}/{}".format(prefix, num)
+
+    def cursor_url(num):
+        if num <= 1:
+            return prefix or "/"
+        cursor = database.cursor_to_str(boundaries[num - 1])
+        return "{}/older/{}".format(prefix, cursor)
+
+    center = page_num if page_num is not None else newer + 1
+    first = max(1, center - _nav_width)
+    last = min(pages, center + _nav_width)
+    window = [{'num': num, 'url': page_url(num), 'current': num == page_num}
+              for num in range(first, last + 1)]
+    if first > 1:
+        window = [{'num': 1, 'url': page_url(1), 'current': False},
+                  None][:first - 1] + window
+    if last < pages:
+        window = window + [None, {'num': pages,
+                                  'url': page_url(pages),
+                                  'current': False}][-(pages - last):]
+
+    older_num = page_num + 1 if page_num is not None else newer + 2
+    return {
+        'pages': pages,
+        'window': window,
+        'newer': cursor_url(newer + 1) if newer >= 0 else None,
+        'older': cursor_url(older_num) if older_num <= pages else None
+    }
 
 
 def check_logged_in():
@@ -72,20 +193,144 @@ def check_logged_in():
     return True
 
 
+def is_anonymous():
+    """Checks whether the request carries no session at all. Requests with
+    a session (even an expired one) are never served from the cache."""
+    return 'username' not in session and 'key' not in session
+
+
+def cache_key():
+    """Return the page cache key of the current request, or None if it has
+    a query string."""
+    if request.args:
+        return None
+    return request.path
+
+
+def skip_cache():
+    """Render the current page without storing it in the page cache, for
+    URLs which the site itself never links to."""
+    g.cache_key = None
+
+
+@app.before_request
+def serve_cached_page():
+    """Serve public pages to anonymous readers from the page cache."""
+    if (request.method != 'GET' or
+            request.endpoint not in _cached_views or
+            not is_anonymous()):
+        return None
+
+    key = cache_key()
+    if key is None:
+        return None
+
+    g.cache_generation = cache.generation()
+    cached = cache.get(key, g.cache_generation)
+    if cached is None:
+        g.cache_key = key
+        return None
+
+    body, headers = cached
+    if not_modified(headers.get('ETag'),
+                    parse_date(headers.get('Last-Modified'))):
+        return Response(status=304, headers=validator_headers(headers))
+    return Response(body, headers=headers)
+
+
+@app.after_request
+def store_cached_page(response):
+    """Store freshly rendered public pages in the page cache."""
+    key = getattr(g, 'cache_key', None)
+    if key is None or response.status_code != 200:
+        return response
+
+    headers = {'Content-Type': response.headers['Content-Type']}
+    headers.update(validator_headers(response.headers))
+
+    # Streamed pages are cached as they are sent rather than buffered here
+    if response.is_streamed:
+        response.response = cache.put_stream(key, response.response,
+                                             headers, g.cache_generation,
+                                             charset=response.charset)
+        return response
+
+    cache.put(key, response.get_data(), headers, g.cache_generation)
+    return response
+
+
+def not_modified(etag, last_modified):
+    """Checks whether the client's copy of the page matches the given
+    validators, in which case we can answer with a 304."""
+    if etag is None and last_modified is None:
+        return False
+    return not is_resource_modified(request.environ,
+                                    etag=etag,
+                                    last_modified=last_modified)
+
+
+def validator_headers(headers):
+    """Return only the validator and caching headers from `headers`."""
+    return {name: headers[name]
+            for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+            if name in headers}
+
+
+@app.before_request
+def check_not_modified():
+    """Answer conditional requests for public pages with a 304 if no content
+    has changed since the client's copy was rendered."""
+    if (request.method != 'GET' or
+            request.endpoint not in _cached_views or
+            not is_anonymous()):
+        return None
+
+    version, changed = database.get_content_version()
+    g.etag = '"v{}"'.format(version)
+    g.last_modified = (datetime.utcfromtimestamp(changed)
+                       if changed is not None else None)
+
+    # The validators are added by `set_validators` below
+    if not_modified(g.etag, g.last_modified):
+        return Response(status=304)
+    return None
+
+
+@app.after_request
+def set_validators(response):
+    """Add the content version validators to public pages."""
+    etag = getattr(g, 'etag', None)
+    if etag is None or response.status_code not in (200, 304):
+        return response
+
+    response.headers['ETag'] = etag
+    if g.last_modified is not None:
+        response.last_modified = g.last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+
 @app.route('/', defaults={'page_num': 1})
 @app.route('/<int:page_num>')
 def home(page_num):
     """Renders the home page."""
-    start, pages = paginate(page_num)
-    articles = database.get_articles(start=start,
-                                     with_body=True,
-                                     with_links=True,
-                                     released=True,
-                                     tag_list=True)
+    articles, nav = paginate(page_num=page_num)
+    return render_template("article.html",
+                           page_title="Home",
+                           articles=articles,
+                           nav=nav,
+                           show_tags=True)
+
+
+@app.route('/older/<cursor>')
+def home_older(cursor):
+    """Renders the home page starting after the given cursor."""
+    articles, nav = paginate(cursor=cursor)
     return render_template("article.html",
                            page_title="Home",
                            articles=articles,
-                           pages=pages,
+                           nav=nav,
                            show_tags=True)
 
 
@@ -132,30 +377,139 @@ def articles_by_tag(tag_name, page_num):
     """Display a list of articles by the tag name."""
     if tag_name is None:
         return redirect(url_for("home"))
-    start, pages = paginate(page_num, by_tag=tag_name)
-    articles = database.get_articles(start=start,
-                                     with_body=True,
-                                     with_links=True,
-                                     released=True,
-                                     tag=tag_name,
-                                     tag_list=True)
+    articles, nav = paginate(page_num=page_num, by_tag=tag_name)
     return render_template("article.html",
                            page_title="Tag: {}".format(tag_name),
                            articles=articles,
-                           pages=pages,
+                           nav=nav,
                            show_tags=True)
 
 
+@app.route('/tag/<tag_name>/older/<cursor>')
+def articles_by_tag_older(tag_name, cursor):
+    """Display a list of articles by the tag name starting after the given
+    cursor."""
+    articles, nav = paginate(cursor=cursor, by_tag=tag_name)
+    return render_template("article.html",
+                           page_title="Tag: {}".format(tag_name),
+                           articles=articles,
+                           nav=nav,
+                           show_tags=True)
+
+
+@app.route('/feed.atom', defaults={'tag_name': None})
+@app.route('/tag/<tag_name>/feed.atom')
+def feed(tag_name):
+    """Returns the Atom feed of the newest articles, optionally only those
+    with the given tag."""
+    result = feeds.get_feed(util.site_url(), tag=tag_name)
+    if result is None:
+        abort(404)
+
+    body, etag, updated = result
+    last_modified = datetime.utcfromtimestamp(updated)
+    if not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/atom+xml')
+    response.headers['ETag'] = etag
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/sitemap.xml', defaults={'num': None})
+@app.route('/sitemap-<int:num>.xml')
+def sitemap_xml(num):
+    """Returns the sitemap (or sitemap index) of every public URL, or one
+    of the sitemaps listed in the sitemap index."""
+    name = 'sitemap-{}.xml'.format(num) if num is not None else 'sitemap.xml'
+    path = sitemap.sitemap_file(util.site_url(), name=name)
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype='application/xml', conditional=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Returns the metrics of every worker in the Prometheus text format.
+    Only administrators and clients on this machine may see them."""
+    if (request.remote_addr not in _local_addresses and
+            not check_logged_in()):
+        abort(403)
+    if not metrics.enabled():
+        abort(404)
+    return Response(metrics.exposition(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/articles')
 def article_list():
-    """Renders the article list."""
-    articles = database.get_articles(with_links=False,
-                                     with_body=False,
-                                     released=True)
+    """Renders the article list, grouped by month. The list is streamed to
+    the client as articles are read from the database."""
+    num_articles, _ = database.get_page_boundaries(released=True)
+    articles = database.iter_articles(with_links=False,
+                                      with_body=False,
+                                      released=True)
     tags = database.get_all_tags(released=True)
-    return render_template("list.html",
-                           articles=articles,
-                           tags=tags)
+    return Response(stream_with_context(
+        stream_template("list.html",
+                        num_articles=num_articles,
+                        months=archive_months(articles),
+                        tags=tags)
+    ))
+
+
+def archive_months(articles):
+    """Group the newest first iterable `articles` by month, giving the
+    name of each month and an iterator over its articles."""
+    def month(article):
+        timestamp = int(article['timestamp'] or 0)
+        return date.fromtimestamp(timestamp).strftime("%B %Y")
+
+    return groupby(articles, key=month)
+
+
+def stream_template(template_name, **context):
+    """Render a template as an iterable of chunks of output, which may be
+    sent to the client while the rest of the template is rendered."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(_stream_buffer)
+    return stream
+
+
+@app.route('/search')
+def search():
+    """Renders search results for the terms in the query string."""
+    terms = request.args.get('q', '').strip()
+    page_num = max(request.args.get('page', 1, type=int), 1)
+
+    total, results = database.search(terms,
+                                     page_num=page_num,
+                                     page_size=_search_page_size)
+    for result in results:
+        result['title'] = highlighted(result['title'])
+        result['snippet'] = highlighted(result['snippet'])
+
+    pages = int(ceil(total / _search_page_size))
+    return render_template("search.html",
+                           terms=terms,
+                           total=total,
+                           results=results,
+                           page_num=page_num,
+                           pages=pages)
+
+
+def highlighted(text):
+    """Escape a search result title or snippet and mark the matching
+    words."""
+    escaped = str(Markup.escape(text or ''))
+    return Markup(escaped.replace(database.search_mark_start, '<mark>')
+                  .replace(database.search_mark_end, '</mark>'))
 
 
 @app.route('/login',
@@ -249,6 +603,7 @@ def jinja_context():
             if arg:
                 return arg
 
+    site = settings.current()
     return dict(
         sel=sel,
         admin=check_logged_in(),
@@ -256,15 +611,31 @@ def jinja_context():
                                      render=False,
                                      with_body=False,
                                      only_links=True),
-        header_title=Markup.escape(config.MAIN_TITLE),
-        header_subtitle=Markup.escape(config.SUBTITLE),
-        browser_title=Markup.escape(config.BROWSER_TITLE),
-        footer_text=Markup(config.FOOTER_TEXT),
-        sidebar_image=Markup.escape(config.IMAGE_LOCATION),
-        sidebar_image_alt=Markup.escape(config.IMAGE_ALT)
+        header_title=Markup.escape(site['main_title']),
+        header_subtitle=Markup.escape(site['subtitle']),
+        browser_title=Markup.escape(site['browser_title']),
+        footer_text=Markup(site['footer_text']),
+        sidebar_image=Markup.escape(site['image_location']),
+        sidebar_image_alt=Markup.escape(site['image_alt'])
     )
 
 
+# Time each phase of every request, collect metrics and log slow queries,
+# if enabled in the configuration
+timing.install(app, database.engine, (sys.modules[__name__], cjblog.admin))
+metrics.install(app, database.engine)
+slowlog.install(database.engine)
+
+# Return each request's database connection to the pool when it finishes
+app.teardown_appcontext(database.close_connection)
+
+# Connections must never be shared between forked uWSGI workers, so each
+# worker starts with an empty pool; each worker also regenerates pages in
+# a background thread of its own
+if postfork is not None:
+    postfork(database.engine.dispose)
+    postfork(lambda: jobs.start(app))
+
 # This is used for sessions
 app.secret_key = config.SECRET_KEY
 
@@ -274,4 +645,5 @@ app.register_blueprint(admin)
 
 
 if __name__ == '__main__':
+    jobs.start(app)
     app.run(debug=config.DEBUG)
@@ -3,9 +3,95 @@
 Performs database maintenance functions.
 
 Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+
+import cjblog.cache as cache
 import cjblog.database as database
 
 
+def main():
+    """
+    Main command-line entry point for blog maintenance.
+
+    With no arguments, unused tags, old sessions and finished jobs are
+    pruned and the statistics the query planner uses are refreshed.
+    """
+    parser = argparse.ArgumentParser(
+        description="Perform maintenance on the blog database."
+    )
+    parser.add_argument("-u", "--upgrade",
+                        dest="upgrade",
+                        help="Upgrade an older database to the current schema",
+                        required=False,
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-r", "--render",
+                        dest="render",
+                        help="Re-render stored HTML for bodies rendered by "
+                             "an older version of the Markdown renderer",
+                        required=False,
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-f", "--force",
+                        dest="force",
+                        help="Re-render every stored body. Only used in "
+                             "conjunction with render.",
+                        required=False,
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-c", "--check-tags",
+                        dest="check_tags",
+                        help="Report any differences between the tag index "
+                             "and the tags attached to articles",
+                        required=False,
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-t", "--rebuild-tags",
+                        dest="rebuild_tags",
+                        help="Rebuild the tag index from scratch",
+                        required=False,
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-s", "--rebuild-search",
+                        dest="rebuild_search",
+                        help="Rebuild the search index from scratch",
+                        required=False,
+                        default=False,
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.upgrade:
+        database.upgrade_schema()
+        database.rebuild_tag_index()
+        database.rebuild_search_index()
+    if args.render:
+        count = database.render_bodies(force=args.force)
+        print("Rendered {count} bodies.".format(count=count))
+    if args.check_tags:
+        problems = database.check_tag_index()
+        for problem in problems:
+            print(problem)
+        print("Found {count} problems in the tag index.".format(
+            count=len(problems)
+        ))
+    if args.rebuild_tags:
+        database.rebuild_tag_index()
+        print("Rebuilt the tag index.")
+    if args.rebuild_search:
+        count = database.rebuild_search_index()
+        print("Indexed {count} articles and pages.".format(count=count))
+    if (args.upgrade or args.render or args.rebuild_tags or
+            args.rebuild_search):
+        # Workers would otherwise keep serving the pages they cached before
+        cache.invalidate()
+    if not (args.upgrade or args.render or args.check_tags or
+            args.rebuild_tags or args.rebuild_search):
+        database.prune_tags()
+        database.prune_sessions()
+        database.prune_jobs()
+        database.analyze()
+
+
 if __name__ == "__main__":
-    database.prune_tags()
-    database.prune_sessions()
+    main()
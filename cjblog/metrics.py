@@ -0,0 +1,329 @@
+"""cjblog :: metrics module
+
+Collects request, query, Markdown rendering, page and highlight cache and
+session check metrics in every worker process and exposes the totals for
+all workers in the Prometheus text format.
+
+Each thread records into its own registry, so recording a metric never
+waits on a lock. Every few seconds each worker writes a snapshot of its
+registries to its own file in the data directory; the metrics endpoint
+adds up the snapshots of every worker.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import atexit
+from bisect import bisect_left
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+import cjblog.config as config
+import cjblog.util as util
+
+
+# Snapshots of each worker's metrics, one file per worker process
+_metrics_dir = util.data_path('metrics')
+_flush_interval = 5
+
+# Snapshots of workers which stopped longer ago than this (in seconds) are
+# removed, which Prometheus sees as a counter reset
+_stale_age = 7 * 24 * 3600
+
+# Upper bounds, in seconds, of the histogram buckets
+_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+            0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Description and type of each metric
+_metric_info = {
+    'cjblog_request_duration_seconds': (
+        'histogram', 'Time taken to handle requests, by endpoint.'),
+    'cjblog_requests_total': (
+        'counter', 'Requests handled, by endpoint and status code.'),
+    'cjblog_db_query_duration_seconds': (
+        'histogram', 'Time taken by database queries, by the database '
+                     'function which ran them.'),
+    'cjblog_markdown_render_duration_seconds': (
+        'histogram', 'Time taken to render Markdown.'),
+    'cjblog_page_cache_requests_total': (
+        'counter', 'Page cache lookups, by result.'),
+    'cjblog_highlight_cache_requests_total': (
+        'counter', 'Highlighted code block lookups, by result.'),
+    'cjblog_session_checks_total': (
+        'counter', 'Session checks, by result.'),
+}
+
+# Registries of every thread in this worker; each thread only ever
+# records into its own registry
+_local = threading.local()
+_registries = []
+_registries_lock = threading.Lock()
+
+# Name of this worker's snapshot file and the last time it was written
+_worker_name = None
+_last_flush = 0.0
+
+
+def enabled():
+    """Return True if metrics are enabled in the configuration."""
+    return bool(getattr(config, 'METRICS', True))
+
+
+def _registry():
+    """Return the current thread's registry."""
+    registry = getattr(_local, 'registry', None)
+    if registry is None:
+        registry = {'counters': {}, 'histograms': {}}
+        with _registries_lock:
+            _registries.append(registry)
+        _local.registry = registry
+    return registry
+
+
+def inc(name, labels=(), value=1):
+    """Increment the counter `name` with the given `labels`, a tuple of
+    (name, value) pairs."""
+    counters = _registry()['counters']
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, labels=()):
+    """Record a `value` in seconds in the histogram `name` with the given
+    `labels`, a tuple of (name, value) pairs."""
+    histograms = _registry()['histograms']
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        # One count per bucket (and the +Inf bucket), then the sum
+        histogram = histograms[key] = [0] * (len(_buckets) + 1) + [0.0]
+    histogram[bisect_left(_buckets, value)] += 1
+    histogram[-1] += value
+
+
+def snapshot():
+    """Return the totals of every registry in this worker."""
+    counters = {}
+    histograms = {}
+    with _registries_lock:
+        registries = list(_registries)
+    for registry in registries:
+        for key, value in list(registry['counters'].items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in list(registry['histograms'].items()):
+            _add_histogram(histograms, key, list(histogram))
+    return {
+        'counters': [[name, list(labels), value]
+                     for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), histogram]
+                       for (name, labels), histogram in histograms.items()]
+    }
+
+
+def _add_histogram(histograms, key, histogram):
+    """Add `histogram` to the histogram stored under `key`."""
+    total = histograms.get(key)
+    if total is None:
+        histograms[key] = histogram
+    else:
+        for i, value in enumerate(histogram):
+            total[i] += value
+
+
+def flush(force=False):
+    """Write this worker's snapshot to its file, at most once every few
+    seconds unless `force` is given."""
+    global _last_flush
+    now = time.time()
+    if not force and now - _last_flush < _flush_interval:
+        return
+    _last_flush = now
+
+    try:
+        os.makedirs(_metrics_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=_metrics_dir, prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp, os.path.join(_metrics_dir, worker_name()))
+    except OSError:
+        pass
+
+
+def worker_name():
+    """Return the name of this worker's snapshot file. The name includes
+    the time the worker started, so a restarted worker with a reused
+    process ID never overwrites its predecessor's totals."""
+    global _worker_name
+    if _worker_name is None or not _worker_name.startswith(
+            '{}-'.format(os.getpid())):
+        _worker_name = '{}-{}.json'.format(os.getpid(), int(time.time()))
+    return _worker_name
+
+
+def collect():
+    """Return the totals of every worker's latest snapshot."""
+    counters = {}
+    histograms = {}
+    try:
+        names = os.listdir(_metrics_dir)
+    except OSError:
+        names = []
+    now = time.time()
+    for name in names:
+        if name.startswith('.'):
+            continue
+        path = os.path.join(_metrics_dir, name)
+        try:
+            if now - os.path.getmtime(path) > _stale_age:
+                os.remove(path)
+                continue
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in data['counters']:
+            key = (metric, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, histogram in data['histograms']:
+            key = (metric, tuple(tuple(label) for label in labels))
+            _add_histogram(histograms, key, histogram)
+    return counters, histograms
+
+
+def exposition():
+    """Return the totals of every worker in the Prometheus text format."""
+    flush(force=True)
+    counters, histograms = collect()
+
+    lines = []
+    for metric in sorted(_metric_info):
+        kind, description = _metric_info[metric]
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        if kind == 'counter':
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append('{}{} {}'.format(name, _labels(labels),
+                                                  value))
+            continue
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != metric:
+                continue
+            count = 0
+            bounds = [str(bound) for bound in _buckets] + ['+Inf']
+            for bound, bucket in zip(bounds, histogram):
+                count += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', bound),)), count
+                ))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels),
+                                              histogram[-1]))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """Return the Prometheus form of a tuple of (name, value) labels."""
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def measure_queries(engine):
+    """Record the time taken by every query run by `engine`, labelled by
+    the database function which ran it."""
+    import cjblog.database as database
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, params, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+        observe('cjblog_db_query_duration_seconds', elapsed,
+                (('function', database.query_source()),))
+
+
+def start_request():
+    """Note the time the current request started."""
+    g.metrics_start = time.perf_counter()
+
+
+def end_request(response):
+    """Record the current request's duration and outcome."""
+    start = getattr(g, 'metrics_start', None)
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        observe('cjblog_request_duration_seconds',
+                time.perf_counter() - start,
+                (('endpoint', endpoint),))
+        inc('cjblog_requests_total',
+            (('endpoint', endpoint), ('status', str(response.status_code))))
+    flush()
+    return response
+
+
+def install(app, engine):
+    """
+    Collect metrics for the requests handled by `app` if metrics are
+    enabled.
+
+    Queries are measured through `engine` events; Markdown rendering, page
+    cache lookups and session checks are measured by wrapping
+    `util.mkdown`, `cache.get` and `database.check_session`.
+    """
+    if not enabled():
+        return
+
+    import cjblog.cache as cache
+    import cjblog.database as database
+
+    measure_queries(engine)
+
+    mkdown = util.mkdown
+
+    @functools.wraps(mkdown)
+    def measured_mkdown(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return mkdown(*args, **kwargs)
+        finally:
+            observe('cjblog_markdown_render_duration_seconds',
+                    time.perf_counter() - start)
+    util.mkdown = measured_mkdown
+
+    cache_get = cache.get
+
+    @functools.wraps(cache_get)
+    def measured_cache_get(*args, **kwargs):
+        cached = cache_get(*args, **kwargs)
+        inc('cjblog_page_cache_requests_total',
+            (('result', 'miss' if cached is None else 'hit'),))
+        return cached
+    cache.get = measured_cache_get
+
+    check_session = database.check_session
+
+    @functools.wraps(check_session)
+    def measured_check_session(*args, **kwargs):
+        valid, current = check_session(*args, **kwargs)
+        result = 'current' if current else 'expired' if valid else 'invalid'
+        inc('cjblog_session_checks_total', (('result', result),))
+        return valid, current
+    database.check_session = measured_check_session
+
+    # Measure the whole request, including any other request hooks
+    app.before_request_funcs.setdefault(None, []).insert(0, start_request)
+    app.after_request_funcs.setdefault(None, []).insert(0, end_request)
+    atexit.register(flush, force=True)
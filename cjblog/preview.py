@@ -0,0 +1,105 @@
+"""cjblog :: preview module
+
+Renders the editor's live preview a block at a time. The body is split
+into its top-level Markdown blocks, each identified by a hash of its
+text, and only the blocks the editor has not already been sent are
+rendered. The editor keeps the HTML of every block it has seen during the
+editing session and puts the preview back together from the order of
+hashes it receives, so a preview costs about as much as the edit which
+changed it rather than the whole document.
+
+Blocks are rendered on their own, so a blank line only ends a block where
+it would also end it in the whole document: indented lines, further list
+items, blockquotes and unclosed HTML blocks following a blank line are
+kept with the block before them. Reference link definitions apply to the
+whole document, so they are rendered with every block.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import hashlib
+import re
+
+import cjblog.util as util
+
+
+# Separates chunks of the body which may be separate blocks
+_blank_lines = re.compile(r'\n(?:[ \t]*\n)+')
+
+# Lines which continue the previous block when they follow a blank line
+_indented = re.compile(r'( {4}|\t)')
+_list_item = re.compile(r' {0,3}([*+-]|\d+\.)[ \t]')
+_quote = re.compile(r' {0,3}>')
+
+# Raw HTML blocks, which continue until their closing tag
+_html_block = re.compile(r' {0,3}<([a-zA-Z][a-zA-Z0-9]*)[\s/>]')
+
+# Reference link definitions
+_reference = re.compile(r' {0,3}\[[^\]]+\]:[ \t]*\S')
+
+
+def _continues(block, chunk):
+    """Return True if `chunk` continues `block` despite the blank line
+    between them."""
+    if _indented.match(chunk):
+        return True
+    for marker in (_list_item, _quote):
+        if marker.match(chunk) and marker.match(block):
+            return True
+    html = _html_block.match(block)
+    if html is not None:
+        closing = '</{}>'.format(html.group(1).lower())
+        return closing not in block.lower()
+    return False
+
+
+def split_blocks(text):
+    """
+    Return the top-level blocks of the Markdown `text` and the text of
+    its reference link definitions.
+
+    Rendering each block on its own along with the definitions, and
+    joining the results with newlines, produces the same HTML as
+    rendering the whole text, apart from blank lines between blocks.
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n').strip('\n')
+    blocks = []
+    references = []
+    for chunk in _blank_lines.split(text):
+        lines = []
+        for line in chunk.split('\n'):
+            (references if _reference.match(line) else lines).append(line)
+        chunk = '\n'.join(lines)
+        if not chunk.strip():
+            continue
+        if blocks and _continues(blocks[-1], chunk):
+            blocks[-1] = '{}\n\n{}'.format(blocks[-1], chunk)
+        else:
+            blocks.append(chunk)
+    return blocks, '\n'.join(references)
+
+
+def block_hash(block, references):
+    """Return the hash identifying the HTML of `block` when it is rendered
+    with the given reference definitions."""
+    key = '\0'.join((util.render_version(), references, block))
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def render_blocks(text, known=()):
+    """
+    Return the hashes of the blocks of the Markdown `text`, in order, and
+    a dictionary of the rendered HTML of each block whose hash is not in
+    `known`.
+    """
+    known = set(known)
+    blocks, references = split_blocks(text)
+    order = []
+    rendered = {}
+    for block in blocks:
+        key = block_hash(block, references)
+        order.append(key)
+        if key in known or key in rendered:
+            continue
+        if references:
+            block = '{}\n\n{}'.format(block, references)
+        rendered[key] = util.mkdown(block)
+    return order, rendered
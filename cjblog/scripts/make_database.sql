@@ -19,12 +19,16 @@ CREATE TABLE IF NOT EXISTS articles (
     title_link  TEXT,
     title_alt   TEXT,
     date        INTEGER,
-    body        TEXT
+    body        TEXT,
+    body_html   TEXT,
+    render_version TEXT,
+    tag_list    TEXT
 );
 
 CREATE INDEX released ON articles (released);
 CREATE INDEX title_path ON articles (title_path);
 CREATE INDEX article_date ON articles (date);
+CREATE INDEX article_released_date ON articles (released, date);
 
 CREATE TABLE IF NOT EXISTS pages (
     id          INTEGER PRIMARY KEY,
@@ -35,7 +39,9 @@ CREATE TABLE IF NOT EXISTS pages (
     create_date INTEGER,
     edit_date   INTEGER,
     incl_link   INTEGER,
-    body        TEXT
+    body        TEXT,
+    body_html   TEXT,
+    render_version TEXT
 );
 
 CREATE INDEX page_released ON pages (released);
@@ -55,6 +61,28 @@ CREATE TABLE IF NOT EXISTS tag_map (
     FOREIGN KEY(article_id) REFERENCES articles(id)
 );
 
+CREATE INDEX tag_map_tag ON tag_map (tag_id, article_id);
+CREATE INDEX tag_map_article ON tag_map (article_id);
+
+CREATE TABLE IF NOT EXISTS tag_counts (
+    tag_id    INTEGER PRIMARY KEY,
+    tag       TEXT,
+    released  INTEGER
+);
+
+CREATE INDEX tag_count_tag ON tag_counts (tag);
+CREATE INDEX tag_count_released ON tag_counts (released);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    title,
+    body,
+    tokenize = 'porter unicode61',
+    prefix = '2 3'
+);
+
+INSERT INTO search_index (search_index, rank) VALUES
+    ('rank', 'bm25(10.0, 1.0)');
+
 CREATE TABLE IF NOT EXISTS sessions (
     key     TEXT PRIMARY KEY,
     user    INTEGER,
@@ -71,6 +99,29 @@ CREATE TABLE IF NOT EXISTS configuration (
 
 CREATE INDEX config_key ON configuration (key_name);
 
+CREATE TABLE IF NOT EXISTS content_version (
+    id        INTEGER PRIMARY KEY,
+    version   INTEGER,
+    changed   INTEGER
+);
+
+INSERT INTO content_version (id, version, changed) VALUES
+    (1, 0, strftime('%s', 'now'));
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id        INTEGER PRIMARY KEY,
+    kind      TEXT,
+    target    TEXT,
+    state     TEXT,
+    created   INTEGER,
+    started   INTEGER,
+    finished  INTEGER,
+    error     TEXT
+);
+
+CREATE INDEX job_state ON jobs (state, id);
+CREATE UNIQUE INDEX job_queued ON jobs (kind, target) WHERE state = 'queued';
+
 INSERT INTO configuration (key_name, value, `default`) VALUES
     ('main_title', '', 'my new blog'),
     ('subtitle', '', 'has a subtitle'),
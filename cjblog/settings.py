@@ -0,0 +1,145 @@
+"""cjblog :: settings module
+
+Holds the settings which can be changed from the administration panel:
+the titles and other text shown on every page, the page size and the
+session lifetimes.
+
+The settings are stored in the database, but every worker reads them
+from a versioned snapshot in the data directory. Checking whether the
+snapshot has changed costs a single `stat` per request and the file is
+only read again once another worker has published a new version, so a
+change takes effect in every worker at once while requests make no
+database reads for their settings. Settings which need a restart to take
+effect (such as storage and debugging) remain in `config.py`.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from flask import g, has_app_context
+
+import cjblog.util as util
+
+
+# Snapshot of the settings shared by every worker process
+_settings_file = util.data_path('settings.json')
+
+# This worker's copy of the snapshot, along with the identity (inode,
+# modification time and size) of the file it was read from; the file is
+# replaced whenever it changes, so a new identity means a new version
+_snapshot = {'key': None, 'values': None}
+_snapshot_lock = threading.Lock()
+
+
+def coerce(data):
+    """Return a complete dictionary of settings from `data`, using the
+    default value of any setting which is missing, empty or invalid."""
+    values = {}
+    for key, default in util.defaults.items():
+        value = data.get(key)
+        try:
+            values[key] = type(default)(value) if value else default
+        except (TypeError, ValueError):
+            values[key] = default
+    return values
+
+
+def _file_key():
+    """Return the identity of the snapshot file, or None if there is no
+    snapshot yet."""
+    try:
+        st = os.stat(_settings_file)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _read():
+    """Return the version and settings in the snapshot file, or None if it
+    is missing or unreadable."""
+    try:
+        with open(_settings_file, 'r', encoding='utf8') as f:
+            snapshot = json.load(f)
+        return int(snapshot['version']), coerce(snapshot['values'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def current():
+    """
+    Return a dictionary of the current settings.
+
+    The snapshot is checked at most once per request, so every part of a
+    request sees the same settings. Outside of a request it is checked on
+    every call. If no snapshot has been published yet, the settings are
+    read from the database and published.
+    """
+    if has_app_context() and getattr(g, 'settings', None) is not None:
+        return g.settings
+
+    key = _file_key()
+    with _snapshot_lock:
+        if _snapshot['values'] is not None and _snapshot['key'] == key:
+            values = _snapshot['values']
+        else:
+            values = None
+
+    if values is None:
+        snapshot = _read() if key is not None else None
+        if snapshot is not None:
+            values = snapshot[1]
+            with _snapshot_lock:
+                _snapshot['key'] = key
+                _snapshot['values'] = values
+        else:
+            import cjblog.database as database
+            values = publish(database.load_config())
+
+    if has_app_context():
+        g.settings = values
+    return values
+
+
+def get(name):
+    """Return the current value of the setting `name`."""
+    return current()[name]
+
+
+def publish(data):
+    """
+    Publish the settings in `data` to every worker and return the complete
+    settings.
+
+    Each snapshot has a version greater than any before it and the file is
+    replaced atomically, so workers never read a partially written
+    snapshot. If the snapshot cannot be written, this worker still uses
+    the new settings.
+    """
+    values = coerce(data)
+    previous = _read()
+    version = max(previous[0] + 1 if previous is not None else 1,
+                  int(time.time() * 1000000))
+
+    key = None
+    try:
+        directory = os.path.dirname(_settings_file)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.settings')
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            json.dump({'version': version, 'values': values}, f,
+                      sort_keys=True)
+        os.replace(tmp, _settings_file)
+        key = _file_key()
+    except OSError:
+        pass
+
+    with _snapshot_lock:
+        _snapshot['key'] = key
+        _snapshot['values'] = values
+    if has_app_context():
+        g.settings = values
+    return values
@@ -0,0 +1,143 @@
+"""cjblog :: sitemap module
+
+Writes the sitemap of every public URL on the site, splitting it into a
+sitemap index and several sitemaps for large archives.
+
+Sitemaps are written to disk once per content version while streaming
+rows from the database, so neither the database query nor the response
+holds the whole archive in memory.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+from datetime import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+import cjblog.database as database
+import cjblog.util as util
+
+
+# Sitemaps for each content version are written to their own directory
+_sitemap_dir = util.data_path('sitemaps')
+
+# Maximum number of URLs in a single sitemap file
+_max_urls = 50000
+
+_header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<{} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+
+def w3c_date(timestamp):
+    """Return the W3C date form of a UNIX timestamp."""
+    return datetime.utcfromtimestamp(int(timestamp)).strftime('%Y-%m-%d')
+
+
+def sitemap_file(base_url, name='sitemap.xml'):
+    """
+    Return the location of the sitemap file `name` for the current
+    content, writing the sitemaps first if they are out of date. Returns
+    None if there is no such sitemap.
+    """
+    version, _ = database.get_content_version()
+    host = hashlib.sha1(base_url.encode('utf8')).hexdigest()[:12]
+    version_dir = os.path.join(_sitemap_dir, '{}-{}'.format(version, host))
+    if not os.path.isdir(version_dir):
+        write_sitemaps(base_url, version_dir)
+
+    path = os.path.join(version_dir, name)
+    return path if os.path.isfile(path) else None
+
+
+def write_sitemaps(base_url, version_dir):
+    """Write the sitemaps for every public URL into `version_dir`, and
+    remove the sitemaps for any older content."""
+    os.makedirs(_sitemap_dir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=_sitemap_dir, prefix='.')
+
+    num_files = 0
+    num_urls = 0
+    out = None
+    try:
+        for path, timestamp in database.iter_sitemap_entries():
+            if out is None or num_urls == _max_urls:
+                if out is not None:
+                    close_sitemap(out, 'urlset')
+                num_files += 1
+                num_urls = 0
+                out = open_sitemap(tmpdir, 'sitemap-{}.xml'.format(num_files),
+                                   'urlset')
+
+            out.write('<url><loc>{}</loc>'.format(
+                escape(base_url + quote(path))
+            ))
+            if timestamp is not None:
+                out.write('<lastmod>{}</lastmod>'.format(w3c_date(timestamp)))
+            out.write('</url>\n')
+            num_urls += 1
+        if out is not None:
+            close_sitemap(out, 'urlset')
+
+        # A small site needs just the one sitemap; larger sites get an
+        # index pointing at each of the sitemaps
+        if num_files == 1:
+            os.replace(os.path.join(tmpdir, 'sitemap-1.xml'),
+                       os.path.join(tmpdir, 'sitemap.xml'))
+        else:
+            out = open_sitemap(tmpdir, 'sitemap.xml', 'sitemapindex')
+            for num in range(1, num_files + 1):
+                out.write('<sitemap><loc>{}/sitemap-{}.xml</loc>'
+                          '</sitemap>\n'.format(escape(base_url), num))
+            close_sitemap(out, 'sitemapindex')
+    except BaseException:
+        if out is not None:
+            out.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    # Another worker may have finished writing the same sitemaps first
+    try:
+        os.rename(tmpdir, version_dir)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    remove_older_sitemaps(os.path.basename(version_dir))
+
+
+def sitemap_version(name):
+    """Return the content version of the sitemap directory `name`, or
+    None if it is not a finished sitemap directory."""
+    if name.startswith('.'):
+        return None
+    try:
+        return int(name.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def remove_older_sitemaps(name):
+    """Remove the sitemaps for content older than the sitemap directory
+    `name`. Sitemaps for the same or newer content are kept, since another
+    worker may have written them (or still be writing them) for readers
+    of the current content."""
+    current = sitemap_version(name)
+    for other in os.listdir(_sitemap_dir):
+        version = sitemap_version(other)
+        if version is not None and version < current:
+            shutil.rmtree(os.path.join(_sitemap_dir, other),
+                          ignore_errors=True)
+
+
+def open_sitemap(directory, name, root):
+    """Open a new sitemap file and write its opening tags."""
+    out = open(os.path.join(directory, name), 'w', encoding='utf8')
+    out.write(_header.format(root))
+    return out
+
+
+def close_sitemap(out, root):
+    """Write the closing tag of a sitemap file and close it."""
+    out.write('</{}>\n'.format(root))
+    out.close()
@@ -0,0 +1,385 @@
+"""cjblog :: slow query log module
+
+Logs every query which takes longer than `SLOW_QUERY_MS` milliseconds,
+together with its bound parameters and SQLite's `EXPLAIN QUERY PLAN`
+output, to a log of JSON lines in the data directory. Run
+`python -m cjblog.slowlog` to summarize the log by statement.
+
+Queries under the threshold cost only a timer read. Plans are captured on
+a separate read-only connection which never waits for a lock, and are
+remembered for each statement, so the query being logged and the
+transaction it belongs to are never disturbed.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import logging.handlers
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+import cjblog.config as config
+import cjblog.util as util
+
+
+# Slow queries are logged as one JSON object per line
+logger = logging.getLogger('cjblog.slowlog')
+
+# Location of the log; every worker appends whole lines to the same file,
+# which is rotated by logrotate (see `etc/logrotate/cjblog`) rather than
+# by the workers, since each worker would otherwise rotate it on its own
+_log_file = util.data_path('logs', 'slow-queries.log')
+
+# Number of rotated copies of the log kept by logrotate
+_backup_count = 4
+
+# Bound parameters are shortened to this many characters in the log
+_max_param_length = 200
+
+# At most this many slow queries are logged by a worker each minute, so a
+# struggling database does not also fill the disk
+_max_per_minute = 600
+
+# Plans of the most recently logged statements; plans are captured again
+# after a while since they change as tables grow
+_plan_cache_size = 256
+_plan_max_age = 3600
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+# Statements which have a query plan
+_explainable = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b',
+                          re.IGNORECASE)
+
+# Plan steps which read every row of a table
+_full_scan = re.compile(r'SCAN (?:TABLE )?\w+(?: AS \w+)?$')
+
+# Each thread's connection for capturing plans
+_local = threading.local()
+
+# Start of the current minute and the number of queries logged and
+# dropped in it
+_window = [0.0, 0, 0]
+_window_lock = threading.Lock()
+
+
+def threshold():
+    """Return the slow query threshold in seconds, or None if the slow
+    query log is disabled in the configuration."""
+    ms = getattr(config, 'SLOW_QUERY_MS', 100)
+    return ms / 1000 if ms else None
+
+
+def format_param(value):
+    """Return a loggable form of a bound parameter. Binary values (such as
+    session keys) are never logged, only their length."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '<{} bytes>'.format(len(value))
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    value = str(value)
+    if len(value) > _max_param_length:
+        return '{}... ({} chars)'.format(value[:_max_param_length],
+                                         len(value))
+    return value
+
+
+def format_params(params):
+    """Return a loggable form of a statement's bound parameters."""
+    if isinstance(params, dict):
+        return {key: format_param(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [format_param(value) for value in params]
+    return format_param(params)
+
+
+def _plan_connection(path):
+    """Return the current thread's read-only connection to the database
+    at `path`."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path:
+        # Never wait for a lock: the lock may be held by the very
+        # transaction which ran the slow query
+        conn = sqlite3.connect('file:{}?mode=ro'.format(quote(path)),
+                               uri=True, timeout=0, check_same_thread=False)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+
+def query_plan(path, statement, params):
+    """Return the lines of SQLite's query plan for `statement` run with
+    `params`, or None if it could not be captured."""
+    if not path or path == ':memory:' or not _explainable.match(statement):
+        return None
+
+    now = time.time()
+    with _plans_lock:
+        cached = _plans.get(statement)
+        if cached is not None and now - cached[0] < _plan_max_age:
+            _plans.move_to_end(statement)
+            return cached[1]
+
+    try:
+        cursor = _plan_connection(path).execute(
+            'EXPLAIN QUERY PLAN ' + statement, params
+        )
+        rows = cursor.fetchall()
+    except (sqlite3.Error, ValueError):
+        return None
+
+    # Indent each step under its parent; since SQLite 3.24 the first
+    # column is the step's ID and the second its parent's
+    nested = sqlite3.sqlite_version_info >= (3, 24, 0)
+    depths = {}
+    plan = []
+    for row in rows:
+        depth = depths.get(row[1], -1) + 1 if nested and row[1] else 0
+        depths[row[0]] = depth
+        plan.append('  ' * depth + str(row[-1]))
+
+    with _plans_lock:
+        _plans[statement] = (now, plan)
+        _plans.move_to_end(statement)
+        while len(_plans) > _plan_cache_size:
+            _plans.popitem(last=False)
+    return plan
+
+
+def _admit():
+    """Return the number of queries dropped since the last one logged if
+    another slow query may be logged this minute, or None if not."""
+    now = time.time()
+    with _window_lock:
+        if now - _window[0] >= 60:
+            _window[0] = now
+            _window[1] = 0
+        if _window[1] >= _max_per_minute:
+            _window[2] += 1
+            return None
+        _window[1] += 1
+        dropped = _window[2]
+        _window[2] = 0
+        return dropped
+
+
+def log_query(path, statement, params, executemany, elapsed):
+    """Log a slow query run against the database at `path`."""
+    import cjblog.database as database
+
+    dropped = _admit()
+    if dropped is None:
+        return
+
+    # Only the first set of parameters of a batch is logged and explained
+    rows = None
+    if executemany:
+        rows = len(params)
+        params = params[0] if params else ()
+
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'ms': round(elapsed * 1000, 3),
+        'function': database.query_source(),
+        'statement': statement,
+        'params': format_params(params),
+        'plan': query_plan(path, statement, params)
+    }
+    if rows is not None:
+        entry['rows'] = rows
+    if dropped:
+        entry['dropped'] = dropped
+    if has_request_context():
+        entry['path'] = request.path
+    logger.warning(json.dumps(entry, sort_keys=True, default=str))
+
+
+def watch_queries(engine, limit):
+    """Log every query run by `engine` which takes longer than `limit`
+    seconds."""
+    path = engine.url.database
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault('slowlog_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, params, context, executemany):
+        elapsed = time.perf_counter() - conn.info['slowlog_start'].pop()
+        if elapsed < limit:
+            return
+        try:
+            log_query(path, statement, params, executemany, elapsed)
+        except Exception:
+            # Logging must never fail the query itself
+            pass
+
+    @event.listens_for(engine, 'handle_error')
+    def failed_query(context):
+        conn = context.connection
+        starts = conn.info.get('slowlog_start') if conn is not None else None
+        if starts:
+            starts.pop()
+
+
+def install(engine):
+    """Log the slow queries run by `engine` if the slow query log is
+    enabled."""
+    limit = threshold()
+    if limit is None:
+        return
+
+    if not logger.handlers:
+        try:
+            os.makedirs(os.path.dirname(_log_file), exist_ok=True)
+            # Reopens the log whenever it has been rotated
+            handler = logging.handlers.WatchedFileHandler(_log_file,
+                                                          delay=True)
+        except OSError:
+            return
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+
+    watch_queries(engine, limit)
+
+
+def read_log(log_file):
+    """Yield every entry in `log_file` and its rotated copies, oldest
+    first."""
+    paths = ['{}.{}'.format(log_file, i)
+             for i in range(_backup_count, 0, -1)] + [log_file]
+    for path in paths:
+        try:
+            f = open(path, 'r', encoding='utf8')
+        except OSError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def full_scans(plan):
+    """Return the steps of a query plan which scan a whole table."""
+    return [step.strip() for step in plan or []
+            if _full_scan.match(step.strip())]
+
+
+def summarize(entries, since=None):
+    """Return the statistics of each statement in the slow query log
+    `entries`, slowest in total first. Only entries logged since the time
+    `since` are counted, if given."""
+    by_statement = {}
+    for entry in entries:
+        if since is not None and entry.get('time', '') < since:
+            continue
+        key = ' '.join(entry['statement'].split())
+        stats = by_statement.get(key)
+        if stats is None:
+            stats = by_statement[key] = {
+                'statement': key,
+                'times': [],
+                'functions': set(),
+                'paths': set(),
+            }
+        stats['times'].append(entry['ms'])
+        stats['functions'].add(entry.get('function', 'other'))
+        if entry.get('path'):
+            stats['paths'].add(entry['path'])
+        if entry.get('plan') is not None:
+            stats['plan'] = entry['plan']
+        stats['example'] = entry.get('params')
+
+    summary = []
+    for stats in by_statement.values():
+        times = sorted(stats.pop('times'))
+        stats['count'] = len(times)
+        stats['total_ms'] = sum(times)
+        stats['p50_ms'] = times[len(times) // 2]
+        stats['max_ms'] = times[-1]
+        stats['scans'] = full_scans(stats.get('plan'))
+        summary.append(stats)
+    summary.sort(key=lambda stats: stats['total_ms'], reverse=True)
+    return summary
+
+
+def print_summary(summary, top):
+    """Print the `top` statements of a slow query log summary."""
+    if not summary:
+        print("No slow queries logged.")
+        return
+
+    for rank, stats in enumerate(summary[:top], 1):
+        print("{rank}. {count} queries, {total:.1f} ms total, p50 {p50:.1f} "
+              "ms, max {max:.1f} ms{scan}".format(
+                  rank=rank, count=stats['count'], total=stats['total_ms'],
+                  p50=stats['p50_ms'], max=stats['max_ms'],
+                  scan=' [FULL SCAN]' if stats['scans'] else ''
+              ))
+        print("   From: {}".format(', '.join(sorted(stats['functions']))))
+        if stats['paths']:
+            paths = sorted(stats['paths'])
+            print("   Paths: {}{}".format(
+                ', '.join(paths[:5]),
+                ' (+{} more)'.format(len(paths) - 5) if len(paths) > 5 else ''
+            ))
+        print("   SQL: {}".format(stats['statement']))
+        print("   Example parameters: {}".format(
+            json.dumps(stats['example'])))
+        if stats.get('plan'):
+            print("   Plan:")
+            for step in stats['plan']:
+                print("     {}".format(step))
+        print()
+
+
+def main():
+    """
+    Main command-line entry point for the slow query report.
+    """
+    parser = argparse.ArgumentParser(
+        description="Summarize the slow query log by statement."
+    )
+    parser.add_argument("-l", "--log",
+                        dest="log",
+                        help="Slow query log file",
+                        required=False,
+                        default=_log_file)
+    parser.add_argument("-n", "--top",
+                        dest="top",
+                        help="Number of statements to show",
+                        required=False,
+                        type=int,
+                        default=20)
+    parser.add_argument("-s", "--since",
+                        dest="since",
+                        help="Only count queries logged in the last this "
+                             "many hours",
+                        required=False,
+                        type=float,
+                        default=None)
+
+    args = parser.parse_args()
+
+    since = None
+    if args.since is not None:
+        since = time.strftime('%Y-%m-%dT%H:%M:%S%z',
+                              time.localtime(time.time() - args.since * 3600))
+    print_summary(summarize(read_log(args.log), since), args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,46 @@
  * Author: Christopher Rink (chrisrink10 at gmail dot com)
  */
 $(document).ready(function(){
+    // Rendered HTML of each block of the body previewed so far, by hash
+    var previewBlocks = {},
+        previewRequest = 0;
+
+    // Render the preview, asking the server only for the blocks which
+    // changed since the last preview
+    var renderPreview = function(body, known) {
+        var request = ++previewRequest;
+        $.ajax({
+            'type': 'POST',
+            'url': '/admin/preview',
+            'data': JSON.stringify({'body': body, 'known': known}),
+            'dataType': 'json',
+            'contentType': 'application/json'
+        }).done(function(data) {
+            // A newer preview has been requested since
+            if (request != previewRequest) {
+                return;
+            }
+
+            var blocks = {},
+                html = [];
+            for (var i = 0; i < data.blocks.length; i++) {
+                var hash = data.blocks[i],
+                    block = data.html.hasOwnProperty(hash) ?
+                        data.html[hash] : previewBlocks[hash];
+                if (block === undefined) {
+                    // Start over if a block we claimed to have is gone
+                    previewBlocks = {};
+                    renderPreview(body, []);
+                    return;
+                }
+                blocks[hash] = block;
+                html.push(block);
+            }
+            previewBlocks = blocks;
+            $("#preview_body").html(html.join("\n"));
+        });
+    };
+
     // Enable the Preview and Hide Preview buttons
     $("input[name='preview']").on("click", function() {
         var target = $("input[name='title_link']").val(),
@@ -25,15 +65,7 @@ $(document).ready(function(){
         }
 
         // Create valid HTML from the Markdown body
-        $.ajax({
-            'type': 'POST',
-            'url': '/admin/tomarkdown',
-            'data': body,
-            'dataType': 'html',
-            'contentType': 'text/plain'
-        }).done(function(data) {
-             $("#preview_body").html(data);
-        });
+        renderPreview(body, Object.keys(previewBlocks));
 
 
         // Update the body and date too
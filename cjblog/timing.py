@@ -0,0 +1,134 @@
+"""cjblog :: timing module
+
+Times the phases of each request (database queries, Markdown rendering,
+template rendering and session checks) and reports them in a
+`Server-Timing` header and a JSON log line.
+
+Timing is only installed if `SERVER_TIMING` is enabled in the
+configuration, so it costs nothing otherwise. Phases may overlap: the
+template phase includes any queries run while rendering the template.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import functools
+import json
+import logging
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+import cjblog.config as config
+
+
+# Timings are logged as one JSON object per line
+logger = logging.getLogger('cjblog.timing')
+
+# Order in which phases appear in the header
+_phases = ('db', 'session', 'markdown', 'template')
+
+
+def enabled():
+    """Return True if request timing is enabled in the configuration."""
+    return bool(getattr(config, 'SERVER_TIMING', False))
+
+
+def record(phase, elapsed):
+    """Add `elapsed` seconds to the time spent in `phase` by the current
+    request, if it is being timed."""
+    if not has_app_context():
+        return
+    timings = getattr(g, 'timings', None)
+    if timings is None:
+        return
+    total, count = timings.get(phase, (0.0, 0))
+    timings[phase] = (total + elapsed, count + 1)
+
+
+def timed(phase, func):
+    """Return a wrapper around `func` which records its run time under
+    `phase`."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(phase, time.perf_counter() - start)
+    return wrapper
+
+
+def time_queries(engine):
+    """Record the time taken by every query run by `engine`."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, params, context, executemany):
+        start = conn.info['query_start'].pop()
+        record('db', time.perf_counter() - start)
+
+
+def start_timing():
+    """Start timing the current request."""
+    g.timings = {}
+    g.timing_start = time.perf_counter()
+
+
+def report_timing(response):
+    """Add the current request's timings to `response` and log them."""
+    timings = getattr(g, 'timings', None)
+    if timings is None:
+        return response
+    total = time.perf_counter() - g.timing_start
+
+    metrics = []
+    for phase in _phases:
+        if phase in timings:
+            elapsed, count = timings[phase]
+            metrics.append('{name};dur={ms:.2f};desc="{count} calls"'.format(
+                name=phase, ms=elapsed * 1000, count=count
+            ))
+    metrics.append('total;dur={:.2f}'.format(total * 1000))
+    response.headers['Server-Timing'] = ', '.join(metrics)
+
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 3),
+        'phases': {phase: {'ms': round(elapsed * 1000, 3), 'count': count}
+                   for phase, (elapsed, count) in timings.items()}
+    }, sort_keys=True))
+    return response
+
+
+def install(app, engine, modules):
+    """
+    Time the requests handled by `app` if timing is enabled.
+
+    Queries are timed through `engine` events. Markdown rendering, session
+    checks and template rendering are timed by wrapping `util.mkdown`,
+    `database.check_session` and the `render_template` imported by each
+    of the view `modules`.
+    """
+    if not enabled():
+        return
+
+    import cjblog.database as database
+    import cjblog.util as util
+
+    time_queries(engine)
+    util.mkdown = timed('markdown', util.mkdown)
+    database.check_session = timed('session', database.check_session)
+    for module in modules:
+        module.render_template = timed('template', module.render_template)
+
+    # Time the whole request, including any other request hooks
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timing)
+    app.after_request_funcs.setdefault(None, []).insert(0, report_timing)
+
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
@@ -3,13 +3,27 @@
 Contains utility functions.
 
 Author: Christopher Rink (chrisrink10 at gmail dot com)"""
-import markdown
+import html
 import os
+import re
+import tempfile
+import threading
+import time
 
 # Make sure we handle the variable path (especially with venvs)
 _cfg_loc = '/app/config.py'
 
-# These are some basic defaults, just in case we fail to get any value
+# Directory holding the database and any files shared between workers
+_data_dir = '/data'
+
+# Base URL of absolute links to the site, unless one is configured
+_default_base_url = 'http://localhost'
+
+# Matches any HTML tag or comment
+_html_tag = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+
+# Settings which can be changed from the administration panel and their
+# defaults, just in case we fail to get any value; see the settings module
 defaults = {
     'main_title': '',
     'subtitle': '',
@@ -22,93 +36,144 @@ defaults = {
     'session_prune_age': 3600
 }
 
+# SQLite storage profiles; each setting is applied as a PRAGMA to every new
+# database connection and may be overridden individually in `config.py`
+storage_profiles = {
+    # SQLite's own defaults: writers block every reader
+    'legacy': {
+        'journal_mode': 'delete',
+        'synchronous': 'full',
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'temp_store': 'default',
+        'busy_timeout': 5000
+    },
+    # Readers never wait for writers and commits skip most fsyncs
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 0,
+        'cache_size': -16000,
+        'temp_store': 'memory',
+        'busy_timeout': 5000
+    },
+    # As above, but reads are served from a shared memory map
+    'wal-mmap': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 268435456,
+        'cache_size': -16000,
+        'temp_store': 'memory',
+        'busy_timeout': 5000
+    }
+}
+default_storage_profile = 'wal-mmap'
 
-def compile_configuration(data):
-    """
-    Compile a configuration file from database data.
-
-    Note that this function will attempt to import the existing
-    configuration file, so it is not suitable for compilation of a
-    brand-new `config.py` file.
-    """
-    if not isinstance(data, (dict, type(None))):
-        raise TypeError("Configuration information is required.")
-
-    # Import existing configuration for configuration which is static
-    import cjblog.config
-
-    # Generate the compiled configuration dictionary
-    compiled = {}
-    for key in defaults.keys():
-        compiled[key] = data[key] or defaults[key]
-    compiled['secret_key'] = cjblog.config.SECRET_KEY
+# Accepted values for the storage settings which are not integers
+_storage_choices = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory')
+}
 
-    # Create the text of the configuration file
-    cfg = generate_configuration(debug=cjblog.config.DEBUG,
-                                 data=compiled)
+# Markdown extensions used to render article and page bodies; Markdown
+# and Pygments are only imported once something is rendered, since most
+# requests are served from stored HTML and importing them slows down
+# starting each worker
+_md_extensions = ('smarty', 'codehilite')
 
-    # Once we verified compilation is valid, save the file
-    with open(_cfg_loc, 'w') as f:
-        f.write(cfg)
+# Each thread's Markdown converter; creating one loads every extension,
+# which costs more than rendering a short text, so they are reused
+_md_local = threading.local()
 
-    return
+# Bump this whenever `mkdown` changes in a way which alters its output so
+# that stored HTML will be re-rendered by the maintenance script
+_render_revision = 1
+_render_version = None
 
 
-def generate_configuration(debug=False, data=None, key=None):
+def generate_configuration(debug=False, key=None, storage=None,
+                           server_timing=False, metrics=True,
+                           slow_query_ms=100, highlight_cache=True,
+                           base_url=None):
     """
     Generate the text of the `config.py` file.
 
     Optionally, specify that this instance of the blog will be run in
-    `debug` mode. If no `data` dictionary is provided, the defaults
-    will be selected. If the caller specifies a `key`, then that
-    value will be used
+    `debug` mode. If the caller specifies a `key`, then that value will
+    be used; otherwise a new key is generated. The `storage` settings may
+    be given as a dictionary or the name of a storage profile; by default,
+    the default storage profile is used. Set `server_timing` to report the
+    time spent in each phase of every request, and `metrics` to collect
+    metrics for the metrics endpoint. Queries slower than `slow_query_ms`
+    milliseconds are written to the slow query log (0 disables it). Set
+    `highlight_cache` to share highlighted code blocks between workers
+    on disk. Absolute links in feeds and sitemaps begin with `base_url`.
     """
-    # Specify default data (and key if not given)
-    if data is None:
-        data = defaults
-        if key is None:
-            data['secret_key'] = generate_secret_key()
+    # Absolute links are built from the configured base URL, never from
+    # the Host header of a request
+    if base_url is None:
+        base_url = _default_base_url
+    if not base_url.startswith(('http://', 'https://')):
+        raise ValueError("Base URL '{}' must begin with http:// or "
+                         "https://.".format(base_url))
 
-    # Specify the custom key version
-    if key is not None or 'secret_key' not in data:
-        data["secret_key"] = key
+    # Select the storage settings and verify they can be applied
+    if storage is None or isinstance(storage, str):
+        storage = storage_settings(profile=storage)
+    storage_pragmas(storage)
 
-    # Convert the secret key to a string
-    data["secret_key"] = repr(data["secret_key"])
+    # Generate a key if none was given
+    if key is None:
+        key = generate_secret_key()
 
     # Generate the configuration string
     cfg = str(
         '################################################################\n'
         '# Blog Configuration File\n'
         '#\n'
-        '# DO NOT EDIT THIS FILE MANUALLY. You can modify the settings\n'
-        '# by accessing the administration panel for this blog. This\n'
-        '# file will be compiled by the software.\n'
+        '# DO NOT EDIT THIS FILE MANUALLY. This file is generated by\n'
+        '# setup-blog and read when the blog starts.\n'
         '#\n'
-        '# This file exists to reduce database reads for commonly\n'
-        '# accessed configuration information.\n'
+        '# Settings which can be changed while the blog is running,\n'
+        '# such as its titles and page size, are kept in the database.\n'
+        '# You can modify them by accessing the administration panel.\n'
         '################################################################\n'
         'DEBUG = {debug}\n'
         '\n'
-        '# Page configuration\n'
-        'MAIN_TITLE = "{main_title:s}"\n'
-        'SUBTITLE = "{subtitle:s}"\n'
-        'BROWSER_TITLE = "{browser_title:s}"\n'
-        'FOOTER_TEXT = "{footer_text:s}"\n'
-        'IMAGE_LOCATION = "{image_location:s}"\n'
-        'IMAGE_ALT = "{image_alt:s}"\n'
+        '# Report the time taken by each phase of every request\n'
+        'SERVER_TIMING = {server_timing}\n'
+        '\n'
+        '# Collect request, query and cache metrics for /metrics\n'
+        'METRICS = {metrics}\n'
+        '\n'
+        '# Log queries slower than this many milliseconds (0 to disable)\n'
+        'SLOW_QUERY_MS = {slow_query_ms:d}\n'
         '\n'
-        '# Page Size\n'
-        'PAGE_SIZE = {page_size:d}\n'
+        '# Keep highlighted code blocks on disk for every worker to reuse\n'
+        'HIGHLIGHT_CACHE = {highlight_cache}\n'
         '\n'
-        '# Session configuration\n'
-        'SESSION_EXPIRE = {session_expire:d}\n'
-        'SESSION_PRUNE_AGE = {session_prune_age:d}\n'
+        '# Base URL of absolute links in feeds and sitemaps\n'
+        'BASE_URL = {base_url:s}\n'
+        '\n'
+        '# Storage configuration, applied to every database connection\n'
+        'JOURNAL_MODE = "{storage[journal_mode]:s}"\n'
+        'SYNCHRONOUS = "{storage[synchronous]:s}"\n'
+        'MMAP_SIZE = {storage[mmap_size]:d}\n'
+        'CACHE_SIZE = {storage[cache_size]:d}\n'
+        'TEMP_STORE = "{storage[temp_store]:s}"\n'
+        'BUSY_TIMEOUT = {storage[busy_timeout]:d}\n'
         '\n'
         "# App Secret key encrypts the user's session data\n"
         "SECRET_KEY = {secret_key:s}\n"
     ).format(debug=debug,
-             **data)
+             server_timing=bool(server_timing),
+             metrics=bool(metrics),
+             slow_query_ms=int(slow_query_ms or 0),
+             highlight_cache=bool(highlight_cache),
+             base_url=repr(base_url.rstrip('/')),
+             storage=storage,
+             secret_key=repr(key))
 
     # Try to verify that we can compile this configuration before saving
     # and potentially crashing the application
@@ -120,6 +185,90 @@ def generate_configuration(debug=False, data=None, key=None):
     return cfg
 
 
+def storage_settings(cfg=None, profile=None):
+    """
+    Return a dictionary of SQLite storage settings.
+
+    Settings are taken from the storage profile named `profile` (or the
+    default profile), overridden by any given in the configuration module
+    `cfg`, so configuration files written before a setting existed still
+    work.
+    """
+    if profile is None:
+        profile = default_storage_profile
+    if profile not in storage_profiles:
+        raise ValueError("Unknown storage profile '{}'.".format(profile))
+
+    settings = dict(storage_profiles[profile])
+    if cfg is not None:
+        for name in settings:
+            settings[name] = getattr(cfg, name.upper(), settings[name])
+    return settings
+
+
+def storage_pragmas(settings):
+    """Return the PRAGMA statements which apply the storage `settings`,
+    raising a ValueError if any of them are invalid."""
+    pragmas = []
+    for name in sorted(settings, key=lambda n: n != 'journal_mode'):
+        value = settings[name]
+        if name in _storage_choices:
+            value = str(value).lower()
+            if value not in _storage_choices[name]:
+                raise ValueError("Invalid value '{val}' for '{name}'.".format(
+                    val=value, name=name
+                ))
+        elif not isinstance(value, int):
+            raise ValueError("Setting '{}' must be an integer.".format(name))
+        pragmas.append("PRAGMA {name} = {val}".format(name=name, val=value))
+    return pragmas
+
+
+def site_url():
+    """Return the base URL of absolute links to the site, without a
+    trailing slash, from `BASE_URL` in the configuration."""
+    import cjblog.config as config
+    return getattr(config, 'BASE_URL', _default_base_url).rstrip('/')
+
+
+def data_path(*parts):
+    """Return the location of a file in the data directory."""
+    return os.path.join(_data_dir, *parts)
+
+
+def read_stamp(name):
+    """
+    Return the current version of the stamp called `name`.
+
+    Stamps are small files in the data directory which every worker
+    process can read cheaply to learn that some shared state has changed.
+    A stamp which has never been bumped has version 0.
+    """
+    try:
+        with open(data_path('stamps', name), 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def bump_stamp(name):
+    """
+    Advance the stamp called `name` and return its new version.
+
+    Versions are monotonically increasing and the file is replaced
+    atomically, so readers never observe a partially written value.
+    """
+    stampdir = data_path('stamps')
+    os.makedirs(stampdir, exist_ok=True)
+
+    version = max(read_stamp(name) + 1, int(time.time() * 1000000))
+    fd, tmp = tempfile.mkstemp(dir=stampdir, prefix='.{}'.format(name))
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(version))
+    os.replace(tmp, data_path('stamps', name))
+    return version
+
+
 def generate_secret_key():
     """Generate a new secret key."""
     return os.urandom(32)
@@ -127,10 +276,51 @@ def generate_secret_key():
 
 def mkdown(text):
     """Common function to produce consistent Markdown output."""
-    return markdown.markdown(text,
-                             extensions=['smarty', 'codehilite'],
-                             output_format="html5"
-                             )
+    md = getattr(_md_local, 'md', None)
+    if md is None:
+        import markdown
+        import cjblog.highlight as highlight
+
+        # Reuse the highlighted HTML of code blocks rendered before
+        highlight.install()
+        md = _md_local.md = markdown.Markdown(
+            extensions=list(_md_extensions),
+            output_format="html5"
+        )
+    md.reset()
+    return md.convert(text)
+
+
+def html_to_text(markup):
+    """Return the plain text content of an HTML fragment, as indexed for
+    searching."""
+    text = _html_tag.sub(' ', markup or '')
+    return ' '.join(html.unescape(text).split())
+
+
+def render_version():
+    """
+    Return a string identifying the Markdown renderer which produced any
+    stored HTML.
+
+    The version includes the Markdown and Pygments library versions and
+    the enabled extensions, so upgrading any of them will cause stored
+    article and page bodies to be re-rendered.
+    """
+    global _render_version
+    if _render_version is None:
+        import markdown
+        import pygments
+
+        md_version = getattr(markdown, '__version__',
+                             getattr(markdown, 'version', 'unknown'))
+        _render_version = "{rev}:markdown-{md}:pygments-{pyg}:{ext}".format(
+            rev=_render_revision,
+            md=md_version,
+            pyg=pygments.__version__,
+            ext=",".join(_md_extensions)
+        )
+    return _render_version
 
 
 class CompileError(Exception):
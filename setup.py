@@ -24,7 +24,10 @@ setup(
         'SQLAlchemy>=0.9.4'
     ],
     include_package_data=True,
-    scripts=['bin/setup-blog'],
+    scripts=['bin/setup-blog',
+             'bin/export-blog',
+             'bin/import-blog',
+             'bin/backup-blog'],
     package_data={
         'static': 'cjblog/static/*',
         'templates': 'cjblog/templates/*'
@@ -0,0 +1,17 @@
+"""cjblog :: test configuration
+
+Gives the tests a freshly generated blog configuration if the blog has
+not been configured yet.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import sys
+import types
+
+import cjblog.util as util
+
+try:
+    import cjblog.config
+except ImportError:
+    config = types.ModuleType('cjblog.config')
+    exec(util.generate_configuration(), config.__dict__)
+    sys.modules['cjblog.config'] = config
@@ -0,0 +1,55 @@
+"""cjblog :: pagination cursor tests
+
+Checks that malformed pagination cursors are answered with a 404 rather
+than an error.
+
+Run with `python -m pytest tests`.
+
+Author: Christopher Rink (chrisrink10 at gmail dot com)"""
+import random
+import shutil
+import tempfile
+
+import pytest
+
+import benchmarks.suite as suite
+
+
+# Cursors whose dates parse as floats but are not real timestamps
+_bad_cursors = ('inf_1', '-inf_1', 'nan_1', '1e400_1')
+
+
+@pytest.fixture(scope='module')
+def blog():
+    """Yield a test client for a small synthetic blog, and a sample of its
+    content. The blog's files are kept in a temporary directory."""
+    workdir = tempfile.mkdtemp(prefix='cjblog-test-')
+    try:
+        database = suite.prepare(workdir, options={'articles': 20,
+                                                   'tags': 5,
+                                                   'pages': 2,
+                                                   'sessions': 1})
+        sample = suite.samples(database, random.Random(0))
+
+        import cjblog.main
+        yield cjblog.main.app.test_client(), sample
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@pytest.mark.parametrize('cursor', _bad_cursors)
+def test_cursor_from_str_rejects_non_finite_dates(blog, cursor):
+    # The blog must be prepared before the database module is imported
+    import cjblog.database as database
+
+    with pytest.raises(ValueError):
+        database.cursor_from_str(cursor)
+
+
+@pytest.mark.parametrize('cursor', _bad_cursors)
+def test_bad_cursors_are_not_found(blog, cursor):
+    client, sample = blog
+    assert client.get('/older/{}'.format(cursor)).status_code == 404
+    for tag in sample['tags'][:1]:
+        url = '/tag/{}/older/{}'.format(tag, cursor)
+        assert client.get(url).status_code == 404